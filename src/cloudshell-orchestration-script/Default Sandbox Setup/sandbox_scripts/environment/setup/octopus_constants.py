@@ -11,6 +11,9 @@ REMOVE_MACHINE = 'remove_existing_machine_from_environment'
 
 ADD_ENVIRONMENT_TO_LIFECYCLE_COMMAND = 'add_environment_to_optional_targets_of_lifecycle'
 DEPLOY_RELEASE_COMMAND = 'deploy_environment_to_release'
+START_DEPLOYMENT_COMMAND = 'start_deployment'
+WAIT_FOR_DEPLOYMENTS_COMMAND = 'wait_for_deployments'
+PROVISION_SANDBOX_COMMAND = 'provision_sandbox'
 
 #  JUST FOR DEMO
 DEMO_PROJECT_NAME = 'TestTest2'
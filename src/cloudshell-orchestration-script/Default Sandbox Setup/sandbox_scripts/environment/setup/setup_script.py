@@ -1,5 +1,7 @@
 from multiprocessing.pool import ThreadPool
-from threading import Lock
+from threading import Event, Lock
+import json
+import time
 
 from cloudshell.helpers.scripts import cloudshell_scripts_helpers as helpers
 from cloudshell.api.cloudshell_api import *
@@ -8,7 +10,11 @@ from cloudshell.core.logger.qs_logger import get_qs_logger
 from remap_child_resources_constants import *
 import octopus_constants as oct
 
+from sandbox_scripts.helpers.app_pipeline import AppPipeline
+from sandbox_scripts.helpers.operation_limiter import OperationLimiter, is_rejected_error
 from sandbox_scripts.helpers.resource_helpers import *
+from sandbox_scripts.helpers.service_deployment import ServiceDeployment
+from sandbox_scripts.helpers.stage_scheduler import StageScheduler
 from sandbox_scripts.profiler.env_profiler import profileit
 
 SERVICE_TARGET_TYPE = 'Service'
@@ -25,6 +31,24 @@ PROFILE_NAME_ATTR = 'Profile Name'
 
 OCTOPUS_ORCHESTRATOR_SERVICE_NAME = 'Octopus Deploy Orchestrator'
 
+# global input holding the number of apps deployed together, when set every deployed chunk of apps goes on to
+# autoload, power on, refresh ip and install while the other chunks are still deploying, 0 deploys all apps at once
+PIPELINED_SETUP_INPUT = 'quali_pipelined_setup'
+DEFAULT_PIPELINED_SETUP = 0
+
+# most deployed apps autoloaded at the same time
+AUTOLOAD_MAX_WORKERS = 10
+
+# global inputs limiting how many power on, refresh ip and install calls run at the same time, in total and on the
+# same cloud provider, the limit of a cloud provider is lowered while it throttles calls
+MAX_CONCURRENT_APP_OPERATIONS_INPUT = 'quali_max_concurrent_app_operations'
+MAX_CONCURRENT_APP_OPERATIONS_PER_CLOUD_PROVIDER_INPUT = 'quali_max_concurrent_app_operations_per_cloud_provider'
+DEFAULT_MAX_CONCURRENT_APP_OPERATIONS = 20
+DEFAULT_MAX_CONCURRENT_APP_OPERATIONS_PER_CLOUD_PROVIDER = 10
+
+# seconds between checks whether setup failed while an app waits for its routes
+ROUTES_WAIT_INTERVAL = 1
+
 
 class EnvironmentSetup(object):
     NO_DRIVER_ERR = "129"
@@ -35,6 +59,40 @@ class EnvironmentSetup(object):
         self.logger = get_qs_logger(log_file_prefix="CloudShell Sandbox Setup",
                                     log_group=self.reservation_id,
                                     log_category='Setup')
+        global_inputs = helpers.get_global_inputs()
+        self.pipelined_chunk_size = self._get_numeric_global_input(global_inputs, PIPELINED_SETUP_INPUT,
+                                                                   DEFAULT_PIPELINED_SETUP, minimum=0)
+        self.max_concurrent_app_operations = self._get_numeric_global_input(
+            global_inputs, MAX_CONCURRENT_APP_OPERATIONS_INPUT, DEFAULT_MAX_CONCURRENT_APP_OPERATIONS, minimum=1)
+        self.app_operations = OperationLimiter(
+            max_concurrent=self.max_concurrent_app_operations,
+            max_concurrent_per_group=self._get_numeric_global_input(
+                global_inputs, MAX_CONCURRENT_APP_OPERATIONS_PER_CLOUD_PROVIDER_INPUT,
+                DEFAULT_MAX_CONCURRENT_APP_OPERATIONS_PER_CLOUD_PROVIDER, minimum=1),
+            logger=self.logger)
+
+    def _get_numeric_global_input(self, global_inputs, name, default, minimum):
+        """
+        A blank global input gets its default, so does a value that is not a whole number of at least minimum,
+        with a warning instead of failing the setup
+        :param dict global_inputs:
+        :param str name:
+        :param int default:
+        :param int minimum:
+        :rtype: int
+        """
+        value = (global_inputs.get(name) or '').strip()
+        if not value:
+            return default
+        try:
+            number = int(value)
+        except ValueError:
+            number = None
+        if number is None or number < minimum:
+            self.logger.warning("Global input {0} should be a whole number of at least {1} but is '{2}', using {3}"
+                                .format(name, minimum, value, default))
+            return default
+        return number
 
     @profileit(scriptName='Setup')
     def execute(self):
@@ -44,51 +102,218 @@ class EnvironmentSetup(object):
         api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
                                             message='Beginning reservation setup')
 
-        self._prepare_connectivity(api, self.reservation_id)
-
-        reservation_details = api.GetReservationDetails(self.reservation_id)
-
-        self._deploy_cloud_provider_services(api, reservation_details)
-
-        octo_environment_name = self._get_octopus_environment_name(reservation_details)
-        environment_parameters_for_octopus_apps = self._create_octopus_environment(reservation_details, api,
-                                                                                   octo_environment_name)
+        stages = self._get_setup_stages(api, resource_details_cache)
+        try:
+            stages.run()
+        finally:
+            self.logger.info("Setup critical path for reservation {0}: {1}"
+                             .format(self.reservation_id, stages.format_critical_path()))
+            self.logger.info("App operations for reservation {0}: {1}"
+                             .format(self.reservation_id, self.app_operations.format_metrics()))
 
-        api.WriteMessageToReservationOutput(self.reservation_id, 'Octopus parameters are: {0}'
-                                            .format(environment_parameters_for_octopus_apps))
+        self.logger.info("Setup for reservation {0} completed".format(self.reservation_id))
+        api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
+                                            message='Reservation setup finished successfully')
 
-        deploy_result = self._deploy_apps_in_reservation(api=api,
-                                                         reservation_details=reservation_details,
-                                                         octopus_app_params=environment_parameters_for_octopus_apps)
+    def _get_setup_stages(self, api, resource_details_cache):
+        """
+        The setup flow as stages with their dependencies, a stage gets the results of the stages it depends on
+        :param CloudShellAPISession api:
+        :param (dict of str: ResourceInfo) resource_details_cache:
+        :rtype: StageScheduler
+        """
+        def create_octopus_environment(reservation_details):
+            octo_environment_name = self._get_octopus_environment_name(reservation_details)
+            environment_parameters_for_octopus_apps = self._create_octopus_environment(reservation_details, api,
+                                                                                       octo_environment_name)
+            api.WriteMessageToReservationOutput(self.reservation_id, 'Octopus parameters are: {0}'
+                                                .format(environment_parameters_for_octopus_apps))
+            return octo_environment_name, environment_parameters_for_octopus_apps
+
+        def start_octopus_deployment(reservation_details, octopus_environment):
+            # the octopus deployment runs on the octopus server while apps power on and refresh their IPs
+            return self._start_octopus_deployment(reservation_details, api, octopus_environment[0])
+
+        def wait_for_octopus_deployment(reservation_details, octopus_task_id, *_):
+            self._wait_for_octopus_deployment(reservation_details, api, octopus_task_id)
+
+        stages = StageScheduler(self.logger) \
+            .add('reservation details', lambda: api.GetReservationDetails(self.reservation_id)) \
+            .add('prepare connectivity', lambda: self._prepare_connectivity(api, self.reservation_id)) \
+            .add('deploy cloud provider services',
+                 lambda reservation_details, *_: self._deploy_cloud_provider_services(api, reservation_details),
+                 ['reservation details', 'prepare connectivity']) \
+            .add('create octopus environment', create_octopus_environment, ['reservation details'])
+        if self.pipelined_chunk_size:
+            self._add_pipelined_app_stages(stages, api, resource_details_cache)
+        else:
+            self._add_app_stages(stages, api, resource_details_cache)
+        return stages \
+            .add('start octopus deployment', start_octopus_deployment,
+                 ['refresh reservation details', 'create octopus environment']) \
+            .add('wait for octopus deployment', wait_for_octopus_deployment,
+                 ['refresh reservation details', 'start octopus deployment', 'power on, refresh ip and install'])
+
+    def _add_app_stages(self, stages, api, resource_details_cache):
+        """
+        Deploys all apps in one bulk deployment, then autoloads, powers on, refreshes the IP of and installs them
+        :param StageScheduler stages:
+        :param CloudShellAPISession api:
+        :param (dict of str: ResourceInfo) resource_details_cache:
+        """
+        def deploy_apps(reservation_details, octopus_environment, *_):
+            return self._deploy_apps_in_reservation(api=api,
+                                                    reservation_details=reservation_details,
+                                                    octopus_app_params=octopus_environment[1])
+
+        def power_on_refresh_ip_install(reservation_details, deploy_result, *_):
+            self._run_async_power_on_refresh_ip_install(api=api,
+                                                        reservation_details=reservation_details,
+                                                        deploy_results=deploy_result,
+                                                        resource_details_cache=resource_details_cache,
+                                                        reservation_id=self.reservation_id)
+
+        stages \
+            .add('deploy apps', deploy_apps,
+                 ['reservation details', 'create octopus environment', 'prepare connectivity',
+                  'deploy cloud provider services']) \
+            .add('autoload',
+                 lambda deploy_result: self._try_exeucte_autoload(api=api,
+                                                                  deploy_result=deploy_result,
+                                                                  resource_details_cache=resource_details_cache),
+                 ['deploy apps']) \
+            .add('refresh reservation details',
+                 lambda reservation_details, deploy_result: self._refresh_reservation_details(api, reservation_details,
+                                                                                              deploy_result),
+                 ['reservation details', 'deploy apps']) \
+            .add('connect routes',
+                 lambda reservation_details, *_: self._connect_all_routes_in_reservation(
+                     api=api,
+                     reservation_details=reservation_details,
+                     reservation_id=self.reservation_id,
+                     resource_details_cache=resource_details_cache),
+                 ['refresh reservation details', 'autoload', 'prepare connectivity']) \
+            .add('power on, refresh ip and install', power_on_refresh_ip_install,
+                 ['refresh reservation details', 'deploy apps', 'connect routes'])
+
+    def _add_pipelined_app_stages(self, stages, api, resource_details_cache):
+        """
+        Deploys apps in chunks of pipelined_chunk_size, each deployed app is autoloaded, powered on, gets its IP
+        refreshed and is installed without waiting for the other apps. Only apps with routes to connect wait for
+        route connection, which happens once every app is deployed and autoloaded, before powering on.
+        :param StageScheduler stages:
+        :param CloudShellAPISession api:
+        :param (dict of str: ResourceInfo) resource_details_cache:
+        """
+        lock = Lock()
+        message_status = {
+            "autoload": False,
+            "power_on": False,
+            "wait_for_ip": False,
+            "install": False
+        }
+        apps_with_routes = set()
+        routes_connected = Event()
+
+        def autoload(deployed_app, deploy_result):
+            self._autoload_deployed_app(api, deployed_app.AppDeploymentyInfo.LogicalResourceName,
+                                        resource_details_cache, lock, message_status)
+
+        def wait_for_routes(deployed_app, deploy_result):
+            if deployed_app.AppName not in apps_with_routes:
+                return
+            while not routes_connected.wait(ROUTES_WAIT_INTERVAL):
+                if stages.failed.is_set() or pipeline.failed.is_set():
+                    raise Exception("Routes of deployed app {0} were not connected"
+                                    .format(deployed_app.AppDeploymentyInfo.LogicalResourceName))
+
+        def power_on_refresh_ip_install(deployed_app, deploy_result):
+            success, message = self._power_on_refresh_ip_install(api, lock, message_status,
+                                                                 deployed_app.AppDeploymentyInfo.LogicalResourceName,
+                                                                 deploy_result, resource_details_cache)
+            if not success:
+                raise Exception(message)
+
+        pipeline = AppPipeline(deploy=lambda app_names: self._deploy_apps(api, app_names),
+                               steps=[('autoload', autoload),
+                                      ('wait for routes', wait_for_routes),
+                                      ('power on, refresh ip and install', power_on_refresh_ip_install)],
+                               chunk_size=self.pipelined_chunk_size,
+                               logger=self.logger)
+
+        def deploy_apps(reservation_details, octopus_environment, *_):
+            apps_with_routes.update(self._get_apps_with_routes_to_connect(reservation_details))
+            return self._deploy_apps_in_reservation(api=api,
+                                                    reservation_details=reservation_details,
+                                                    octopus_app_params=octopus_environment[1],
+                                                    pipeline=pipeline)
 
-        self._try_exeucte_autoload(api=api,
-                                   deploy_result=deploy_result,
-                                   resource_details_cache=resource_details_cache)
+        def wait_for_autoload(deploy_result):
+            if deploy_result is None:
+                return self._try_exeucte_autoload(api=api, deploy_result=None,
+                                                  resource_details_cache=resource_details_cache)
+            pipeline.wait_step('autoload')
 
+        def connect_routes(reservation_details, *_):
+            self._connect_all_routes_in_reservation(api=api,
+                                                    reservation_details=reservation_details,
+                                                    reservation_id=self.reservation_id,
+                                                    resource_details_cache=resource_details_cache)
+            routes_connected.set()
+
+        def wait_for_power_on_refresh_ip_install(reservation_details, deploy_result, *_):
+            if deploy_result is None:
+                return self._run_async_power_on_refresh_ip_install(api=api,
+                                                                   reservation_details=reservation_details,
+                                                                   deploy_results=None,
+                                                                   resource_details_cache=resource_details_cache,
+                                                                   reservation_id=self.reservation_id)
+            errors = pipeline.join()
+            if errors:
+                raise Exception("Reservation is Active with Errors - " +
+                                ", ".join(error.message for _, error in sorted(errors.items())))
+            self._validate_all_apps_deployed(deploy_result)
+
+        stages \
+            .add('deploy apps', deploy_apps,
+                 ['reservation details', 'create octopus environment', 'prepare connectivity',
+                  'deploy cloud provider services']) \
+            .add('autoload', wait_for_autoload, ['deploy apps']) \
+            .add('refresh reservation details',
+                 lambda reservation_details, deploy_result: self._refresh_reservation_details(api, reservation_details,
+                                                                                              deploy_result),
+                 ['reservation details', 'deploy apps']) \
+            .add('connect routes', connect_routes, ['refresh reservation details', 'autoload', 'prepare connectivity']) \
+            .add('power on, refresh ip and install', wait_for_power_on_refresh_ip_install,
+                 ['refresh reservation details', 'deploy apps', 'connect routes'])
+
+    def _refresh_reservation_details(self, api, reservation_details, deploy_result):
         # refresh reservation_details after app deployment if any deployed apps
         if deploy_result and deploy_result.ResultItems:
-            reservation_details = api.GetReservationDetails(self.reservation_id)
-
-        self._connect_all_routes_in_reservation(api=api,
-                                                reservation_details=reservation_details,
-                                                reservation_id=self.reservation_id,
-                                                resource_details_cache=resource_details_cache)
-
-        self._run_async_power_on_refresh_ip_install(api=api,
-                                                    reservation_details=reservation_details,
-                                                    deploy_results=deploy_result,
-                                                    resource_details_cache=resource_details_cache,
-                                                    reservation_id=self.reservation_id)
-
-        self.logger.info("Setup for reservation {0} completed".format(self.reservation_id))
-        api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
-                                            message='Reservation setup finished successfully')
-
-        self._deploy_sandbox_to_octopus(reservation_details, api, octo_environment_name)
+            return api.GetReservationDetails(self.reservation_id)
+        return reservation_details
 
-    def _deploy_sandbox_to_octopus(self, reservation_details, api, octopus_environment_name):
-        octopus_service = self._get_octopus_service(reservation_details).Alias
-        if not octopus_service: return
+    def _get_apps_with_routes_to_connect(self, reservation_details):
+        """
+        :param GetReservationDescriptionResponseInfo reservation_details: details from before the apps are deployed
+        :return: names of the apps that are an endpoint of a route that will be connected
+        :rtype: set[str]
+        """
+        app_names = set(app.Name for app in reservation_details.ReservationDescription.Apps)
+        endpoints = set()
+        for connector in reservation_details.ReservationDescription.Connectors:
+            if connector.State in ['Disconnected', 'PartiallyConnected', 'ConnectionFailed'] \
+                    and connector.Target and connector.Source:
+                endpoints.add(connector.Source.split('/')[0])
+                endpoints.add(connector.Target.split('/')[0])
+        return app_names & endpoints
+
+    def _start_octopus_deployment(self, reservation_details, api, octopus_environment_name):
+        """
+        :return: id of the octopus task running the deployment, None if there is no octopus service
+        """
+        octopus_service = self._get_octopus_service(reservation_details)
+        if not octopus_service: return None
 
         res_id = reservation_details.ReservationDescription.Id
         inputs = {input.ParamName: input.Value for input in api.GetReservationInputs(res_id).GlobalInputs}
@@ -98,10 +323,21 @@ class EnvironmentSetup(object):
         phase_name = InputNameValue('phase_name', inputs['Phase Name'])
         environment_name = InputNameValue('environment_name', octopus_environment_name)
 
-        api.ExecuteCommand(res_id, octopus_service, SERVICE_TARGET_TYPE, oct.ADD_ENVIRONMENT_TO_LIFECYCLE_COMMAND,
-                           [project_name, channel_name, environment_name, phase_name])
-        api.ExecuteCommand(res_id, octopus_service, SERVICE_TARGET_TYPE, oct.DEPLOY_RELEASE_COMMAND,
-                           [project_name, release_version, environment_name])
+        output = api.ExecuteCommand(res_id, octopus_service.Alias, SERVICE_TARGET_TYPE, oct.PROVISION_SANDBOX_COMMAND,
+                                    [project_name, channel_name, release_version, phase_name, environment_name]).Output
+        provisioned = json.loads(output)
+        self.logger.info('Octopus sandbox provisioned: {0}'.format(output))
+
+        api.WriteMessageToReservationOutput(res_id, 'Deployment to Octopus started')
+        return provisioned['TaskId']
+
+    def _wait_for_octopus_deployment(self, reservation_details, api, octopus_task_id):
+        if not octopus_task_id: return
+
+        res_id = reservation_details.ReservationDescription.Id
+        octopus_service = self._get_octopus_service(reservation_details)
+        api.ExecuteCommand(res_id, octopus_service.Alias, SERVICE_TARGET_TYPE, oct.WAIT_FOR_DEPLOYMENTS_COMMAND,
+                           [InputNameValue('task_ids', octopus_task_id)])
 
         api.WriteMessageToReservationOutput(res_id, 'Deployment to Octopus completed')
 
@@ -146,37 +382,47 @@ class EnvironmentSetup(object):
         return octopus_service
 
     def _deploy_cloud_provider_services(self, api, reservation_details):
+        """
+        Creates every CDN profile once and deploys every azure service, all concurrently, a service that names a
+        profile is deployed once its profile was created
+        :param CloudShellAPISession api:
+        :param GetReservationDescriptionResponseInfo reservation_details:
+        """
         cloud_provider = self._get_cloud_provider_from_azure_apps(reservation_details)
         if cloud_provider is not None:
-            pool = ThreadPool()
-            deploy_commands = []
-            cdn_profiles = []
+            profiles = {}
+            services = {}
+            service_profiles = []
             for service in reservation_details.ReservationDescription.Services:
                 service_attributes = {attr.Name: attr.Value for attr in service.Attributes}
 
-                if AZURE_RESOURCE_ATTR in service_attributes.keys():
-                    deploy_commands.append((api.ExecuteCommand, (reservation_details.ReservationDescription.Id,
-                                                                 service.Alias, SERVICE_TARGET_TYPE, DEPLOY_COMMAND,
-                                                                 [InputNameValue(CLOUD_PROVIDER_ATTR,
-                                                                                 service_attributes[
-                                                                                     AZURE_RESOURCE_ATTR])])))
-
-                if PROFILE_NAME_ATTR in service_attributes.keys():
-                    self.create_profile(api, cdn_profiles, service_attributes[AZURE_RESOURCE_ATTR], reservation_details,
-                                        service,
-                                        service_attributes)
-
-            for deploy_command in deploy_commands:
-                pool.apply_async(*deploy_command)
-            pool.close()
-            pool.join()
-
-    def create_profile(self, api, cdn_profiles, cloud_provider, reservation_details, service, service_attributes):
-        profile = service_attributes[PROFILE_NAME_ATTR]
-        if profile not in cdn_profiles:
-            cdn_profiles.append(profile)
-            api.ExecuteCommand(reservation_details.ReservationDescription.Id, service.Alias, SERVICE_TARGET_TYPE,
-                               CREATE_PROFILE_COMMAND, [InputNameValue(CLOUD_PROVIDER_ATTR, cloud_provider)])
+                profile = service_attributes.get(PROFILE_NAME_ATTR)
+                if profile is not None and profile not in profiles:
+                    profiles[profile] = (service, service_attributes[AZURE_RESOURCE_ATTR])
+
+                if AZURE_RESOURCE_ATTR in service_attributes:
+                    services[service.Alias] = (service, service_attributes[AZURE_RESOURCE_ATTR])
+                    service_profiles.append((service.Alias, profile))
+
+            deployment = ServiceDeployment(
+                create_profile=lambda profile: self.create_profile(api, profiles[profile][1], reservation_details,
+                                                                   profiles[profile][0]),
+                deploy=lambda alias: self._deploy_service(api, services[alias][1], reservation_details,
+                                                          services[alias][0]),
+                logger=self.logger)
+            errors = deployment.run(sorted(profiles), service_profiles)
+            for error in errors:
+                api.WriteMessageToReservationOutput(reservationId=self.reservation_id, message=error)
+            if errors:
+                raise Exception("Reservation is Active with Errors - " + ", ".join(errors))
+
+    def create_profile(self, api, cloud_provider, reservation_details, service):
+        api.ExecuteCommand(reservation_details.ReservationDescription.Id, service.Alias, SERVICE_TARGET_TYPE,
+                           CREATE_PROFILE_COMMAND, [InputNameValue(CLOUD_PROVIDER_ATTR, cloud_provider)])
+
+    def _deploy_service(self, api, cloud_provider, reservation_details, service):
+        api.ExecuteCommand(reservation_details.ReservationDescription.Id, service.Alias, SERVICE_TARGET_TYPE,
+                           DEPLOY_COMMAND, [InputNameValue(CLOUD_PROVIDER_ATTR, cloud_provider)])
 
     def _get_cloud_provider_from_azure_apps(self, reservation_details):
         """
@@ -221,58 +467,92 @@ class EnvironmentSetup(object):
             api.WriteMessageToReservationOutput(reservationId=self.reservation_id, message='No apps to discover')
             return
 
-        message_written = False
+        deployed_app_names = [deployed_app.AppDeploymentyInfo.LogicalResourceName
+                              for deployed_app in deploy_result.ResultItems if deployed_app.Success]
+        if not deployed_app_names:
+            return
 
-        for deployed_app in deploy_result.ResultItems:
-            if not deployed_app.Success:
-                continue
-            deployed_app_name = deployed_app.AppDeploymentyInfo.LogicalResourceName
+        pool = ThreadPool(min(AUTOLOAD_MAX_WORKERS, len(deployed_app_names)))
+        lock = Lock()
+        message_status = {"autoload": False}
 
-            resource_details = api.GetResourceDetails(deployed_app_name)
-            resource_details_cache[deployed_app_name] = resource_details
+        async_results = [pool.apply_async(self._timed_autoload_deployed_app,
+                                          (api, deployed_app_name, resource_details_cache, lock, message_status))
+                         for deployed_app_name in deployed_app_names]
 
-            autoload = "true"
-            autoload_param = get_vm_custom_param(resource_details, "autoload")
-            if autoload_param:
-                autoload = autoload_param.Value
-            if autoload.lower() != "true":
-                self.logger.info("Apps discovery is disabled on deployed app {0}".format(deployed_app_name))
-                continue
+        pool.close()
+        pool.join()
 
-            try:
-                self.logger.info("Executing Autoload command on deployed app {0}".format(deployed_app_name))
-                if not message_written:
-                    api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
-                                                        message='Apps are being discovered...')
-                    message_written = True
-
-                api.AutoLoad(deployed_app_name)
-
-                # for devices that are autoloaded and have child resources attempt to call "Connect child resources"
-                # which copies CVCs from app to deployed app ports.
-                api.ExecuteCommand(self.reservation_id, deployed_app_name,
-                                   TARGET_TYPE_RESOURCE,
-                                   REMAP_CHILD_RESOURCES, [])
-
-            except CloudShellAPIError as exc:
-                if exc.code not in (EnvironmentSetup.NO_DRIVER_ERR,
-                                    EnvironmentSetup.DRIVER_FUNCTION_ERROR,
-                                    MISSING_COMMAND_ERROR):
-                    self.logger.error(
-                        "Error executing Autoload command on deployed app {0}. Error: {1}".format(deployed_app_name,
-                                                                                                  exc.rawxml))
-                    api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
-                                                        message='Discovery failed on "{0}": {1}'
-                                                        .format(deployed_app_name, exc.message))
-
-            except Exception as exc:
-                self.logger.error("Error executing Autoload command on deployed app {0}. Error: {1}"
-                                  .format(deployed_app_name, str(exc)))
+        for async_result in async_results:
+            async_result.get()
+
+    def _timed_autoload_deployed_app(self, api, deployed_app_name, resource_details_cache, lock, message_status):
+        started = time.time()
+        try:
+            self._autoload_deployed_app(api, deployed_app_name, resource_details_cache, lock, message_status)
+        finally:
+            self.logger.info("Autoload of deployed app {0} took {1:.1f} seconds"
+                             .format(deployed_app_name, time.time() - started))
+
+    def _autoload_deployed_app(self, api, deployed_app_name, resource_details_cache, lock, message_status):
+        """
+        :param CloudShellAPISession api:
+        :param str deployed_app_name:
+        :param (dict of str: ResourceInfo) resource_details_cache:
+        :param Lock lock:
+        :param (dict of str: Boolean) message_status:
+        """
+        resource_details = api.GetResourceDetails(deployed_app_name)
+        add_resource_details_to_cache(deployed_app_name, resource_details, resource_details_cache)
+
+        autoload = "true"
+        autoload_param = get_vm_custom_param(resource_details, "autoload")
+        if autoload_param:
+            autoload = autoload_param.Value
+        if autoload.lower() != "true":
+            self.logger.info("Apps discovery is disabled on deployed app {0}".format(deployed_app_name))
+            return
+
+        try:
+            self.logger.info("Executing Autoload command on deployed app {0}".format(deployed_app_name))
+            if not message_status['autoload']:
+                with lock:
+                    if not message_status['autoload']:
+                        message_status['autoload'] = True
+                        api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
+                                                            message='Apps are being discovered...')
+
+            api.AutoLoad(deployed_app_name)
+
+            # for devices that are autoloaded and have child resources attempt to call "Connect child resources"
+            # which copies CVCs from app to deployed app ports.
+            api.ExecuteCommand(self.reservation_id, deployed_app_name,
+                               TARGET_TYPE_RESOURCE,
+                               REMAP_CHILD_RESOURCES, [])
+
+        except CloudShellAPIError as exc:
+            if exc.code not in (EnvironmentSetup.NO_DRIVER_ERR,
+                                EnvironmentSetup.DRIVER_FUNCTION_ERROR,
+                                MISSING_COMMAND_ERROR):
+                self.logger.error(
+                    "Error executing Autoload command on deployed app {0}. Error: {1}".format(deployed_app_name,
+                                                                                              exc.rawxml))
                 api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
                                                     message='Discovery failed on "{0}": {1}'
                                                     .format(deployed_app_name, exc.message))
 
-    def _deploy_apps_in_reservation(self, api, reservation_details, octopus_app_params):
+        except Exception as exc:
+            self.logger.error("Error executing Autoload command on deployed app {0}. Error: {1}"
+                              .format(deployed_app_name, str(exc)))
+            api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
+                                                message='Discovery failed on "{0}": {1}'
+                                                .format(deployed_app_name, exc.message))
+
+    def _deploy_apps_in_reservation(self, api, reservation_details, octopus_app_params, pipeline=None):
+        """
+        :param AppPipeline pipeline: deploys the apps instead of a single bulk deployment when given
+        :rtype: BulkAppDeploymentyInfo
+        """
         apps = reservation_details.ReservationDescription.Apps
         if not apps or (len(apps) == 1 and not apps[0].Name):
             self.logger.info("No apps found in reservation {0}".format(self.reservation_id))
@@ -283,13 +563,18 @@ class EnvironmentSetup(object):
         self.update_octopus_apps(api, apps, octopus_app_params)
 
         app_names = map(lambda x: x.Name, apps)
-        app_inputs = map(lambda x: DeployAppInput(x.Name, "Name", x.Name), apps)
 
         api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
                                             message='Apps deployment started')
         self.logger.info(
             "Deploying apps for reservation {0}. App names: {1}".format(reservation_details, ", ".join(app_names)))
 
+        if pipeline:
+            return pipeline.start(app_names).wait_deployed()
+        return self._deploy_apps(api, app_names)
+
+    def _deploy_apps(self, api, app_names):
+        app_inputs = map(lambda x: DeployAppInput(x, "Name", x), app_names)
         res = api.DeployAppToCloudProviderBulk(self.reservation_id, app_names, app_inputs)
 
         return res
@@ -361,7 +646,7 @@ class EnvironmentSetup(object):
             self._validate_all_apps_deployed(deploy_results)
             return
 
-        pool = ThreadPool(len(resources))
+        pool = ThreadPool(min(len(resources), self.max_concurrent_app_operations))
         lock = Lock()
         message_status = {
             "power_on": False,
@@ -370,7 +655,8 @@ class EnvironmentSetup(object):
         }
 
         async_results = [pool.apply_async(self._power_on_refresh_ip_install,
-                                          (api, lock, message_status, resource, deploy_results, resource_details_cache))
+                                          (api, lock, message_status, resource.Name, deploy_results,
+                                           resource_details_cache, time.time()))
                          for resource in resources]
 
         pool.close()
@@ -389,19 +675,21 @@ class EnvironmentSetup(object):
                 if not deploy_res.Success:
                     raise Exception("Reservation is Active with Errors - " + deploy_res.Error)
 
-    def _power_on_refresh_ip_install(self, api, lock, message_status, resource, deploy_result, resource_details_cache):
+    def _power_on_refresh_ip_install(self, api, lock, message_status, deployed_app_name, deploy_result,
+                                     resource_details_cache, queued_since=None):
         """
         :param CloudShellAPISession api:
         :param Lock lock:
         :param (dict of str: Boolean) message_status:
-        :param ReservedResourceInfo resource:
+        :param str deployed_app_name:
         :param BulkAppDeploymentyInfo deploy_result:
         :param (dict of str: ResourceInfo) resource_details_cache:
+        :param float queued_since: when the app was queued for a thread, counted as waiting time of power on
         :return:
         """
 
-        deployed_app_name = resource.Name
         deployed_app_data = None
+        cloud_provider = None
 
         power_on = "true"
         wait_for_ip = "true"
@@ -416,6 +704,7 @@ class EnvironmentSetup(object):
             if not hasattr(vm_details, "UID"):
                 self.logger.debug("Resource {0} is not a deployed app, nothing to do with it".format(deployed_app_name))
                 return True, ""
+            cloud_provider = getattr(vm_details, "CloudProviderFullName", None)
 
             auto_power_on_param = get_vm_custom_param(resource_details, "auto_power_on")
             if auto_power_on_param:
@@ -437,21 +726,21 @@ class EnvironmentSetup(object):
                                                                              str(exc)))
 
         try:
-            self._power_on(api, deployed_app_name, power_on, lock, message_status)
+            self._power_on(api, deployed_app_name, power_on, lock, message_status, cloud_provider, queued_since)
         except Exception as exc:
             self.logger.error("Error powering on deployed app {0} in reservation {1}. Error: {2}"
                               .format(deployed_app_name, self.reservation_id, str(exc)))
             return False, "Error powering on deployed app {0}".format(deployed_app_name)
 
         try:
-            self._wait_for_ip(api, deployed_app_name, wait_for_ip, lock, message_status)
+            self._wait_for_ip(api, deployed_app_name, wait_for_ip, lock, message_status, cloud_provider)
         except Exception as exc:
             self.logger.error("Error refreshing IP on deployed app {0} in reservation {1}. Error: {2}"
                               .format(deployed_app_name, self.reservation_id, str(exc)))
             return False, "Error refreshing IP deployed app {0}. Error: {1}".format(deployed_app_name, exc.message)
 
         try:
-            self._install(api, deployed_app_data, deployed_app_name, lock, message_status)
+            self._install(api, deployed_app_data, deployed_app_name, lock, message_status, cloud_provider)
         except Exception as exc:
             self.logger.error("Error installing deployed app {0} in reservation {1}. Error: {2}"
                               .format(deployed_app_name, self.reservation_id, str(exc)))
@@ -459,7 +748,7 @@ class EnvironmentSetup(object):
 
         return True, ""
 
-    def _install(self, api, deployed_app_data, deployed_app_name, lock, message_status):
+    def _install(self, api, deployed_app_data, deployed_app_name, lock, message_status, cloud_provider):
         installation_info = None
         if deployed_app_data:
             installation_info = deployed_app_data.AppInstallationInfo
@@ -484,12 +773,16 @@ class EnvironmentSetup(object):
                 script_inputs.append(
                     InputNameValue(installation_script_input.Name, installation_script_input.Value))
 
-            installation_result = api.InstallApp(self.reservation_id, deployed_app_name,
-                                                 installation_info.ScriptCommandName, script_inputs)
+            # a throttled installation script may have run partly, it is only tried again when the call was
+            # refused before it ran
+            installation_result = self.app_operations.run(cloud_provider, 'install', api.InstallApp,
+                                                          self.reservation_id, deployed_app_name,
+                                                          installation_info.ScriptCommandName, script_inputs,
+                                                          is_throttled=is_rejected_error)
 
             self.logger.debug("Installation_result: " + installation_result.Output)
 
-    def _wait_for_ip(self, api, deployed_app_name, wait_for_ip, lock, message_status):
+    def _wait_for_ip(self, api, deployed_app_name, wait_for_ip, lock, message_status, cloud_provider):
         if wait_for_ip.lower() == "true":
 
             if not message_status['wait_for_ip']:
@@ -503,14 +796,15 @@ class EnvironmentSetup(object):
             self.logger.info("Executing 'Refresh IP' on deployed app {0} in reservation {1}"
                              .format(deployed_app_name, self.reservation_id))
 
-            api.ExecuteResourceConnectedCommand(self.reservation_id, deployed_app_name,
-                                                "remote_refresh_ip",
-                                                "remote_connectivity")
+            self.app_operations.run(cloud_provider, 'refresh ip', api.ExecuteResourceConnectedCommand,
+                                    self.reservation_id, deployed_app_name,
+                                    "remote_refresh_ip",
+                                    "remote_connectivity")
         else:
             self.logger.info("Wait For IP is off for deployed app {0} in reservation {1}"
                              .format(deployed_app_name, self.reservation_id))
 
-    def _power_on(self, api, deployed_app_name, power_on, lock, message_status):
+    def _power_on(self, api, deployed_app_name, power_on, lock, message_status, cloud_provider, queued_since=None):
         if power_on.lower() == "true":
             self.logger.info("Executing 'Power On' on deployed app {0} in reservation {1}"
                              .format(deployed_app_name, self.reservation_id))
@@ -522,7 +816,9 @@ class EnvironmentSetup(object):
                         api.WriteMessageToReservationOutput(reservationId=self.reservation_id,
                                                             message='Apps are powering on...')
 
-            api.ExecuteResourceConnectedCommand(self.reservation_id, deployed_app_name, "PowerOn", "power")
+            self.app_operations.run(cloud_provider, 'power on', api.ExecuteResourceConnectedCommand,
+                                    self.reservation_id, deployed_app_name, "PowerOn", "power",
+                                    queued_since=queued_since)
         else:
             self.logger.info("Auto Power On is off for deployed app {0} in reservation {1}"
                              .format(deployed_app_name, self.reservation_id))
@@ -0,0 +1,146 @@
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class PipelineDeployResult(object):
+    def __init__(self, result_items):
+        """
+        The deployment results of every chunk, shaped like the BulkAppDeploymentyInfo of a single bulk deployment
+        :type result_items: list[BulkAppDeploymentyResultItem]
+        """
+        self.ResultItems = result_items
+
+
+class AppPipeline(object):
+    def __init__(self, deploy, steps, chunk_size=1, logger=None):
+        """
+        Deploys apps in chunks, all chunks in parallel, and takes every app through the steps that follow
+        deployment as soon as its own chunk is deployed, so setup waits for the slowest app rather than for
+        the slowest app of every step
+        :param deploy: deploys a chunk of apps, e.g. DeployAppToCloudProviderBulk
+        :type deploy: (list[str]) -> BulkAppDeploymentyInfo
+        :param steps: (name, step) pairs run in order on every app deployed successfully, step is called with the
+        BulkAppDeploymentyResultItem of the app and the BulkAppDeploymentyInfo of its chunk, an app stops at
+        the first step that raises
+        :param chunk_size: number of apps deployed by each call to deploy
+        :param logger: gets a line with the duration of every step of every app
+        """
+        self._deploy = deploy
+        self._steps = steps
+        self._chunk_size = chunk_size
+        self._logger = logger
+        self._condition = threading.Condition()
+        self._pool = None
+        self._chunks_pending = 0
+        self._deploy_errors = []
+        self._result_items = []
+        self._apps_in_steps = 0
+        self._apps_past_step = {name: 0 for name, _ in steps}
+        self.errors = {}
+        self.timings = {}
+        # set as soon as a chunk fails to deploy, no step starts after that, for steps waiting on something
+        # that will not happen once deployment failed
+        self.failed = threading.Event()
+
+    def start(self, app_names):
+        """
+        :type app_names: list[str]
+        :rtype: AppPipeline
+        """
+        chunks = [app_names[i:i + self._chunk_size] for i in xrange(0, len(app_names), self._chunk_size)]
+        self._chunks_pending = len(chunks)
+        # every app gets a thread, steps may wait for something that happens once other apps passed a step
+        self._pool = ThreadPool(max(len(app_names), 1))
+        for chunk in chunks:
+            self._pool.apply_async(self._deploy_chunk, (chunk,))
+        return self
+
+    def wait_deployed(self):
+        """
+        Waits for every chunk to be deployed. When a deployment raised, waits for the steps already running
+        and raises the first error.
+        :rtype: PipelineDeployResult
+        """
+        with self._condition:
+            while self._chunks_pending:
+                self._condition.wait()
+        if self._deploy_errors:
+            self._pool.close()
+            self._pool.join()
+            error_type, error, traceback = self._deploy_errors[0]
+            raise error_type, error, traceback
+        return PipelineDeployResult(self._result_items)
+
+    def wait_step(self, name):
+        """
+        Waits until every deployed app passed the step, or stopped before it
+        """
+        with self._condition:
+            while self._chunks_pending or self._apps_past_step[name] < self._apps_in_steps:
+                self._condition.wait()
+
+    def join(self):
+        """
+        Waits until every app went through all the steps
+        :return: error of every app that stopped at a step, by deployed app name
+        :rtype: dict[str, Exception]
+        """
+        if self._steps:
+            self.wait_step(self._steps[-1][0])
+        else:
+            self.wait_deployed()
+        self._pool.close()
+        self._pool.join()
+        return self.errors
+
+    def _deploy_chunk(self, app_names):
+        deploy_result = None
+        try:
+            deploy_result = self._deploy(app_names)
+        except Exception:
+            with self._condition:
+                self._deploy_errors.append(sys.exc_info())
+                self.failed.set()
+        with self._condition:
+            self._chunks_pending -= 1
+            if deploy_result is not None:
+                self._result_items.extend(deploy_result.ResultItems)
+                for deployed_app in deploy_result.ResultItems:
+                    if deployed_app.Success and not self.failed.is_set():
+                        self._apps_in_steps += 1
+                        self._pool.apply_async(self._run_steps, (deployed_app, deploy_result))
+            self._condition.notify_all()
+
+    def _run_steps(self, deployed_app, deploy_result):
+        deployed_app_name = deployed_app.AppDeploymentyInfo.LogicalResourceName
+        timings = self.timings[deployed_app_name] = {}
+        for index, (name, step) in enumerate(self._steps):
+            if self.failed.is_set():
+                with self._condition:
+                    for skipped, _ in self._steps[index:]:
+                        self._apps_past_step[skipped] += 1
+                    self._condition.notify_all()
+                return
+            started = time.time()
+            error = None
+            try:
+                step(deployed_app, deploy_result)
+            except Exception as exc:
+                error = exc
+            timings[name] = time.time() - started
+            if self._logger:
+                self._logger.info('App {0} {1} {2} in {3:.1f} seconds'
+                                  .format(deployed_app_name, name, 'failed' if error else 'finished', timings[name]))
+            with self._condition:
+                if error:
+                    self.errors[deployed_app_name] = error
+                    # the app will not reach the remaining steps either
+                    for skipped, _ in self._steps[index:]:
+                        self._apps_past_step[skipped] += 1
+                else:
+                    self._apps_past_step[name] += 1
+                self._condition.notify_all()
+            if error:
+                return
@@ -0,0 +1,155 @@
+import re
+import threading
+import time
+
+# an http 429 status as the http client or cloudshell report it, e.g. HTTP Error 429, status code: 429
+REJECTED_STATUS_PATTERN = re.compile(r'\b(?:http(?: error)?|status(?: code)?)\W*429\b', re.IGNORECASE)
+
+# throttling codes and messages of the cloud providers, e.g. Throttling, TooManyRequests, RequestLimitExceeded,
+# SubscriptionRequestsThrottled, ServerBusy
+THROTTLING_ERROR_PATTERN = re.compile(r'throttl|too ?many ?requests|rate ?limit ?exceeded|request ?limit ?exceeded|'
+                                      r'server ?is ?busy|serverbusy', re.IGNORECASE)
+
+# times a throttled operation is tried again, each time after waiting THROTTLING_BACKOFF seconds longer
+THROTTLING_RETRIES = 3
+THROTTLING_BACKOFF = 5
+
+
+def is_rejected_error(exc):
+    """
+    Whether the call was refused with an http 429 before it ran, so running it again does not repeat its work
+    :type exc: Exception
+    :rtype: bool
+    """
+    # urllib2.HTTPError has the status as an int, the code of a CloudShellAPIError is a cloudshell error code
+    return getattr(exc, 'code', None) == 429 or bool(REJECTED_STATUS_PATTERN.search(str(exc)))
+
+
+def is_throttling_error(exc):
+    """
+    Whether the call was refused for load, by cloudshell or by the cloud provider
+    :type exc: Exception
+    :rtype: bool
+    """
+    return is_rejected_error(exc) or bool(THROTTLING_ERROR_PATTERN.search(str(exc)))
+
+
+class _Slots(object):
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.successes = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while self.in_use >= self.limit:
+                self._condition.wait()
+            self.in_use += 1
+
+    def release(self):
+        with self._condition:
+            self.in_use -= 1
+            self._condition.notify_all()
+
+    def decrease(self):
+        """
+        :return: the new limit
+        """
+        with self._condition:
+            self.limit = max(1, self.limit // 2)
+            self.successes = 0
+            return self.limit
+
+    def succeeded(self, max_limit):
+        # gives back one slot for every limit operations in a row that were not throttled
+        with self._condition:
+            self.successes += 1
+            if self.limit < max_limit and self.successes >= self.limit:
+                self.limit += 1
+                self.successes = 0
+                self._condition.notify_all()
+
+
+class OperationLimiter(object):
+    def __init__(self, max_concurrent, max_concurrent_per_group, is_throttled=is_throttling_error, logger=None):
+        """
+        Limits how many operations run at the same time, in total and per group, e.g. per cloud provider.
+        A group that gets throttled has its limit halved and the operation is tried again, the limit grows
+        back one at a time while operations succeed.
+        :param int max_concurrent: operations running at the same time over all groups
+        :param int max_concurrent_per_group: operations of the same group running at the same time
+        :param is_throttled: tells whether an error means the operation was rejected for load
+        :type is_throttled: (Exception) -> bool
+        :param logger: gets a line whenever the limit of a group changes because of throttling
+        """
+        self._max_concurrent_per_group = max_concurrent_per_group
+        self._is_throttled = is_throttled
+        self._logger = logger
+        self._slots = _Slots(max_concurrent)
+        self._group_slots = {}
+        self._lock = threading.Lock()
+        self.metrics = {}
+
+    def run(self, group, stage, operation, *args, **kwargs):
+        """
+        Runs the operation once there is a free slot in its group and in total
+        :param str group: e.g. the cloud provider the operation calls
+        :param str stage: name the waiting and running times are added up under
+        :param float queued_since: when the operation started waiting, e.g. when it was queued in a pool,
+        defaults to now
+        :param is_throttled: overrides the one of the limiter for this operation, e.g. is_rejected_error for an
+        operation that must not run twice
+        :return: what operation returned
+        """
+        queued_since = kwargs.pop('queued_since', None)
+        is_throttled = kwargs.pop('is_throttled', self._is_throttled)
+        group_slots = self._get_group_slots(group)
+        for attempt in xrange(THROTTLING_RETRIES + 1):
+            wait_started = queued_since or time.time()
+            queued_since = None
+            group_slots.acquire()
+            self._slots.acquire()
+            started = time.time()
+            try:
+                result = operation(*args, **kwargs)
+            except Exception as exc:
+                throttled = is_throttled(exc)
+                if not throttled or attempt == THROTTLING_RETRIES:
+                    raise
+            else:
+                group_slots.succeeded(self._max_concurrent_per_group)
+                return result
+            finally:
+                finished = time.time()
+                self._slots.release()
+                group_slots.release()
+                self._add_metrics(stage, started - wait_started, finished - started)
+
+            limit = group_slots.decrease()
+            if self._logger:
+                self._logger.warning("{0} was throttled on {1}, running at most {2} operations on it at a time"
+                                     .format(stage, group, limit))
+            time.sleep(THROTTLING_BACKOFF * (attempt + 1))
+
+    def format_metrics(self):
+        return ', '.join('{0}: {1} calls, waited {2:.1f}s avg {3:.1f}s max, ran {4:.1f}s avg {5:.1f}s max'
+                         .format(stage, metrics['calls'], metrics['waited'] / metrics['calls'], metrics['max waited'],
+                                 metrics['ran'] / metrics['calls'], metrics['max ran'])
+                         for stage, metrics in sorted(self.metrics.iteritems()))
+
+    def _get_group_slots(self, group):
+        with self._lock:
+            if group not in self._group_slots:
+                self._group_slots[group] = _Slots(self._max_concurrent_per_group)
+            return self._group_slots[group]
+
+    def _add_metrics(self, stage, waited, ran):
+        with self._lock:
+            metrics = self.metrics.setdefault(stage, {'calls': 0, 'waited': 0, 'max waited': 0,
+                                                      'ran': 0, 'max ran': 0})
+            metrics['calls'] += 1
+            metrics['waited'] += waited
+            metrics['max waited'] = max(metrics['max waited'], waited)
+            metrics['ran'] += ran
+            metrics['max ran'] = max(metrics['max ran'], ran)
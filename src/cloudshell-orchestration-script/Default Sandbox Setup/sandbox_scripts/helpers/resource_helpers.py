@@ -1,3 +1,9 @@
+from threading import Lock
+
+# guards every resource details cache, setup fills and reads them from several threads
+_resource_details_cache_lock = Lock()
+
+
 def get_vm_custom_param(resource_info, param_name):
     """
     :param ResourceInfo resource_info:
@@ -77,8 +83,18 @@ def get_resource_details_from_cache_or_server(api, resource_name, resource_detai
     :param dict(str:ResourceInfo) resource_details_cache:
     :return: ResourceInfo resource_details
     """
-    if resource_name in resource_details_cache:
-        resource_details = resource_details_cache[resource_name]
-    else:
+    with _resource_details_cache_lock:
+        resource_details = resource_details_cache.get(resource_name)
+    if resource_details is None:
         resource_details = api.GetResourceDetails(resource_name)
     return resource_details
+
+
+def add_resource_details_to_cache(resource_name, resource_details, resource_details_cache):
+    """
+    :param str resource_name:
+    :param ResourceInfo resource_details:
+    :param dict(str:ResourceInfo) resource_details_cache:
+    """
+    with _resource_details_cache_lock:
+        resource_details_cache[resource_name] = resource_details
@@ -0,0 +1,77 @@
+import threading
+from multiprocessing.pool import ThreadPool
+
+# most profiles created and services deployed at the same time
+SERVICES_MAX_WORKERS = 10
+
+
+class ServiceDeployment(object):
+    def __init__(self, create_profile, deploy, max_workers=SERVICES_MAX_WORKERS, logger=None):
+        """
+        Creates every CDN profile once and deploys every service, all concurrently, a service that is in a
+        profile is deployed once its profile was created and is not deployed when that failed
+        :param create_profile: creates a profile by name
+        :type create_profile: (str) -> None
+        :param deploy: deploys a service by name
+        :type deploy: (str) -> None
+        :param max_workers: profiles and services handled at the same time
+        :param logger: gets a line for every profile or service that failed
+        """
+        self._create_profile = create_profile
+        self._deploy = deploy
+        self._max_workers = max_workers
+        self._logger = logger
+        self.profile_errors = {}
+        self.deploy_errors = {}
+
+    def run(self, profiles, services):
+        """
+        :param profiles: names of the profiles to create
+        :type profiles: list[str]
+        :param services: (service name, name of its profile or None) pairs
+        :type services: list[(str, str)]
+        :return: a message for every profile that was not created and every service that was not deployed,
+        profiles first
+        :rtype: list[str]
+        """
+        if not profiles and not services:
+            return []
+        # an AsyncResult only wakes one of the threads waiting for it, deployments of a profile wait for an event
+        profiles_created = {profile: threading.Event() for profile in profiles}
+        pool = ThreadPool(min(self._max_workers, len(profiles) + len(services)))
+        # the pool takes tasks in order, every profile gets a thread before any deployment can wait for one
+        for profile in profiles:
+            pool.apply_async(self._run_create_profile, (profile, profiles_created[profile]))
+        deployments = [(service, pool.apply_async(self._run_deploy, (service, profile, profiles_created.get(profile))))
+                       for service, profile in services]
+        pool.close()
+        pool.join()
+
+        for service, deployment in deployments:
+            try:
+                deployment.get()
+            except Exception as exc:
+                if self._logger:
+                    self._logger.error("Error deploying service {0}. Error: {1}".format(service, str(exc)))
+                self.deploy_errors[service] = exc
+        return ['Error creating CDN profile {0}: {1}'.format(profile, self.profile_errors[profile])
+                for profile in profiles if profile in self.profile_errors] + \
+               ['Error deploying service {0}: {1}'.format(service, self.deploy_errors[service])
+                for service, _ in services if service in self.deploy_errors]
+
+    def _run_create_profile(self, profile, profile_created):
+        try:
+            self._create_profile(profile)
+        except Exception as exc:
+            if self._logger:
+                self._logger.error("Error creating CDN profile {0}. Error: {1}".format(profile, str(exc)))
+            self.profile_errors[profile] = exc
+        finally:
+            profile_created.set()
+
+    def _run_deploy(self, service, profile, profile_created):
+        if profile_created is not None:
+            profile_created.wait()
+            if profile in self.profile_errors:
+                raise Exception("CDN profile {0} was not created".format(profile))
+        self._deploy(service)
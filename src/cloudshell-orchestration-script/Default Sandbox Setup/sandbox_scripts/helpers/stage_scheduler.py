@@ -0,0 +1,134 @@
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+
+class StageScheduler(object):
+    def __init__(self, logger=None):
+        """
+        Runs named setup stages, each as soon as the stages it depends on are done, so independent
+        stages run concurrently
+        :param logger: gets a line with the duration of every stage
+        """
+        self._logger = logger
+        self._stages = []
+        self._dependencies = {}
+        self.started_at = {}
+        self.finished_at = {}
+        # set as soon as a stage fails, for work outside the stages that waits for a stage to finish
+        self.failed = threading.Event()
+
+    def add(self, name, stage, depends_on=()):
+        """
+        :param str name: name the result and timing of the stage are kept under
+        :param stage: called with the results of depends_on, in that order
+        :param depends_on: names of stages added before this one
+        :return: self, so stages can be chained
+        :rtype: StageScheduler
+        """
+        if name in self._dependencies:
+            raise ValueError('Stage {0} was already added'.format(name))
+        unknown = [dependency for dependency in depends_on if dependency not in self._dependencies]
+        if unknown:
+            raise ValueError('Stage {0} depends on stages that were not added before it: {1}'
+                             .format(name, ', '.join(unknown)))
+        self._stages.append((name, stage))
+        self._dependencies[name] = tuple(depends_on)
+        return self
+
+    def run(self, max_workers=None):
+        """
+        Runs every stage, on at most max_workers threads when given. After a stage fails no further stages
+        are started, including ready ones still queued for a thread, the ones already running are waited for
+        and the first error is raised. Keep in line with cloudshell.octopus.lookup_executor.LookupExecutor.run,
+        the orchestration scripts do not depend on the cloudshell.octopus package.
+        :return: result of each stage by name
+        :rtype: dict
+        """
+        results = {}
+        if not self._stages:
+            return results
+        pending = list(self._stages)
+        running = set()
+        errors = []
+        condition = threading.Condition()
+        pool = ThreadPool(min(max_workers or len(pending), len(pending)))
+        try:
+            with condition:
+                while running or (pending and not errors):
+                    for name, stage in self._pop_ready(pending, results) if not errors else []:
+                        running.add(name)
+                        arguments = [results[dependency] for dependency in self._dependencies[name]]
+                        pool.apply_async(self._run_stage, (name, stage, arguments, results, errors, running, condition))
+                    condition.wait()
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+        return results
+
+    @property
+    def timings(self):
+        """
+        :return: seconds each finished stage took
+        :rtype: dict[str, float]
+        """
+        return {name: self.finished_at[name] - self.started_at[name] for name in self.finished_at}
+
+    def critical_path(self):
+        """
+        The chain of dependencies that ended last, i.e. the stages that made setup take as long as it did
+        :return: (stage name, seconds) pairs, first stage first
+        :rtype: list[(str, float)]
+        """
+        timings = self.timings
+        path = []
+        name = max(self.finished_at, key=self.finished_at.get) if self.finished_at else None
+        while name:
+            path.append((name, timings[name]))
+            dependencies = [dependency for dependency in self._dependencies[name] if dependency in self.finished_at]
+            name = max(dependencies, key=self.finished_at.get) if dependencies else None
+        return list(reversed(path))
+
+    def format_critical_path(self):
+        path = self.critical_path()
+        return '{0} ({1:.1f}s total)'.format(' -> '.join('{0} {1:.1f}s'.format(name, seconds)
+                                                         for name, seconds in path),
+                                             sum(seconds for _, seconds in path))
+
+    def _pop_ready(self, pending, results):
+        ready = [(name, stage) for name, stage in pending
+                 if all(dependency in results for dependency in self._dependencies[name])]
+        for entry in ready:
+            pending.remove(entry)
+        return ready
+
+    def _run_stage(self, name, stage, arguments, results, errors, running, condition):
+        with condition:
+            if errors:
+                running.discard(name)
+                condition.notify()
+                return
+        started = time.time()
+        result = error = None
+        try:
+            result = stage(*arguments)
+        except Exception:
+            error = sys.exc_info()
+        finished = time.time()
+        if self._logger:
+            self._logger.info('Setup stage {0} {1} in {2:.1f} seconds'
+                              .format(name, 'failed' if error else 'finished', finished - started))
+        with condition:
+            self.started_at[name] = started
+            self.finished_at[name] = finished
+            running.discard(name)
+            if error:
+                errors.append(error)
+                self.failed.set()
+            else:
+                results[name] = result
+            condition.notify()
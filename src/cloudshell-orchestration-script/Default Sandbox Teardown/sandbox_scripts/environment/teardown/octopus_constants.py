@@ -9,6 +9,7 @@ DELETE_LIFECYCLE = 'delete_lifecycle'
 DELETE_CHANNEL = 'delete_channel'
 REMOVE_MACHINE = 'remove_existing_machine_from_environment'
 REMOVE_ENV_FROM_LIFECYCLE = 'remove_environment_from_optional_targets_of_lifecycle'
+DEPROVISION_SANDBOX = 'deprovision_sandbox'
 
 #  JUST FOR DEMO
 DEMO_PROJECT_NAME = 'TestTest2'
@@ -69,9 +69,9 @@ class EnvironmentTeardown:
         environment_name = InputNameValue('environment_name', environment_name)
 
         try:
-            api.ExecuteCommand(res_id, octopus_service, SERVICE_TARGET_TYPE, oct.REMOVE_ENV_FROM_LIFECYCLE,
-                               [project_name, channel_name, environment_name, phase_name])
-            api.ExecuteCommand(res_id, octopus_service, SERVICE_TARGET_TYPE, oct.DELETE_ENVIRONMENT, [environment_name])
+            output = api.ExecuteCommand(res_id, octopus_service, SERVICE_TARGET_TYPE, oct.DEPROVISION_SANDBOX,
+                                        [project_name, channel_name, phase_name, environment_name]).Output
+            self.logger.info('Octopus sandbox deprovisioned: {0}'.format(output))
 
             api.WriteMessageToReservationOutput(res_id, 'Cleaned Up Deployment To Octopus')
         except:
@@ -0,0 +1,58 @@
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_MAX_WORKERS = 8
+
+# returned by an operation that found nothing to change
+SKIPPED = object()
+
+
+class BulkResult(object):
+    def __init__(self):
+        """
+        Outcome of applying one operation to many Octopus entities
+        """
+        self.succeeded = []
+        self.skipped = []
+        self.failed = {}
+
+    @property
+    def json(self):
+        return {
+            'Succeeded': self.succeeded,
+            'Skipped': self.skipped,
+            'Failed': self.failed
+        }
+
+    def __str__(self):
+        return '{0} succeeded, {1} skipped, {2} failed{3}'.format(
+            len(self.succeeded), len(self.skipped), len(self.failed),
+            ''.join('\n{0}: {1}'.format(entity_id, error) for entity_id, error in sorted(self.failed.items())))
+
+
+def run_bulk(operation, entity_ids, max_workers=DEFAULT_MAX_WORKERS):
+    """
+    Applies operation to every id on at most max_workers threads and collects per id outcomes,
+    one failing id does not stop the others. Ids the operation returns SKIPPED for are reported as skipped.
+    :type operation: (str) -> object
+    :type entity_ids: list[str]
+    :type max_workers: int
+    :rtype: BulkResult
+    """
+    bulk_result = BulkResult()
+    if not entity_ids:
+        return bulk_result
+    pool = ThreadPool(min(max_workers, len(entity_ids)))
+    try:
+        async_results = [(entity_id, pool.apply_async(operation, (entity_id,))) for entity_id in entity_ids]
+        for entity_id, async_result in async_results:
+            try:
+                if async_result.get() is SKIPPED:
+                    bulk_result.skipped.append(entity_id)
+                else:
+                    bulk_result.succeeded.append(entity_id)
+            except Exception as e:
+                bulk_result.failed[entity_id] = str(e)
+    finally:
+        pool.close()
+        pool.join()
+    return bulk_result
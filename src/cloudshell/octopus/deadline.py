@@ -0,0 +1,75 @@
+import threading
+import time
+from contextlib import contextmanager
+
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 60
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+class Deadline(object):
+    def __init__(self, seconds, name='Octopus command'):
+        """
+        Time budget of a whole composite command, consumed by every Octopus call and poll loop it makes
+        :param seconds: the budget
+        :param name: what the budget belongs to, used in the timeout error
+        :type seconds: float
+        :type name: str
+        """
+        self.seconds = seconds
+        self.name = name
+        self._expires_at = time.time() + seconds
+        self._local = threading.local()
+
+    @property
+    def current_step(self):
+        return getattr(self._local, 'step', None)
+
+    @contextmanager
+    def step(self, name):
+        """
+        Names the part of the command running in this thread, so a timeout reports where the time ran out
+        """
+        previous_step = self.current_step
+        self._local.step = name
+        try:
+            yield self
+        finally:
+            self._local.step = previous_step
+
+    def remaining(self):
+        return max(0, self._expires_at - time.time())
+
+    def expired(self):
+        return self.remaining() <= 0
+
+    def check(self, detail=None):
+        """
+        :param detail: what was about to be done, e.g. the http call
+        :raises DeadlineExceeded: if the budget is spent
+        :return: remaining seconds
+        :rtype: float
+        """
+        remaining = self.remaining()
+        if remaining <= 0:
+            raise DeadlineExceeded(self._describe_timeout(detail))
+        return remaining
+
+    def timeouts(self, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT, detail=None):
+        """
+        :return: (connect, read) timeouts for a single http call, shortened to fit the remaining budget
+        :rtype: (float, float)
+        """
+        remaining = self.check(detail)
+        return min(connect_timeout, remaining), min(read_timeout, remaining)
+
+    def _describe_timeout(self, detail):
+        message = '{0} ran out of its {1} seconds budget'.format(self.name, self.seconds)
+        if self.current_step:
+            message += ' during step "{0}"'.format(self.current_step)
+        if detail:
+            message += ' ({0})'.format(detail)
+        return message
@@ -0,0 +1,195 @@
+import threading
+import time
+
+from cloudshell.octopus.poll_schedule import PollSchedule
+
+_watchers = {}
+_watchers_lock = threading.Lock()
+
+
+def get_deployment_watcher(octopus_server):
+    """
+    Returns the watcher shared by everything in this process waiting on tasks of octopus_server's host with the
+    same API key, so concurrent deployments are refreshed together. The watcher outlives the command asking for it,
+    it polls without the command's deadline and callers bound their own waits.
+    :type octopus_server: cloudshell.octopus.session.OctopusServer
+    :rtype: DeploymentWatcher
+    """
+    key = (octopus_server.host_key, octopus_server.rest_params['ApiKey'])
+    with _watchers_lock:
+        watcher = _watchers.get(key)
+        if watcher is None:
+            watcher = _watchers[key] = DeploymentWatcher(octopus_server.without_deadline())
+        return watcher
+
+
+class TaskFuture(object):
+    def __init__(self, task_id, poll_schedule):
+        """
+        Completion of an Octopus server task tracked by a DeploymentWatcher
+        :type task_id: str
+        :param poll_schedule: delays between the refreshes of this task
+        :type poll_schedule: cloudshell.octopus.poll_schedule.PollSchedule
+        """
+        self.task_id = task_id
+        self.poll_schedule = poll_schedule
+        # the first refresh is due right away
+        self.polls = 0
+        self.next_poll_at = time.time()
+        # why the watcher could not refresh the task lately, if it could not
+        self.last_error = None
+        self._task = None
+        self._error = None
+        self._callbacks = []
+        self._completed = threading.Event()
+        self._lock = threading.Lock()
+
+    def done(self):
+        return self._completed.is_set()
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: seconds to wait, forever when None
+        :return: whether the task completed
+        :rtype: bool
+        """
+        return self._completed.wait(timeout)
+
+    def result(self, timeout=None):
+        """
+        :param timeout: seconds to wait, forever when None
+        :return: the completed task resource
+        :rtype: dict
+        """
+        if not self.wait(timeout):
+            message = 'Timeout after {0} seconds waiting for task {1}'.format(timeout, self.task_id)
+            if self.last_error is not None:
+                message += ', last error refreshing it: {0}'.format(self.last_error)
+            raise Exception(message)
+        if self._error is not None:
+            raise self._error
+        return self._task
+
+    def add_done_callback(self, callback):
+        """
+        :param callback: called with this future once the task completes, right away if it already did
+        :type callback: (TaskFuture) -> None
+        """
+        with self._lock:
+            if not self.done():
+                self._callbacks.append(callback)
+                return
+        callback(self)
+
+    def _complete(self, task=None, error=None):
+        with self._lock:
+            self._task = task
+            self._error = error
+            self._completed.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class DeploymentWatcher(object):
+    def __init__(self, octopus_server, poll_schedule=None):
+        """
+        Tracks any number of in-flight Octopus tasks, each refreshed with the backoff of its own poll schedule.
+        The tasks due at the same tick are refreshed with one bulk request, instead of every waiter polling its
+        own task, and the watcher sleeps until the earliest next poll.
+        :type octopus_server: cloudshell.octopus.session.OctopusServer
+        :param poll_schedule: of the tasks watched without one, defaults to PollSchedule()
+        :type poll_schedule: cloudshell.octopus.poll_schedule.PollSchedule
+        """
+        self._octopus_server = octopus_server
+        self._poll_schedule = poll_schedule or PollSchedule()
+        self._futures = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.ticks = 0
+        self.last_error = None
+
+    def watch(self, task_id, callback=None, poll_schedule=None):
+        """
+        Starts tracking task_id; watching a task that is already tracked returns the same future, which keeps
+        the poll schedule it was first watched with
+        :type task_id: str
+        :param callback: optional, called with the future once the task completes
+        :param poll_schedule: delays between the refreshes of the task, the watcher's default when None
+        :type poll_schedule: cloudshell.octopus.poll_schedule.PollSchedule
+        :rtype: TaskFuture
+        """
+        with self._lock:
+            future = self._futures.get(task_id)
+            if future is None:
+                future = self._futures[task_id] = TaskFuture(task_id, poll_schedule or self._poll_schedule)
+                self._wakeup.set()
+            if self._thread is None:
+                self._thread = self._start_thread()
+        if callback:
+            future.add_done_callback(callback)
+        return future
+
+    def tick(self):
+        """
+        Refreshes every tracked task that is due with a single bulk request and completes the futures of
+        finished tasks
+        """
+        now = time.time()
+        with self._lock:
+            task_ids = [task_id for task_id, future in self._futures.iteritems() if future.next_poll_at <= now]
+        if not task_ids:
+            return
+        self.ticks += 1
+        try:
+            tasks = {task['Id']: task for task in self._octopus_server.get_tasks(task_ids)}
+        except Exception as e:
+            self._polled(task_ids, e)
+            raise
+        for task_id in task_ids:
+            task = tasks.get(task_id)
+            if task is None:
+                self._complete(task_id, error=Exception('Task {0} was not found on Octopus Deploy'.format(task_id)))
+            elif task['IsCompleted']:
+                self._complete(task_id, task=task)
+        self._polled(task_ids, None)
+
+    def _polled(self, task_ids, error):
+        # schedules the next refresh of the tasks still tracked, the waiters bound their own waits
+        with self._lock:
+            for task_id in task_ids:
+                future = self._futures.get(task_id)
+                if future is not None:
+                    future.last_error = error
+                    future.next_poll_at = time.time() + future.poll_schedule.next_delay(future.polls, float('inf'))
+                    future.polls += 1
+
+    def _complete(self, task_id, task=None, error=None):
+        with self._lock:
+            future = self._futures.pop(task_id)
+        future._complete(task, error)
+
+    def _start_thread(self):
+        thread = threading.Thread(target=self._run, name='octopus-deployment-watcher')
+        thread.daemon = True
+        thread.start()
+        return thread
+
+    def _run(self):
+        while True:
+            try:
+                self.tick()
+                self.last_error = None
+            except Exception as e:
+                # transient failures are retried on the next tick, waiters bound their own wait and get the error
+                # through their future when it times out
+                self.last_error = e
+            with self._lock:
+                if not self._futures:
+                    self._thread = None
+                    return
+                delay = max(0, min(future.next_poll_at for future in self._futures.itervalues()) - time.time())
+                # a task watched meanwhile may be due before then
+                self._wakeup.clear()
+            self._wakeup.wait(delay)
@@ -0,0 +1,73 @@
+import json
+
+_WHITESPACE = ' \t\n\r'
+
+_decoder = json.JSONDecoder()
+
+
+def iter_json_array(chunks):
+    """
+    Yields the elements of a top level json array as soon as each one has been read, so a consumer
+    that stops early never reads (or holds) the rest of the array
+    :param chunks: the json document in pieces, e.g. response.iter_content()
+    :type chunks: collections.Iterable[str]
+    :rtype: collections.Iterable[object]
+    """
+    reader = _ChunkReader(chunks)
+    if reader.next_token() != '[':
+        raise ValueError('Expected a json array')
+    reader.position += 1
+    if reader.next_token() == ']':
+        return
+    while True:
+        yield reader.read_value()
+        delimiter = reader.next_token()
+        reader.position += 1
+        if delimiter == ']':
+            return
+        if delimiter != ',':
+            raise ValueError('Expected , or ] after array element, got {0!r}'.format(delimiter))
+
+
+class _ChunkReader(object):
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._exhausted = False
+        self.buffer = ''
+        self.position = 0
+
+    def next_token(self):
+        """
+        :return: the next non whitespace character, without consuming it
+        """
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position] in _WHITESPACE:
+                self.position += 1
+            if self.position < len(self.buffer):
+                return self.buffer[self.position]
+            if not self._read_chunk():
+                raise ValueError('Unexpected end of json array')
+
+    def read_value(self):
+        self.next_token()
+        while True:
+            try:
+                value, end = _decoder.raw_decode(self.buffer, self.position)
+                # a number or literal cut at the end of the buffer may continue in the next chunk
+                if end < len(self.buffer) or self._exhausted:
+                    self.position = end
+                    return value
+            except ValueError:
+                if self._exhausted:
+                    raise
+            self._read_chunk()
+
+    def _read_chunk(self):
+        for chunk in self._chunks:
+            if chunk:
+                # drop what was consumed, only the element being read is kept
+                self.buffer = self.buffer[self.position:] + chunk
+                self.position = 0
+                return True
+        self._exhausted = True
+        return False
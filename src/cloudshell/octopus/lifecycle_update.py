@@ -0,0 +1,187 @@
+import sys
+import threading
+import time
+
+ADD = 'add'
+REMOVE = 'remove'
+
+# seconds a batch keeps collecting operations before it is written, every write costs a GET, a PUT and a GET to
+# verify it, so waiting a little lets environments created together share one. 0 only merges what queues up
+# while the previous write of the same lifecycle is in flight.
+DEFAULT_COALESCE_WINDOW = 0.05
+
+_lifecycle_update_queues = {}
+_lifecycle_update_queues_lock = threading.Lock()
+
+
+def get_lifecycle_update_queue(host_key, api_key, coalesce_window=DEFAULT_COALESCE_WINDOW):
+    """
+    Returns the lifecycle update queue shared by every OctopusServer talking to the same host with the same API key
+    in this process, operations are only merged into a write made with the key they were submitted with
+    :type host_key: str
+    :type api_key: str
+    :type coalesce_window: float
+    :rtype: LifecycleUpdateQueue
+    """
+    key = (host_key, api_key)
+    with _lifecycle_update_queues_lock:
+        if key not in _lifecycle_update_queues:
+            _lifecycle_update_queues[key] = LifecycleUpdateQueue(coalesce_window)
+        return _lifecycle_update_queues[key]
+
+
+class LifecycleOperation(object):
+    def __init__(self, action, environment_id, phase_name):
+        """
+        Adds an environment to, or removes it from, the optional deployment targets of a lifecycle phase.
+        Operations are idempotent so a batch can be applied again after a conflict.
+        :param action: ADD or REMOVE
+        :type action: str
+        :type environment_id: str
+        :type phase_name: str
+        """
+        if action not in (ADD, REMOVE):
+            raise ValueError('Unknown lifecycle operation {0}'.format(action))
+        self.action = action
+        self.environment_id = environment_id
+        self.phase_name = phase_name
+
+    def apply(self, lifecycle, strict=False):
+        """
+        :param lifecycle: lifecycle document, changed in place
+        :type lifecycle: dict
+        :param strict: fail removing an environment that is not on the phase, instead of leaving the document
+        as it is. Retries of a write are not strict, the operation may already have been applied.
+        :type strict: bool
+        :return: whether the document changed
+        :rtype: bool
+        """
+        targets = self._get_phase(lifecycle)['OptionalDeploymentTargets']
+        if self.is_applied(lifecycle):
+            if strict and self.action == REMOVE:
+                raise Exception('Failed to remove environment {0} from lifecycle {1} because it is not a target '
+                                'of phase {2}'.format(self.environment_id, lifecycle['Id'], self.phase_name))
+            return False
+        if self.action == ADD:
+            targets.append(self.environment_id)
+        else:
+            targets.remove(self.environment_id)
+        return True
+
+    def is_applied(self, lifecycle):
+        targets = self._get_phase(lifecycle)['OptionalDeploymentTargets']
+        return (self.environment_id in targets) == (self.action == ADD)
+
+    def _get_phase(self, lifecycle):
+        for phase in lifecycle['Phases']:
+            if phase['Name'] == self.phase_name:
+                return phase
+        raise Exception('Could not {0} environment {1} {2} lifecycle {3} because did not find phase {4}'.format(
+            self.action, self.environment_id, 'to' if self.action == ADD else 'from', lifecycle['Id'],
+            self.phase_name))
+
+    def __repr__(self):
+        return '{0} {1} on phase {2}'.format(self.action, self.environment_id, self.phase_name)
+
+
+class _Submission(object):
+    def __init__(self, operations):
+        self.operations = operations
+        self.result = None
+        self.error = None
+
+
+class _Batch(object):
+    def __init__(self):
+        self.submissions = []
+        self.done = threading.Event()
+
+
+class LifecycleUpdateQueue(object):
+    def __init__(self, coalesce_window=DEFAULT_COALESCE_WINDOW):
+        """
+        Merges lifecycle updates submitted concurrently for the same lifecycle into a single write.
+        The first submitter of a batch starts a thread that writes it once the previous write of that lifecycle
+        finished, everyone submitting in the meantime joins the batch. Each submitter waits for the batch under
+        its own deadline, the write goes on for the others when one of them gives up.
+        :param coalesce_window: see DEFAULT_COALESCE_WINDOW
+        :type coalesce_window: float
+        """
+        self._coalesce_window = coalesce_window
+        self._lock = threading.Lock()
+        self._open_batches = {}
+        self._write_locks = {}
+        # batches open or being written per lifecycle, its write lock is dropped when the last one finished
+        self._batch_counts = {}
+        self.batches_written = 0
+
+    def submit(self, lifecycle_id, operations, write, deadline=None):
+        """
+        :type lifecycle_id: str
+        :type operations: list[LifecycleOperation]
+        :param write: applies a list of operations to the lifecycle, e.g. OctopusServer.update_lifecycle, it
+        should not be bound to the deadline of any single submitter
+        :type write: (str, list[LifecycleOperation]) -> dict
+        :param deadline: bounds the wait for the batch, forever when None
+        :type deadline: cloudshell.octopus.deadline.Deadline
+        :return: what write returned for the batch the operations were written in
+        :rtype: dict
+        """
+        submission = _Submission(operations)
+        with self._lock:
+            batch = self._open_batches.get(lifecycle_id)
+            is_writer = batch is None
+            if is_writer:
+                batch = self._open_batches[lifecycle_id] = _Batch()
+                self._batch_counts[lifecycle_id] = self._batch_counts.get(lifecycle_id, 0) + 1
+            batch.submissions.append(submission)
+            write_lock = self._write_locks.setdefault(lifecycle_id, threading.Lock())
+
+        if is_writer:
+            writer = threading.Thread(target=self._write_when_free, args=(lifecycle_id, batch, write, write_lock))
+            writer.daemon = True
+            writer.start()
+        while not batch.done.wait(deadline.check('waiting for lifecycle {0} update'.format(lifecycle_id))
+                                  if deadline else None):
+            pass
+
+        if submission.error:
+            error_type, error, traceback = submission.error
+            raise error_type, error, traceback
+        return submission.result
+
+    def _write_when_free(self, lifecycle_id, batch, write, write_lock):
+        try:
+            if self._coalesce_window:
+                time.sleep(self._coalesce_window)
+            with write_lock:
+                with self._lock:
+                    # later submitters start the next batch
+                    del self._open_batches[lifecycle_id]
+                self._write_batch(lifecycle_id, batch, write)
+        finally:
+            with self._lock:
+                self._batch_counts[lifecycle_id] -= 1
+                if not self._batch_counts[lifecycle_id]:
+                    del self._batch_counts[lifecycle_id]
+                    del self._write_locks[lifecycle_id]
+            batch.done.set()
+
+    def _write_batch(self, lifecycle_id, batch, write):
+        operations = [operation for submission in batch.submissions for operation in submission.operations]
+        try:
+            result = write(lifecycle_id, operations)
+            for submission in batch.submissions:
+                submission.result = result
+        except Exception:
+            if len(batch.submissions) == 1:
+                batch.submissions[0].error = sys.exc_info()
+            else:
+                # one bad operation must not fail everyone merged with it, write each submission on its own
+                for submission in batch.submissions:
+                    try:
+                        submission.result = write(lifecycle_id, submission.operations)
+                    except Exception:
+                        submission.error = sys.exc_info()
+        with self._lock:
+            self.batches_written += 1
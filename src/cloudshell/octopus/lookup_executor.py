@@ -0,0 +1,106 @@
+import sys
+import threading
+import time
+from multiprocessing.pool import ThreadPool
+
+DEFAULT_MAX_WORKERS = 4
+
+
+class LookupExecutor(object):
+    def __init__(self, deadline=None):
+        """
+        Runs named Octopus lookups, each as soon as the lookups it depends on are done, so independent
+        lookups overlap and the total latency approaches the longest dependency chain
+        :param deadline: every lookup runs as a 'find <name>' step of it, so a timeout names the lookup
+        :type deadline: cloudshell.octopus.deadline.Deadline
+        """
+        self._deadline = deadline
+        self._lookups = []
+        self._dependencies = {}
+        self.timings = {}
+
+    def add(self, name, lookup, *depends_on):
+        """
+        :param name: name the result and timing are returned under
+        :param lookup: called with the results of depends_on, in that order
+        :param depends_on: names of lookups added before this one
+        :type name: str
+        :type lookup: (...) -> object
+        :return: self, so lookups can be chained
+        :rtype: LookupExecutor
+        """
+        if name in self._dependencies:
+            raise ValueError('Lookup {0} was already added'.format(name))
+        unknown = [dependency for dependency in depends_on if dependency not in self._dependencies]
+        if unknown:
+            raise ValueError('Lookup {0} depends on lookups that were not added before it: {1}'
+                             .format(name, ', '.join(unknown)))
+        self._lookups.append((name, lookup))
+        self._dependencies[name] = depends_on
+        return self
+
+    def run(self, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Runs every lookup on at most max_workers threads. After a lookup fails no further lookups are started,
+        including ready ones still queued for a thread, the ones already running are waited for and the first
+        error is raised. Same as the StageScheduler of the setup script, which can not import this package.
+        :type max_workers: int
+        :return: result of each lookup by name
+        :rtype: dict
+        """
+        results = {}
+        if not self._lookups:
+            return results
+        pending = list(self._lookups)
+        running = set()
+        errors = []
+        condition = threading.Condition()
+        pool = ThreadPool(min(max_workers, len(pending)))
+        try:
+            with condition:
+                while running or (pending and not errors):
+                    for name, lookup in self._pop_ready(pending, results) if not errors else []:
+                        running.add(name)
+                        arguments = [results[dependency] for dependency in self._dependencies[name]]
+                        pool.apply_async(self._run_lookup,
+                                         (name, lookup, arguments, results, errors, running, condition))
+                    condition.wait()
+        finally:
+            pool.close()
+            pool.join()
+        if errors:
+            error_type, error, traceback = errors[0]
+            raise error_type, error, traceback
+        return results
+
+    def _pop_ready(self, pending, results):
+        ready = [(name, lookup) for name, lookup in pending
+                 if all(dependency in results for dependency in self._dependencies[name])]
+        for entry in ready:
+            pending.remove(entry)
+        return ready
+
+    def _run_lookup(self, name, lookup, arguments, results, errors, running, condition):
+        with condition:
+            if errors:
+                running.discard(name)
+                condition.notify()
+                return
+        started = time.time()
+        result = error = None
+        try:
+            if self._deadline:
+                with self._deadline.step('find {0}'.format(name)):
+                    result = lookup(*arguments)
+            else:
+                result = lookup(*arguments)
+        except Exception:
+            error = sys.exc_info()
+        with condition:
+            self.timings[name] = round(time.time() - started, 3)
+            running.discard(name)
+            if error:
+                errors.append(error)
+            else:
+                results[name] = result
+            condition.notify()
@@ -0,0 +1,83 @@
+import copy
+import threading
+import time
+
+DEFAULT_TTL = 60
+
+_name_indexes = {}
+_name_indexes_lock = threading.Lock()
+
+
+def get_name_index(host_key, ttl=DEFAULT_TTL):
+    """
+    Returns the name index shared by every OctopusServer talking to the same host in this process
+    :type host_key: str
+    :type ttl: int
+    :rtype: NameIndex
+    """
+    with _name_indexes_lock:
+        if host_key not in _name_indexes:
+            _name_indexes[host_key] = NameIndex(ttl)
+        return _name_indexes[host_key]
+
+
+class NameIndex(object):
+    def __init__(self, ttl=DEFAULT_TTL):
+        """
+        In-process name -> entity index of Octopus collections (projects, environments, machines, lifecycles).
+        Entities are loaded one by one as they are looked up, and then answer lookups locally until their ttl
+        expires or their collection is invalidated. Names that are not in the index are always loaded again,
+        so entities created elsewhere are found right away.
+        :param ttl: seconds a loaded entity is trusted
+        :type ttl: int
+        """
+        self._ttl = ttl
+        self._entities = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def find_entity(self, collection, name, load_entity):
+        """
+        :param collection: collection name, e.g. 'environments'
+        :param name: entity name to look up
+        :param load_entity: called on a miss, returns the entity or None if it does not exist
+        :type collection: str
+        :type name: str
+        :type load_entity: () -> dict
+        :return: a copy of the entity, or None if no entity with that name exists
+        :rtype: dict
+        """
+        with self._lock:
+            entity = self._find_loaded_entity(collection, name)
+            if entity is not None:
+                self.hits += 1
+                return copy.deepcopy(entity)
+            self.misses += 1
+
+        entity = load_entity()
+        if entity is None:
+            return None
+        with self._lock:
+            self._entities[(collection, name)] = (time.time(), entity)
+        return copy.deepcopy(entity)
+
+    def invalidate(self, *collections):
+        """
+        Drops the given collections from the index, or all of them when called without arguments
+        """
+        with self._lock:
+            if not collections:
+                self._entities.clear()
+            for collection in collections:
+                for key in [key for key in self._entities if key[0] == collection]:
+                    del self._entities[key]
+
+    def _find_loaded_entity(self, collection, name):
+        if (collection, name) not in self._entities:
+            return None
+        loaded_at, entity = self._entities[(collection, name)]
+        if time.time() - loaded_at > self._ttl:
+            del self._entities[(collection, name)]
+            return None
+        return entity
@@ -0,0 +1,44 @@
+import random
+
+DEFAULT_INITIAL_INTERVAL = 2
+DEFAULT_MAX_INTERVAL = 60
+DEFAULT_BACKOFF_FACTOR = 2
+DEFAULT_JITTER = 0.2
+DEFAULT_TIMEOUT = 1800
+
+
+class PollSchedule(object):
+    def __init__(self, initial_interval=DEFAULT_INITIAL_INTERVAL, max_interval=DEFAULT_MAX_INTERVAL,
+                 backoff_factor=DEFAULT_BACKOFF_FACTOR, jitter=DEFAULT_JITTER, timeout=DEFAULT_TIMEOUT):
+        """
+        Delays between polls of a long running Octopus task: quick first polls, exponential backoff up to
+        max_interval, all bounded by an overall timeout
+        :param initial_interval: seconds before the second poll
+        :param max_interval: cap on seconds between two polls
+        :param backoff_factor: growth of the interval after each poll
+        :param jitter: fraction by which each delay is randomly stretched or shrunk
+        :param timeout: overall seconds budget for the wait
+        :type initial_interval: float
+        :type max_interval: float
+        :type backoff_factor: float
+        :type jitter: float
+        :type timeout: float
+        """
+        self.initial_interval = initial_interval
+        self.max_interval = max_interval
+        self.backoff_factor = backoff_factor
+        self.jitter = jitter
+        self.timeout = timeout
+
+    def next_delay(self, poll_number, remaining):
+        """
+        :param poll_number: number of polls already made, starting from 0
+        :param remaining: seconds left of the overall timeout
+        :type poll_number: int
+        :type remaining: float
+        :rtype: float
+        """
+        delay = min(self.initial_interval * self.backoff_factor ** poll_number, self.max_interval)
+        delay *= random.uniform(1 - self.jitter, 1 + self.jitter)
+        return max(0, min(delay, remaining))
+
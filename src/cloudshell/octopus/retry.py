@@ -0,0 +1,134 @@
+import random
+import threading
+import time
+from email.utils import parsedate_tz, mktime_tz
+
+IDEMPOTENT_METHODS = frozenset(['GET', 'HEAD', 'OPTIONS', 'PUT', 'DELETE'])
+TOO_MANY_REQUESTS = 429
+
+DEFAULT_FAILURE_THRESHOLD = 5
+DEFAULT_RESET_TIMEOUT = 30
+
+_circuit_breakers = {}
+_circuit_breakers_lock = threading.Lock()
+
+
+def get_circuit_breaker(host_key):
+    """
+    Returns the circuit breaker shared by every OctopusServer talking to the same host in this process
+    :type host_key: str
+    :rtype: CircuitBreaker
+    """
+    with _circuit_breakers_lock:
+        if host_key not in _circuit_breakers:
+            _circuit_breakers[host_key] = CircuitBreaker(host_key)
+        return _circuit_breakers[host_key]
+
+
+class CircuitOpenError(Exception):
+    pass
+
+
+class RetryPolicy(object):
+    def __init__(self, max_attempts=4, base_delay=0.5, max_delay=10, jitter=0.5, max_retry_after=60):
+        """
+        Which failed Octopus calls are retried and how long to wait before each retry.
+        Only idempotent methods are retried, on 429, 5xx and connection errors.
+        :param max_attempts: attempts per call including the first one
+        :param base_delay: seconds before the first retry, doubled for each further retry
+        :param max_delay: cap on the computed backoff
+        :param jitter: fraction of each delay that is randomized
+        :param max_retry_after: cap on a server supplied Retry-After
+        """
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.max_retry_after = max_retry_after
+
+    def should_retry(self, method, attempt, status_code=None):
+        """
+        :param attempt: number of attempts already made
+        :param status_code: None when the call failed with a connection error
+        :rtype: bool
+        """
+        if attempt >= self.max_attempts or method.upper() not in IDEMPOTENT_METHODS:
+            return False
+        return status_code is None or status_code == TOO_MANY_REQUESTS or status_code // 100 == 5
+
+    def delay(self, attempt, retry_after=None):
+        """
+        :param attempt: number of attempts already made, starting from 1
+        :param retry_after: value of the Retry-After response header, if any
+        :rtype: float
+        """
+        delay = min(self.base_delay * 2 ** (attempt - 1), self.max_delay)
+        delay = delay * (1 - self.jitter) + random.uniform(0, delay * self.jitter)
+        retry_after_seconds = _parse_retry_after(retry_after)
+        if retry_after_seconds is not None:
+            delay = max(delay, min(retry_after_seconds, self.max_retry_after))
+        return delay
+
+
+class CircuitBreaker(object):
+    def __init__(self, name, failure_threshold=DEFAULT_FAILURE_THRESHOLD, reset_timeout=DEFAULT_RESET_TIMEOUT):
+        """
+        Fails calls fast while a host looks down: opens after failure_threshold consecutive server or
+        connection failures, then lets a single trial call through once reset_timeout seconds passed
+        :type name: str
+        :type failure_threshold: int
+        :type reset_timeout: float
+        """
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self._failures = 0
+        self._opened_at = None
+        self._trial_in_flight = False
+        self._lock = threading.Lock()
+
+    @property
+    def is_open(self):
+        return self._opened_at is not None
+
+    def before_request(self):
+        """
+        :raises CircuitOpenError: if calls to the host should not be attempted right now
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.time() - self._opened_at < self.reset_timeout or self._trial_in_flight:
+                raise CircuitOpenError('{0} is unavailable after {1} consecutive failures, not retrying for {2} '
+                                       'seconds'.format(self.name, self._failures, self.reset_timeout))
+            self._trial_in_flight = True
+
+    def record_success(self):
+        with self._lock:
+            self._failures = 0
+            self._opened_at = None
+            self._trial_in_flight = False
+
+    def release_trial(self):
+        """
+        Called when a call ended without telling whether the host is healthy, so the next call can be the trial
+        """
+        with self._lock:
+            self._trial_in_flight = False
+
+    def record_failure(self):
+        with self._lock:
+            self._failures += 1
+            self._trial_in_flight = False
+            if self._failures >= self.failure_threshold:
+                self._opened_at = time.time()
+
+
+def _parse_retry_after(retry_after):
+    if not retry_after:
+        return None
+    try:
+        return max(0, float(retry_after))
+    except ValueError:
+        parsed_date = parsedate_tz(retry_after)
+        return max(0, mktime_tz(parsed_date) - time.time()) if parsed_date else None
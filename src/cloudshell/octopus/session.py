@@ -1,29 +1,147 @@
 from cloudshell.octopus.environment_spec import EnvironmentSpec
+from cloudshell.octopus.bulk_operation import run_bulk, DEFAULT_MAX_WORKERS, SKIPPED
+from cloudshell.octopus.name_index import get_name_index
+from cloudshell.octopus.json_stream import iter_json_array
+from cloudshell.octopus.lifecycle_update import LifecycleOperation, get_lifecycle_update_queue, ADD, REMOVE
+from cloudshell.octopus.poll_schedule import PollSchedule
+from cloudshell.octopus.retry import RetryPolicy, get_circuit_breaker
+from cloudshell.octopus.deadline import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
 import requests
+from requests.adapters import HTTPAdapter
 import json
-from urlparse import urljoin
-import urllib
+from urlparse import urljoin, urlparse
+import urllib2
+import socket
 import time
+import threading
 
 import ssl
 import copy
 
 VALIDATE_TENTACLE_CONTEXT = ssl._create_unverified_context()
 
+DEFAULT_POOL_SIZE = 10
+# bytes read from the socket at a time when streaming /all listings
+STREAM_CHUNK_SIZE = 64 * 1024
+# ids per ?ids= request, keeps the url well under common length limits
+IDS_PER_REQUEST = 100
+# read-modify-write rounds of a lifecycle update before giving up on concurrent writers
+LIFECYCLE_UPDATE_ATTEMPTS = 5
+CONFLICT_STATUS_CODES = (409, 412)
+VALIDATED_HOST_TTL = 300
+
+_http_sessions = {}
+_http_sessions_lock = threading.Lock()
+
+_validated_hosts = {}
+_validated_hosts_lock = threading.Lock()
+
+# host key -> collections whose listing ignores ?partialName=, looked up through /all instead
+_unfiltered_collections = {}
+_unfiltered_collections_lock = threading.Lock()
+
+
+class NameFilterNotSupported(Exception):
+    pass
+
+
+def get_http_session(host, pool_size=DEFAULT_POOL_SIZE):
+    """
+    Returns the keep-alive session shared by every OctopusServer talking to host in this process,
+    so that sequential commands and thread pool workers reuse open connections instead of paying
+    a TCP/TLS handshake per call. The pool only ever grows to the largest pool_size requested.
+    :type host: str
+    :type pool_size: int
+    :rtype: requests.Session
+    """
+    host_key = _get_host_key(host)
+    with _http_sessions_lock:
+        session, current_pool_size = _http_sessions.get(host_key, (None, 0))
+        if session is None:
+            session = requests.Session()
+        if pool_size > current_pool_size:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size)
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            current_pool_size = pool_size
+        _http_sessions[host_key] = (session, current_pool_size)
+    return session
+
+
+def _is_host_validated(host_key):
+    with _validated_hosts_lock:
+        validated_at = _validated_hosts.get(host_key)
+        return validated_at is not None and time.time() - validated_at < VALIDATED_HOST_TTL
+
+
+def _set_host_validated(host_key, validated):
+    with _validated_hosts_lock:
+        if validated:
+            _validated_hosts[host_key] = time.time()
+        else:
+            _validated_hosts.pop(host_key, None)
+
+
+def _get_host_key(host):
+    parsed_host = urlparse(host)
+    return '{0}://{1}'.format(parsed_host.scheme, parsed_host.netloc).lower()
+
 
 class OctopusServer:
-    def __init__(self, host, api_key):
+    def __init__(self, host, api_key, pool_size=DEFAULT_POOL_SIZE, retry_policy=None, deadline=None,
+                 lazy_validation=False, renew_api_key=None):
         """
         :param host:
         :param api_key:
+        :param pool_size: max keep-alive connections kept open to host, shared across instances
+        :param retry_policy: which failed calls are retried and how, defaults to RetryPolicy()
+        :param deadline: time budget every call and poll loop of this instance consumes from, calls only get
+        the default connect/read timeouts when None
+        :param lazy_validation: check that host is reachable on the first call instead of here; either way the
+        check is skipped while another instance validated host less than VALIDATED_HOST_TTL seconds ago
+        :type pool_size: int
+        :type retry_policy: cloudshell.octopus.retry.RetryPolicy
+        :type deadline: cloudshell.octopus.deadline.Deadline
+        :param renew_api_key: called once when the server rejects api_key with 401, e.g. after it was rotated,
+        returns the API key the rejected call is repeated with
+        :type lazy_validation: bool
+        :type renew_api_key: () -> str
         :return:
         """
+        self.deadline = deadline
         self._host = host
-        self._validate_host()
+        self._http_session = get_http_session(host, pool_size)
+        self._host_key = _get_host_key(host)
+        self._name_index = get_name_index(self._host_key)
+        self._lifecycle_updates = get_lifecycle_update_queue(self._host_key, api_key)
+        self._retry_policy = retry_policy or RetryPolicy()
+        self._circuit_breaker = get_circuit_breaker(self._host_key)
         self.rest_params = {'ApiKey': api_key}
+        self._renew_api_key = renew_api_key
+        self._api_key_renewed = False
+        self._api_key_lock = threading.Lock()
+        self._host_validated = False
+        if not lazy_validation:
+            self._ensure_host_validated()
+
+    def _ensure_host_validated(self):
+        # set first, the validation call itself goes through _request
+        self._host_validated = True
+        if _is_host_validated(self._host_key):
+            return
+        try:
+            self._validate_host()
+        except Exception:
+            self._host_validated = False
+            raise
+        _set_host_validated(self._host_key, True)
 
     def _validate_host(self):
-        result = requests.get(self.host)
+        try:
+            result = self._request('GET', self.host, params=None)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            raise Exception('Could not reach {0}\nPlease check if server is accessible\nError: {1}'
+                            .format(self._host, e))
         self._valid_status_code(result, 'Could not reach {0}\nPlease check if server is accessible'
                                 .format(self._host))
 
@@ -31,6 +149,29 @@ class OctopusServer:
     def host(self):
         return self._host
 
+    @property
+    def host_key(self):
+        """
+        scheme://netloc of host, identifies the server for state shared across instances
+        """
+        return self._host_key
+
+    def without_deadline(self):
+        """
+        Same host and API key without a time budget, for work that outlives the command that created this instance
+        :rtype: OctopusServer
+        """
+        octopus_server = copy.copy(self)
+        octopus_server.deadline = None
+        return octopus_server
+
+    @property
+    def name_index(self):
+        """
+        :rtype: cloudshell.octopus.name_index.NameIndex
+        """
+        return self._name_index
+
     def create_environment(self, environment_spec):
         """
         :type environment_spec: cloudshell.octopus.environment_spec.EnvironmentSpec
@@ -38,11 +179,24 @@ class OctopusServer:
         """
         env = copy.deepcopy(environment_spec)
         api_url = urljoin(self.host, '/api/environments')
-        result = requests.post(api_url, params=self.rest_params, json=env.json)
+        result = self._request('POST', api_url, json=env.json)
         self._valid_status_code(result, 'Failed to deploy environment; error: {0}'.format(result.text))
+        self._name_index.invalidate('environments')
         env.set_id(json.loads(result.content)['Id'])
         return env
 
+    def ensure_environment(self, environment_spec):
+        """
+        Creates the environment unless an environment with the same name already exists
+        :type environment_spec: cloudshell.octopus.environment_spec.EnvironmentSpec
+        :return: id of the environment and whether it was created
+        :rtype: (str, bool)
+        """
+        environment = self._find_by_name('environments', 'environment', environment_spec.name)
+        if environment is not None:
+            return environment['Id'], False
+        return self.create_environment(environment_spec).id, True
+
     def create_channel(self, name, project_id, lifecycle_id):
         channel = {
             'Name': name,
@@ -50,7 +204,7 @@ class OctopusServer:
             'LifecycleId': lifecycle_id
         }
         api_url = urljoin(self.host, '/api/channels')
-        result = requests.post(api_url, params=self.rest_params, json=channel)
+        result = self._request('POST', api_url, json=channel)
         self._valid_status_code(result, 'Failed to create channel; error: {0}'.format(result.text))
         return json.loads(result.content)
 
@@ -61,8 +215,9 @@ class OctopusServer:
         """
         self._validate_tentacle_uri(machine_spec.uri)
         api_url = urljoin(self.host, '/api/machines')
-        result = requests.post(api_url, params=self.rest_params, json=machine_spec.json)
+        result = self._request('POST', api_url, json=machine_spec.json)
         self._valid_status_code(result, 'Failed to create machine; error: {0}'.format(result.text))
+        self._name_index.invalidate('machines')
         machine_spec.set_id(json.loads(result.content)['Id'])
         return machine_spec
 
@@ -72,7 +227,7 @@ class OctopusServer:
         :return:
         """
         api_url = urljoin(self.host, '/api/releases')
-        result = requests.post(api_url, params=self.rest_params, json=release_spec.json)
+        result = self._request('POST', api_url, json=release_spec.json)
         self._valid_status_code(result, 'Failed to create release; error: {0}'.format(result.text))
         release_spec.set_id(json.loads(result.content)['Id'])
         return release_spec
@@ -91,62 +246,71 @@ class OctopusServer:
             }]
         }
         api_url = urljoin(self.host, '/api/lifecycles')
-        result = requests.post(api_url, params=self.rest_params, json=lifecycle)
+        result = self._request('POST', api_url, json=lifecycle)
         self._valid_status_code(result, 'Failed to create lifecycle; error: {0}'.format(result.text))
+        self._name_index.invalidate('lifecycles')
         lifecycle = json.loads(result.content)
         return lifecycle
 
     def add_environment_to_lifecycle_on_phase(self, environment_id, lifecycle_id, phase_name):
-        lifecycle = self.get_lifecycle_by_id(lifecycle_id)
-        lifecycle = self._add_env_to_optional_targets_of_lifecycle(environment_id, lifecycle, phase_name)
-        api_url = urljoin(self.host, '/api/lifecycles/{0}'.format(lifecycle_id))
-        result = requests.put(api_url, params=self.rest_params, json=lifecycle)
-        self._valid_status_code(result, 'Failed to create lifecycle; error: {0}'.format(result.text))
-        lifecycle = json.loads(result.content)
-        return lifecycle
+        return self.submit_lifecycle_update(lifecycle_id, [LifecycleOperation(ADD, environment_id, phase_name)])
 
     def remove_environment_from_lifecycle_on_phase(self, environment_id, lifecycle_id, phase_name):
-        lifecycle = self.get_lifecycle_by_id(lifecycle_id)
-        lifecycle = self._remove_env_from_optional_targets_of_lifecycle(environment_id, lifecycle, phase_name)
-        api_url = urljoin(self.host, '/api/lifecycles/{0}'.format(lifecycle_id))
-        result = requests.put(api_url, params=self.rest_params, json=lifecycle)
-        self._valid_status_code(result, 'Failed to create lifecycle; error: {0}'.format(result.text))
-        lifecycle = json.loads(result.content)
-        return lifecycle
+        return self.submit_lifecycle_update(lifecycle_id, [LifecycleOperation(REMOVE, environment_id, phase_name)])
 
-    def _add_env_to_optional_targets_of_lifecycle(self, environment_id, lifecycle, phase_name):
-        for phase in lifecycle['Phases']:
-            if phase['Name'] == phase_name:
-                phase['OptionalDeploymentTargets'].append(environment_id)
-                break
-        else:
-            raise Exception('Could not add environment {0} to lifecycle {1}'
-                            ' because did not find phase {2}'.format(environment_id, lifecycle['Id'], phase_name))
-        return lifecycle
+    def submit_lifecycle_update(self, lifecycle_id, operations):
+        """
+        Applies the operations through the host's lifecycle update queue, merged into one write with the
+        operations other threads submit for the same lifecycle at the same time. The write runs without the
+        deadline of this instance, which only bounds waiting for it.
+        :type lifecycle_id: str
+        :type operations: list[cloudshell.octopus.lifecycle_update.LifecycleOperation]
+        :return: the lifecycle after the write
+        :rtype: dict
+        """
+        return self._lifecycle_updates.submit(lifecycle_id, operations, self.without_deadline().update_lifecycle,
+                                              self.deadline)
 
-    def _remove_env_from_optional_targets_of_lifecycle(self, environment_id, lifecycle, phase_name):
-        for phase in lifecycle['Phases']:
-            if phase['Name'] == phase_name:
-                try:
-                    phase['OptionalDeploymentTargets'].remove(environment_id)
-                except:
-                    raise Exception('Failed to remove remove environment {0} from lifecycle {1}'.format(environment_id, lifecycle['Id']))
-                break
-        else:
-            raise Exception('Could not remove environment {0} from lifecycle {1}'
-                            ' because did not find phase {2}'.format(environment_id, lifecycle['Id'], phase_name))
-        return lifecycle
+    def update_lifecycle(self, lifecycle_id, operations):
+        """
+        Applies a batch of operations to the lifecycle in a single PUT. The lifecycle has no version to
+        compare against, so after the PUT it is read back: if a concurrent writer answered with a conflict
+        or overwrote the operations, the whole read-modify-write is repeated. Removing an environment that is not
+        on the phase fails, unless it was already removed by an earlier attempt.
+        :type lifecycle_id: str
+        :type operations: list[cloudshell.octopus.lifecycle_update.LifecycleOperation]
+        :return: the lifecycle after the write
+        :rtype: dict
+        """
+        api_url = urljoin(self.host, '/api/lifecycles/{0}'.format(lifecycle_id))
+        for attempt in xrange(1, LIFECYCLE_UPDATE_ATTEMPTS + 1):
+            lifecycle = self.get_lifecycle_by_id(lifecycle_id)
+            changed = [operation for operation in operations if operation.apply(lifecycle, strict=attempt == 1)]
+            if not changed:
+                return lifecycle
+            result = self._request('PUT', api_url, json=lifecycle)
+            if result.status_code not in CONFLICT_STATUS_CODES:
+                self._valid_status_code(result, 'Failed to update lifecycle {1}; error: {0}'
+                                        .format(result.text, lifecycle_id))
+                self._name_index.invalidate('lifecycles')
+                lifecycle = self.get_lifecycle_by_id(lifecycle_id)
+                if all(operation.is_applied(lifecycle) for operation in operations):
+                    return lifecycle
+            if attempt < LIFECYCLE_UPDATE_ATTEMPTS:
+                time.sleep(self._fit_in_deadline(self._retry_policy.delay(attempt)))
+        raise Exception('Failed to update lifecycle {0} with {1}, it kept being changed concurrently'
+                        .format(lifecycle_id, operations))
 
     def get_lifecycle_by_id(self, lifecycle_id):
         api_url = urljoin(self.host, '/api/lifecycles/{0}'.format(lifecycle_id))
-        result = requests.get(api_url, params=self.rest_params)
+        result = self._request('GET', api_url)
         self._valid_status_code(result, 'Failed to get lifecycle with id {0}'.format(lifecycle_id))
         lifecycle = json.loads(result.content)
         return lifecycle
 
     def get_release_by_id(self, project_id, release_id):
         api_url = urljoin(self.host, '/api/releases/{0}'.format(release_id))
-        result = requests.get(api_url, params=self.rest_params)
+        result = self._request('GET', api_url)
         self._valid_status_code(result,
                                 'Failed to find release {0} on project {1}\n Error: {2}'.format(release_id,
                                                                                                 project_id,
@@ -155,257 +319,529 @@ class OctopusServer:
         return release
 
     def get_latest_channel_release(self, channel_id):
-        api_url = urljoin(self.host, '/api/channels/{0}/releases'.format(channel_id))
-        result = requests.get(api_url, params=self.rest_params)
-        self._valid_status_code(result, 'Failed to get channel releases; error: {0}'.format(result.text))
-        releases = json.loads(result.content)
-        if not releases:
-            raise Exception('No releases found on this channel')
         # releases are always ordered from most recent to oldest
         # https://github.com/OctopusDeploy/OctopusDeploy-Api/wiki/Releases
-        return releases['Items'][0]
+        releases = self.iter_collection('/api/channels/{0}/releases'.format(channel_id), take=1)
+        release = next(releases, None)
+        if release is None:
+            raise Exception('No releases found on this channel')
+        return release
 
     def get_release_by_version_name(self, project_id, version_name):
         api_url = urljoin(self.host, '/api/projects/{0}/releases/{1}'.format(project_id, version_name))
-        result = requests.get(api_url, params=self.rest_params)
+        result = self._request('GET', api_url)
         self._valid_status_code(result, 'Failed to get release named {1}; error: {0}'.format(result.text, version_name))
         release = json.loads(result.content)
         return release
 
-    def deploy_release(self, release_id, environment_id):
+    def deploy_release(self, release_id, environment_id, poll_schedule=None):
         """
         :param release_id: str
         :type environment_id: str
+        :param poll_schedule: how to poll for deployment completion, defaults to PollSchedule()
+        :type poll_schedule: cloudshell.octopus.poll_schedule.PollSchedule
         :return:
         """
+        deployment_result = self.start_deployment(release_id, environment_id)
+
+        self.wait_till_deployment_completes(deployment_result, poll_schedule)
+
+        return deployment_result
+
+    def start_deployment(self, release_id, environment_id):
+        """
+        Queues the deployment without waiting for it, its progress is tracked through deployment['TaskId']
+        :type release_id: str
+        :type environment_id: str
+        :return: the created deployment
+        :rtype: dict
+        """
         api_url = urljoin(self.host, '/api/deployments')
         deployment = {
             'EnvironmentId': environment_id,
             'ReleaseId': release_id
         }
-        result = requests.post(api_url, params=self.rest_params, json=deployment)
+        result = self._request('POST', api_url, json=deployment)
         self._valid_status_code(result, 'Failed to deploy release; error: {0}'.format(result.text))
-        deployment_result = json.loads(result.text)
-
-        self.wait_till_deployment_completes(deployment_result)
-
-        return deployment_result
+        return json.loads(result.text)
 
-    def delete_environment(self, environment_id):
-        self._delete_machines_associated_with_environment(environment_id)
+    def delete_environment(self, environment_id, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Deletes the environment after deleting its machines, up to max_workers machines at a time.
+        When any machine could not be deleted the environment is kept and the error lists every failed machine;
+        the others stay deleted.
+        :type environment_id: str
+        :type max_workers: int
+        :return: outcome of each machine deletion, a BulkResult rather than True since machines are deleted
+        concurrently; it is truthy, so callers checking the result keep working
+        :rtype: cloudshell.octopus.bulk_operation.BulkResult
+        """
+        machines_result = self._delete_machines_associated_with_environment(environment_id, max_workers)
+        if machines_result.failed:
+            raise Exception('Failed to delete machines of environment {0}: {1}'.format(environment_id,
+                                                                                       machines_result))
         api_url = urljoin(self.host, '/api/environments/{0}'.format(environment_id))
-        result = requests.delete(api_url, params=self.rest_params)
+        result = self._request('DELETE', api_url)
         self._valid_status_code(result, 'Error during delete environment: {0}'.format(result.text))
-        return True
+        self._name_index.invalidate('environments', 'machines')
+        return machines_result
 
-    def _delete_machines_associated_with_environment(self, environment_id):
-        environment_machines_url = urljoin(self.host, 'api/environments/{0}/machines'.format(environment_id))
-        while True:
-            result = requests.get(environment_machines_url, params=self.rest_params)
-            environment_machines = json.loads(result.content)
-            if not environment_machines['Items']:
-                break
-            for machine in environment_machines['Items']:
-                self.delete_machine(machine['Id'])
+    def _delete_machines_associated_with_environment(self, environment_id, max_workers):
+        machine_ids = [machine['Id'] for machine in
+                       self.iter_collection('/api/environments/{0}/machines'.format(environment_id))]
+        return self._settle_failed_deletions('machines', run_bulk(self.delete_machine, machine_ids, max_workers))
 
     def delete_machine(self, machine_id):
-        if not self.machine_exists(machine_id):
-            raise Exception('Machine does not exist')
         api_url = urljoin(self.host, '/api/machines/{0}'.format(machine_id))
-        result = requests.delete(api_url, params=self.rest_params)
+        result = self._request('DELETE', api_url)
+        # already deleted is as good as deleted
+        if result.status_code != 404:
+            self._valid_status_code(result, 'Failed to delete machine {0}; error: {1}'.format(machine_id,
+                                                                                             result.text))
+        self._name_index.invalidate('machines')
 
     def delete_release(self, release_id):
-        if not self.release_exists(release_id):
-            raise Exception('Release does not exist')
         api_url = urljoin(self.host, '/api/releases/{0}'.format(release_id))
-        return requests.delete(api_url, params=self.rest_params)
+        result = self._request('DELETE', api_url)
+        # already deleted is as good as deleted
+        if result.status_code != 404:
+            self._valid_status_code(result, 'Failed to delete release {0}; error: {1}'.format(release_id,
+                                                                                             result.text))
+        return True
 
     def delete_lifecycle(self, lifecycle_id):
         api_url = urljoin(self.host, 'api/lifecycles/{0}'.format(lifecycle_id))
-        result = requests.delete(api_url, params=self.rest_params)
+        result = self._request('DELETE', api_url)
         self._valid_status_code(result, 'Failed to delete lifecycle; error: {0}'.format(result.text))
+        self._name_index.invalidate('lifecycles')
         return True
 
-    def delete_channel(self, channel_id):
-        self._delete_channel_releases(channel_id)
+    def delete_channel(self, channel_id, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Deletes the channel after deleting its releases, up to max_workers releases at a time.
+        When any release could not be deleted the channel is kept and the error lists every failed release;
+        the others stay deleted.
+        :type channel_id: str
+        :type max_workers: int
+        :return: outcome of each release deletion, a BulkResult rather than the deleted channel since releases
+        are deleted concurrently
+        :rtype: cloudshell.octopus.bulk_operation.BulkResult
+        """
+        releases_result = self._delete_channel_releases(channel_id, max_workers)
+        if releases_result.failed:
+            raise Exception('Failed to delete releases of channel {0}: {1}'.format(channel_id, releases_result))
         api_url = urljoin(self.host, '/api/channels/{0}'.format(channel_id))
-        result = requests.delete(api_url, params=self.rest_params)
+        result = self._request('DELETE', api_url)
         self._valid_status_code(result, 'Failed to delete channel; error: {0}'.format(result.text))
-        return json.loads(result.content)
+        return releases_result
 
-    def _delete_channel_releases(self, channel_id):
-        api_url = urljoin(self.host, '/api/channels/{0}/releases'.format(channel_id))
-        result = requests.get(api_url, params=self.rest_params)
-        self._valid_status_code(result, 'Failed to get channel releases; error: {0}'.format(result.text))
-        releases_dict = json.loads(result.content)
-        if 'Items' in releases_dict:
-            for release in releases_dict['Items']:
-                self.delete_release(release['Id'])
+    def _delete_channel_releases(self, channel_id, max_workers):
+        # collect every page before deleting, deleting while paging would shift releases past the skip offset
+        release_ids = [release['Id'] for release in
+                       self.iter_collection('/api/channels/{0}/releases'.format(channel_id))]
+        return self._settle_failed_deletions('releases', run_bulk(self.delete_release, release_ids, max_workers))
 
     def add_existing_machine_to_environment(self, machine_id, environment_id, roles=[]):
-        api_url = urljoin(self.host, '/api/machines/{0}'.format(machine_id))
-        result = requests.get(api_url, params=self.rest_params)
-        existing_machine = json.loads(result.text)
-        existing_machine['EnvironmentIds'].append(environment_id)
-        if roles:
-            existing_machine['Roles'].extend(roles)
-        result = requests.put(api_url, params=self.rest_params, json=existing_machine)
-        self._valid_status_code(result,
-                                'Failed to add existing machine with id {0} to environment {1}.'
-                                '\nError: {2}'.format(machine_id, environment_id, result.text))
-        return json.loads(result.content)
+        existing_machine = self.get_entity('/api/machines/{0}'.format(machine_id))
+        if not self._add_machine_to_environment(existing_machine, environment_id, roles):
+            return existing_machine
+        return self._put_machine(existing_machine, 'Failed to add existing machine with id {0} to environment {1}.'
+                                 .format(machine_id, environment_id))
 
     def remove_existing_machine_from_environment(self, machine_id, environment_id):
-        api_url = urljoin(self.host, '/api/machines/{0}'.format(machine_id))
-        result = requests.get(api_url, params=self.rest_params)
-        existing_machine = json.loads(result.text)
-        if environment_id in existing_machine['EnvironmentIds']:
-            existing_machine['EnvironmentIds'].remove(environment_id)
-        result = requests.put(api_url, params=self.rest_params, json=existing_machine)
-        self._valid_status_code(result,
-                                'Failed to remove existing machine with id {0} to environment {1}.'
-                                '\nError: {2}'.format(machine_id, environment_id, result.text))
-        return json.loads(result.content)
+        existing_machine = self.get_entity('/api/machines/{0}'.format(machine_id))
+        if environment_id not in existing_machine['EnvironmentIds']:
+            return existing_machine
+        existing_machine['EnvironmentIds'].remove(environment_id)
+        return self._put_machine(existing_machine, 'Failed to remove existing machine with id {0} to environment {1}.'
+                                 .format(machine_id, environment_id))
+
+    def add_existing_machines_to_environment(self, machine_roles, environment_id, max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Adds many machines to the environment: all machines are read in one request, only the ones whose
+        environments or roles change are written, up to max_workers at a time
+        :param machine_roles: roles to add to each machine, by machine id
+        :type machine_roles: dict[str, list[str]]
+        :type environment_id: str
+        :type max_workers: int
+        :return: per machine outcome, machines already set up are skipped
+        :rtype: cloudshell.octopus.bulk_operation.BulkResult
+        """
+        machines = self._get_machines_by_id(machine_roles.keys())
 
-    def wait_till_deployment_completes(self, deployment_result, retries=30, wait_duration=60):
-        deployments = self._get_release_deployments(deployment_result)
-
-        for deployment in deployments:
-            deployment_completed = False
-            task_url = urljoin(self.host, deployment['Links']['Task'])
-            for retry in xrange(retries):
-                result = requests.get(task_url, params=self.rest_params)
-                if json.loads(result.content)['IsCompleted']:
-                    deployment_completed = True
-                    break
-                else:
-                    time.sleep(wait_duration)
-            if not deployment_completed:
-                raise Exception('Timeout after {0}'.format(str(retries*wait_duration)))
-
-    def _get_release_deployments(self, deployment_result):
-        deployments_url = urljoin(self.host, deployment_result['Links']['Release'] + '/deployments')
-        result = requests.get(deployments_url, params=self.rest_params)
-        self._valid_status_code(result, 'Failed to get release deployments; error: {0}'.format(result.text))
-        deployments = json.loads(result.content)['Items']
-        return deployments
+        def add_machine(machine_id):
+            machine = self._get_existing_machine(machines, machine_id)
+            if not self._add_machine_to_environment(machine, environment_id, machine_roles[machine_id]):
+                return SKIPPED
+            return self._put_machine(machine, 'Failed to add existing machine with id {0} to environment {1}.'
+                                     .format(machine_id, environment_id))
 
-    def environment_exists(self, environment_id):
-        api_url = urljoin(self.host, '/api/environments/{0}'.format(environment_id))
-        result = requests.get(api_url, params=self.rest_params)
-        try:
-            self._valid_status_code(result, 'Environment not found; error: {0}'.format(result.text))
-        except:
+        return run_bulk(add_machine, machine_roles.keys(), max_workers)
+
+    def remove_existing_machines_from_environment(self, machine_ids, environment_id,
+                                                  max_workers=DEFAULT_MAX_WORKERS):
+        """
+        Removes many machines from the environment, see add_existing_machines_to_environment.
+        Machines that are not on the environment are skipped, machines that would be left without
+        any environment fail.
+        :type machine_ids: list[str]
+        :type environment_id: str
+        :type max_workers: int
+        :rtype: cloudshell.octopus.bulk_operation.BulkResult
+        """
+        machines = self._get_machines_by_id(machine_ids)
+
+        def remove_machine(machine_id):
+            machine = self._get_existing_machine(machines, machine_id)
+            if environment_id not in machine['EnvironmentIds']:
+                return SKIPPED
+            if len(machine['EnvironmentIds']) == 1:
+                raise Exception('a machine must be associated with at least one environment and {0} is the last '
+                                'environment {1} is associated with'.format(environment_id, machine_id))
+            machine['EnvironmentIds'].remove(environment_id)
+            return self._put_machine(machine, 'Failed to remove existing machine with id {0} to environment {1}.'
+                                     .format(machine_id, environment_id))
+
+        return run_bulk(remove_machine, machine_ids, max_workers)
+
+    def _get_machines_by_id(self, machine_ids):
+        return {machine['Id']: machine for machine in self.get_many('machines', list(machine_ids))}
+
+    def _get_existing_machine(self, machines, machine_id):
+        if machine_id not in machines:
+            raise Exception('Machine with id {0} was not found on Octopus Deploy'.format(machine_id))
+        return machines[machine_id]
+
+    def _add_machine_to_environment(self, machine, environment_id, roles):
+        """
+        :return: whether the machine changed
+        :rtype: bool
+        """
+        new_roles = [role for role in roles if role not in machine['Roles']]
+        # a role listed twice in roles is added once
+        new_roles = sorted(set(new_roles), key=new_roles.index)
+        if environment_id in machine['EnvironmentIds'] and not new_roles:
             return False
+        if environment_id not in machine['EnvironmentIds']:
+            machine['EnvironmentIds'].append(environment_id)
+        machine['Roles'].extend(new_roles)
         return True
 
+    def _put_machine(self, machine, error_msg):
+        api_url = urljoin(self.host, '/api/machines/{0}'.format(machine['Id']))
+        result = self._request('PUT', api_url, json=machine)
+        self._valid_status_code(result, '{0}\nError: {1}'.format(error_msg, result.text))
+        self._name_index.invalidate('machines')
+        return json.loads(result.content)
+
+    def wait_till_deployment_completes(self, deployment_result, poll_schedule=None):
+        """
+        :param poll_schedule: delays between task polls and overall timeout, defaults to PollSchedule()
+        :type poll_schedule: cloudshell.octopus.poll_schedule.PollSchedule
+        """
+        poll_schedule = poll_schedule or PollSchedule()
+        deadline = time.time() + poll_schedule.timeout
+        # only the task of this deployment, other deployments of the release belong to other sandboxes
+        task_url = urljoin(self.host, deployment_result['Links']['Task'])
+        poll_number = 0
+        while True:
+            result = self._request('GET', task_url)
+            self._valid_status_code(result, 'Failed to get deployment task {0}; error: {1}'
+                                    .format(deployment_result['TaskId'], result.text))
+            task = json.loads(result.content)
+            if task['IsCompleted']:
+                return task
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise Exception('Timeout after {0} seconds'.format(poll_schedule.timeout))
+            if self.deadline:
+                remaining = min(remaining, self.deadline.check('waiting for task {0}'
+                                                               .format(deployment_result['TaskId'])))
+            time.sleep(poll_schedule.next_delay(poll_number, remaining))
+            poll_number += 1
+
+    def get_task(self, task_id):
+        api_url = urljoin(self.host, '/api/tasks/{0}'.format(task_id))
+        result = self._request('GET', api_url)
+        self._valid_status_code(result, 'Failed to get task {0}; error: {1}'.format(task_id, result.text))
+        return json.loads(result.content)
+
+    def get_tasks(self, task_ids):
+        """
+        Fetches many server tasks with as few requests as the url length allows
+        :type task_ids: list[str]
+        :rtype: list[dict]
+        """
+        return self.get_many('tasks', task_ids)
+
+    def get_many(self, collection, ids):
+        """
+        Fetches entities of a collection by id through ?ids=, IDS_PER_REQUEST ids per request
+        :param collection: collection name, e.g. 'machines'
+        :type collection: str
+        :type ids: list[str]
+        :return: the entities that exist, ids that do not are left out
+        :rtype: list[dict]
+        """
+        entities = []
+        for i in xrange(0, len(ids), IDS_PER_REQUEST):
+            chunk = ids[i:i + IDS_PER_REQUEST]
+            entities.extend(self.iter_collection('/api/{0}'.format(collection), take=len(chunk),
+                                                 filters={'ids': ','.join(chunk)}))
+        return entities
+
+    def existing_ids(self, collection, ids):
+        """
+        Batch existence check, see get_many
+        :rtype: set[str]
+        """
+        return {entity['Id'] for entity in self.get_many(collection, ids)}
+
+    def _settle_failed_deletions(self, collection, bulk_result):
+        """
+        A deletion that failed, e.g. timed out, after the server applied it is as good as deleted,
+        the failed ids are checked in one batch request rather than one request each
+        :type bulk_result: cloudshell.octopus.bulk_operation.BulkResult
+        :rtype: cloudshell.octopus.bulk_operation.BulkResult
+        """
+        if bulk_result.failed:
+            try:
+                existing = self.existing_ids(collection, bulk_result.failed.keys())
+            except Exception:
+                # the failures stand as they are, the caller reports them rather than why they could not be rechecked
+                return bulk_result
+            for entity_id in [entity_id for entity_id in bulk_result.failed if entity_id not in existing]:
+                del bulk_result.failed[entity_id]
+                bulk_result.succeeded.append(entity_id)
+        return bulk_result
+
+    def environment_exists(self, environment_id):
+        return self._exists('environments', environment_id)
+
+    def _exists(self, collection, entity_id):
+        # through ?ids= the server answers with an empty page instead of the whole entity
+        return entity_id in self.existing_ids(collection, [entity_id])
+
     def get_entity(self, relative_path):
         api_url = urljoin(self.host, relative_path)
-        result = requests.get(api_url, params=self.rest_params)
+        result = self._request('GET', api_url)
         self._valid_status_code(result, 'Couldn''t get entity. error: {0}'.format(result.text))
         return json.loads(result.content)
 
+    def iter_collection(self, relative_path, take=None, skip=0, filters=None):
+        """
+        Yields the items of a paged Octopus collection, following Links['Page.Next'].
+        Pages are requested lazily, so a consumer that stops iterating early never fetches the remaining pages.
+        :param relative_path: path of the collection, e.g. /api/channels/Channels-1/releases
+        :param take: page size, server default when None
+        :param skip: number of items to skip before the first page
+        :param filters: extra query parameters of the first page, e.g. {'partialName': 'web'}
+        :type relative_path: str
+        :type take: int
+        :type skip: int
+        :type filters: dict
+        :rtype: collections.Iterable[dict]
+        """
+        api_url = urljoin(self.host, relative_path)
+        params = dict(self.rest_params, skip=skip)
+        params.update(filters or {})
+        if take:
+            params['take'] = take
+        while api_url:
+            result = self._request('GET', api_url, params=params)
+            self._valid_status_code(result, 'Failed to get {0}; error: {1}'.format(relative_path, result.text))
+            page = json.loads(result.content)
+            items = page.get('Items') or []
+            for item in items:
+                yield item
+            next_page = page.get('Links', {}).get('Page.Next')
+            if not items or not next_page:
+                break
+            # the next page link already carries skip, take and the filters
+            api_url = urljoin(self.host, next_page)
+            params = self.rest_params
+
     def find_lifecycle_by_name(self, lifecycle_name):
-        api_url = urljoin(self.host, '/api/lifecycles/all')
-        result = requests.get(api_url, params=self.rest_params)
-        self._valid_status_code(result, 'Failed to find lifecycle {1}; error: {0}'.format(result.text, lifecycle_name))
-        lifecycles = json.loads(result.content)
-        for lifecycle in lifecycles:
-            if lifecycle['Name'] == lifecycle_name:
-                return lifecycle
-        raise Exception('Lifecycle named {0} was not found on Octopus Deploy'.format(lifecycle_name))
+        lifecycle = self._find_by_name('lifecycles', 'lifecycle', lifecycle_name)
+        if lifecycle is None:
+            raise Exception('Lifecycle named {0} was not found on Octopus Deploy'.format(lifecycle_name))
+        return lifecycle
 
     def find_project_by_name(self, project_name):
-        api_url = urljoin(self.host, '/api/projects/all')
-        result = requests.get(api_url, params=self.rest_params)
-        self._valid_status_code(result, 'Failed to find project {1}; error: {0}'.format(result.text, project_name))
-        projects = json.loads(result.content)
-        for project in projects:
-            if project['Name'] == project_name:
-                return project
-        raise Exception('Project named {0} was not found on Octopus Deploy'.format(project_name))
+        project = self._find_by_name('projects', 'project', project_name)
+        if project is None:
+            raise Exception('Project named {0} was not found on Octopus Deploy'.format(project_name))
+        return project
 
     def find_machine_by_name(self, machine_name):
         """
         :type machine_name: str
         :return:
         """
-        api_url = urljoin(self.host, '/api/machines/all')
-        result = requests.get(api_url, params=self.rest_params)
-        self._valid_status_code(result, 'Failed to find machine {1}; error: {0}'.format(result.text,
-                                                                                        machine_name))
-        machines = json.loads(result.content)
-        for machine in machines:
-            if machine['Name'] == machine_name:
-                return machine
-        raise Exception('Machine named {0} was not found on Octopus Deploy'.format(machine_name))
+        machine = self._find_by_name('machines', 'machine', machine_name)
+        if machine is None:
+            raise Exception('Machine named {0} was not found on Octopus Deploy'.format(machine_name))
+        return machine
 
     def find_environment_by_name(self, environment_name):
         """
         :type machine_name: str
         :rtype: dict
         """
-        api_url = urljoin(self.host, '/api/environments/all')
-        result = requests.get(api_url, params=self.rest_params)
-        self._valid_status_code(result, 'Failed to find environment {1}; error: {0}'.format(result.text,
-                                                                                            environment_name))
-        environments = json.loads(result.content)
-        for environment_dict in environments:
-            if environment_dict['Name'] == environment_name:
-                return environment_dict
-        raise Exception('Environment named {0} was not found on Octopus Deploy'.format(environment_name))
+        environment_dict = self._find_by_name('environments', 'environment', environment_name)
+        if environment_dict is None:
+            raise Exception('Environment named {0} was not found on Octopus Deploy'.format(environment_name))
+        return environment_dict
+
+    def _find_by_name(self, collection, entity_type, name):
+        if not self._is_unfiltered(collection):
+            try:
+                return self._name_index.find_entity(collection, name,
+                                                    lambda: self._find_by_name_filter(collection, name))
+            except NameFilterNotSupported:
+                self._set_unfiltered(collection)
+        return self._name_index.find_entity(collection, name, lambda: self._find_in_all(collection, entity_type, name))
+
+    def _find_by_name_filter(self, collection, name):
+        """
+        Looks the name up with ?partialName= so the server only returns candidates, then matches exactly
+        :raises NameFilterNotSupported: if the server ignored the filter
+        """
+        for entity in self.iter_collection('/api/{0}'.format(collection), filters={'partialName': name}):
+            if entity['Name'] == name:
+                return entity
+            if name.lower() not in entity['Name'].lower():
+                raise NameFilterNotSupported('{0} ignores partialName'.format(collection))
+        return None
+
+    def _is_unfiltered(self, collection):
+        with _unfiltered_collections_lock:
+            return collection in _unfiltered_collections.get(self._host_key, ())
+
+    def _set_unfiltered(self, collection):
+        with _unfiltered_collections_lock:
+            _unfiltered_collections.setdefault(self._host_key, set()).add(collection)
+
+    def _find_in_all(self, collection, entity_type, name):
+        """
+        Streams /all and stops reading at the first match, so the whole listing is never held in memory
+        """
+        api_url = urljoin(self.host, '/api/{0}/all'.format(collection))
+        result = self._request('GET', api_url, stream=True)
+        try:
+            # result.text would read the whole body, only touch it on errors
+            if not result.status_code // 100 == 2:
+                self._valid_status_code(result, 'Failed to find {1} {2}; error: {0}'
+                                        .format(result.text, entity_type, name))
+            for entity in iter_json_array(result.iter_content(STREAM_CHUNK_SIZE)):
+                if entity['Name'] == name:
+                    return entity
+            return None
+        finally:
+            result.close()
 
     def find_channel_by_name_on_project(self, project_id, channel_name):
-        api_url = urljoin(self.host, '/api/projects/{0}/channels'.format(project_id))
-        result = requests.get(api_url, params=self.rest_params)
-        project_channels = json.loads(result.text)['Items']
-        for channel in project_channels:
+        for channel in self.iter_collection('/api/projects/{0}/channels'.format(project_id)):
             if channel['Name'] == channel_name:
                 return channel
         raise Exception('Channel named {0} was not found on Octopus Deploy'.format(channel_name))
 
     def channel_exists(self, project_id, channel_name):
-        api_url = urljoin(self.host, '/api/projects/{0}/channels'.format(project_id))
-        result = requests.get(api_url, params=self.rest_params)
-        project_channels = json.loads(result.text)['Items']
-        for channel in project_channels:
+        for channel in self.iter_collection('/api/projects/{0}/channels'.format(project_id)):
             if channel['Name'] == channel_name:
                 return True
         return False
 
     def lifecycle_exists(self, lifecycle_id):
-        api_url = urljoin(self.host, '/api/lifecycles/{0}'.format(lifecycle_id))
-        result = requests.get(api_url, params=self.rest_params)
-        try:
-            self._valid_status_code(result, 'Lifeycle not found; error: {0}'.format(result.text))
-        except:
-            return False
-        return True
+        return self._exists('lifecycles', lifecycle_id)
 
     def machine_exists(self, machine_id):
-        api_url = urljoin(self.host, '/api/machines/{0}'.format(machine_id))
-        result = requests.get(api_url, params=self.rest_params)
-        try:
-            self._valid_status_code(result, 'Machine not found; error: {0}'.format(result.text))
-        except:
-            return False
-        return True
+        return self._exists('machines', machine_id)
 
     def machine_exists_on_environment(self, machine_id, environment_id):
         api_url = urljoin(self.host, '/api/machines/{0}'.format(machine_id))
-        result = requests.get(api_url, params=self.rest_params)
+        result = self._request('GET', api_url)
         self._valid_status_code(result, 'Machine with id {1} not found; error: {0}'.format(result.text, machine_id))
         machine = json.loads(result.text)
         return True if environment_id in machine['EnvironmentIds'] else False
 
     def release_exists(self, release_id):
-        api_url = urljoin(self.host, '/api/releases/{0}'.format(release_id))
-        result = requests.get(api_url, params=self.rest_params)
-        try:
-            self._valid_status_code(result, 'Machine not found; error: {0}'.format(result.text))
-        except:
-            return False
-        return True
+        return self._exists('releases', release_id)
+
+    def _request(self, method, api_url, **kwargs):
+        """
+        Sends every Octopus API call: authenticates it, retries transient failures of idempotent calls
+        with jittered backoff and fails fast while the host's circuit breaker is open
+        :type method: str
+        :type api_url: str
+        :rtype: requests.Response
+        """
+        if not self._host_validated:
+            self._ensure_host_validated()
+        kwargs.setdefault('params', self.rest_params)
+        call = '{0} {1}'.format(method, urlparse(api_url).path)
+        attempt = 0
+        while True:
+            # may raise DeadlineExceeded, so before the breaker hands out its trial call
+            kwargs['timeout'] = self._get_timeouts(call)
+            self._circuit_breaker.before_request()
+            attempt += 1
+            try:
+                result = self._http_session.request(method, api_url, **kwargs)
+            except (requests.ConnectionError, requests.Timeout):
+                self._circuit_breaker.record_failure()
+                # an unreachable host has to prove itself again before the next instance trusts it
+                _set_host_validated(self._host_key, False)
+                if self.deadline:
+                    self.deadline.check(call)
+                if not self._retry_policy.should_retry(method, attempt):
+                    raise
+                time.sleep(self._fit_in_deadline(self._retry_policy.delay(attempt)))
+                continue
+            except Exception:
+                self._circuit_breaker.release_trial()
+                raise
+            if result.status_code // 100 == 5:
+                self._circuit_breaker.record_failure()
+            else:
+                self._circuit_breaker.record_success()
+            if result.status_code == 401 and 'ApiKey' in (kwargs['params'] or {}):
+                api_key = self._get_renewed_api_key(kwargs['params']['ApiKey'])
+                if api_key:
+                    result.close()
+                    kwargs['params'] = dict(kwargs['params'], ApiKey=api_key)
+                    continue
+            if not self._retry_policy.should_retry(method, attempt, result.status_code):
+                return result
+            time.sleep(self._fit_in_deadline(self._retry_policy.delay(attempt, result.headers.get('Retry-After'))))
+
+    def _get_renewed_api_key(self, rejected_api_key):
+        """
+        :return: the API key to repeat a call rejected with rejected_api_key with, None when there is none
+        :rtype: str
+        """
+        with self._api_key_lock:
+            if self.rest_params['ApiKey'] != rejected_api_key:
+                # renewed by a concurrent call
+                return self.rest_params['ApiKey']
+            if not self._renew_api_key or self._api_key_renewed:
+                return None
+            self._api_key_renewed = True
+            api_key = self._renew_api_key()
+            if not api_key or api_key == rejected_api_key:
+                return None
+            # in place, copies made by without_deadline share the dict and pick the new key up too
+            self.rest_params['ApiKey'] = api_key
+            self._lifecycle_updates = get_lifecycle_update_queue(self._host_key, api_key)
+            return api_key
+
+    def _get_timeouts(self, call):
+        if self.deadline:
+            return self.deadline.timeouts(detail=call)
+        return DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+
+    def _fit_in_deadline(self, delay):
+        return min(delay, self.deadline.remaining()) if self.deadline else delay
 
     def _valid_status_code(self, result, error_msg):
         # Consider any status other than 2xx an error
@@ -413,11 +849,20 @@ class OctopusServer:
             raise Exception(error_msg)
 
     def _validate_tentacle_uri(self, uri):
-        reply = urllib.urlopen(uri, context=VALIDATE_TENTACLE_CONTEXT)
+        connect_timeout, read_timeout = self._get_timeouts('validate tentacle {0}'.format(uri))
+        try:
+            reply = urllib2.urlopen(uri, timeout=max(connect_timeout, read_timeout), context=VALIDATE_TENTACLE_CONTEXT)
+            status_code = reply.getcode()
+        except urllib2.HTTPError as e:
+            status_code = e.code
+        except (urllib2.URLError, socket.timeout) as e:
+            if self.deadline:
+                self.deadline.check('validate tentacle {0}'.format(uri))
+            raise Exception('Unable to access Octopus Tentacle at {0}: {1}'.format(uri, e))
         class Result(object):
             pass
         result = Result()
-        result.status_code = reply.getcode()
+        result.status_code = status_code
         # noinspection PyTypeChecker
         self._valid_status_code(result=result,
                                 error_msg='Unable to access Octopus Tentacle at {0}'
@@ -0,0 +1,50 @@
+import threading
+import time
+
+DEFAULT_TTL = 300
+
+
+class TtlCache(object):
+    def __init__(self, ttl=DEFAULT_TTL):
+        """
+        Thread safe key -> value cache whose entries are created on first use and trusted for ttl seconds
+        :param ttl: seconds a created value is trusted
+        :type ttl: int
+        """
+        self._ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, create):
+        """
+        :param key: hashable cache key
+        :param create: called on a miss, returns the value to cache for key
+        :type create: () -> object
+        :return: the cached value, or the one create returned
+        """
+        with self._lock:
+            if key in self._entries:
+                created_at, value = self._entries[key]
+                if time.time() - created_at <= self._ttl:
+                    self.hits += 1
+                    return value
+                del self._entries[key]
+            self.misses += 1
+
+        # created outside the lock, a slow create must not block hits on other keys
+        value = create()
+        with self._lock:
+            self._entries[key] = (time.time(), value)
+        return value
+
+    def invalidate(self, *keys):
+        """
+        Drops the given keys from the cache, or all of them when called without arguments
+        """
+        with self._lock:
+            if not keys:
+                self._entries.clear()
+            for key in keys:
+                self._entries.pop(key, None)
@@ -1,15 +1,37 @@
+import time
+
 from cloudshell.api.cloudshell_api import CloudShellAPISession
 from cloudshell.shell.core.resource_driver_interface import ResourceDriverInterface
 from cloudshell.shell.core.driver_context import InitCommandContext, ResourceCommandContext
 from cloudshell.octopus.session import OctopusServer
+from cloudshell.octopus.deployment_watcher import get_deployment_watcher
+from cloudshell.octopus.deadline import Deadline
+from cloudshell.octopus.lookup_executor import LookupExecutor
+from cloudshell.octopus.bulk_operation import BulkResult, DEFAULT_MAX_WORKERS
+from cloudshell.octopus.ttl_cache import TtlCache
 from cloudshell.octopus.environment_spec import EnvironmentSpec
 from cloudshell.octopus.release_spec import ReleaseSpec
+from cloudshell.octopus.poll_schedule import PollSchedule, DEFAULT_INITIAL_INTERVAL, DEFAULT_MAX_INTERVAL, \
+    DEFAULT_TIMEOUT
 
 # cloudshell attribute names
 OCTOPUS_DEPLOY_PROVIDER = 'Octopus Deploy Provider'
 OCTOPUS_API_KEY = 'API Key'
+DEPLOYMENT_TIMEOUT = 'Deployment Timeout'
+DEPLOYMENT_POLL_INTERVAL = 'Deployment Poll Interval'
+DEPLOYMENT_MAX_POLL_INTERVAL = 'Deployment Max Poll Interval'
 import json
 
+# seconds any command that does not wait on deployments may spend talking to Octopus
+DEFAULT_COMMAND_TIMEOUT = 300
+# seconds a CloudShell API session and the provider address/API key are reused across commands
+CLOUDSHELL_SESSION_TTL = 600
+OCTOPUS_PROVIDER_TTL = 300
+
+# shared by every command this driver process runs
+_cloudshell_sessions = TtlCache(CLOUDSHELL_SESSION_TTL)
+_octopus_providers = TtlCache(OCTOPUS_PROVIDER_TTL)
+
 
 class OctopusDeployOrchestratorDriver(ResourceDriverInterface):
     def __init__(self):
@@ -52,6 +74,87 @@ class OctopusDeployOrchestratorDriver(ResourceDriverInterface):
         """
         return self._remove_existing_machine_from_environment(context, machine_name, environment_name)
 
+    def add_existing_machines_to_environment(self, context, machines, environment_name):
+        """
+        :param machines: semicolon separated machines, each the name of an existing machine in Octopus Deploy
+        optionally followed by a colon and a comma separated list of roles to add, e.g. web1:web,api;db1:db
+        :param environment_name: environment to which the machines will be added
+        :type machines: str
+        :type environment_name: str
+        :param ResourceCommandContext context: the context the command runs on
+        :return: json with the machines added, skipped because they were already set up, and failed
+        """
+        machine_roles = self._parse_machines(machines)
+        cloudshell = self._get_cloudshell_api(context)
+        octo = self._get_octopus_server(context, cloudshell)
+        environment, machine_ids, report = self._find_machines(octo, machine_roles.keys(), environment_name)
+        bulk_result = octo.add_existing_machines_to_environment(
+            {machine_ids[name]: roles for name, roles in machine_roles.items() if name in machine_ids},
+            environment['Id'])
+        return json.dumps(self._merge_machines_report(report, bulk_result, machine_ids).json)
+
+    def remove_existing_machines_from_environment(self, context, machine_names, environment_name):
+        """
+        :param machine_names: comma separated names of existing machines in Octopus Deploy
+        :param environment_name: environment from which the machines will be removed
+        :type machine_names: str
+        :type environment_name: str
+        :param ResourceCommandContext context: the context the command runs on
+        :return: json with the machines removed, skipped because they were not on the environment, and failed
+        """
+        names = [name.strip() for name in machine_names.split(',') if name.strip()]
+        # a machine named twice would be looked up twice and written twice at the same time
+        names = sorted(set(names), key=names.index)
+        cloudshell = self._get_cloudshell_api(context)
+        octo = self._get_octopus_server(context, cloudshell)
+        environment, machine_ids, report = self._find_machines(octo, names, environment_name)
+        bulk_result = octo.remove_existing_machines_from_environment(
+            [machine_ids[name] for name in names if name in machine_ids], environment['Id'])
+        return json.dumps(self._merge_machines_report(report, bulk_result, machine_ids).json)
+
+    def _parse_machines(self, machines):
+        machine_roles = {}
+        for machine in filter(None, [machine.strip() for machine in machines.split(';')]):
+            name, _, roles = machine.partition(':')
+            machine_roles[name.strip()] = self._parse_roles(roles)
+        return machine_roles
+
+    def _find_machines(self, octo, machine_names, environment_name):
+        """
+        :return: the environment, ids of the machines found by name and a report failing the others
+        :rtype: (dict, dict[str, str], BulkResult)
+        """
+        lookups = LookupExecutor(octo.deadline) \
+            .add('environment', lambda: octo.find_environment_by_name(environment_name))
+        for name in machine_names:
+            lookups.add('machine {0}'.format(name), self._get_machine_lookup(octo, name))
+        found = lookups.run(DEFAULT_MAX_WORKERS)
+        report = BulkResult()
+        machine_ids = {}
+        for name in machine_names:
+            machine, error = found['machine {0}'.format(name)]
+            if error:
+                report.failed[name] = error
+            else:
+                machine_ids[name] = machine['Id']
+        return found['environment'], machine_ids, report
+
+    def _get_machine_lookup(self, octo, machine_name):
+        # a machine that is not found fails on its own instead of failing the whole command
+        def find_machine():
+            try:
+                return octo.find_machine_by_name(machine_name), None
+            except Exception as e:
+                return None, str(e)
+        return find_machine
+
+    def _merge_machines_report(self, report, bulk_result, machine_ids):
+        names = {machine_id: name for name, machine_id in machine_ids.items()}
+        report.succeeded.extend(names[machine_id] for machine_id in bulk_result.succeeded)
+        report.skipped.extend(names[machine_id] for machine_id in bulk_result.skipped)
+        report.failed.update((names[machine_id], error) for machine_id, error in bulk_result.failed.items())
+        return report
+
     def create_environment(self, context, environment_name):
         """
         :param ResourceCommandContext context: the context the command runs on
@@ -77,14 +180,160 @@ class OctopusDeployOrchestratorDriver(ResourceDriverInterface):
         return self._delete_lifecycle(context)
 
     def deploy_environment_to_release(self, context, project_name, release_version, environment_name):
+        poll_schedule = self._get_poll_schedule(context)
+        deadline = Deadline(poll_schedule.timeout, 'deploy_environment_to_release')
         cloudshell = self._get_cloudshell_api(context)
-        octo = self._get_octopus_server(context, cloudshell)
-        project = octo.find_project_by_name(project_name)
-        release = octo.get_release_by_version_name(project['Id'], release_version)
-        environment = octo.find_environment_by_name(environment_name)
-        octo.deploy_release(release['Id'], environment['Id'])
+        octo = self._get_octopus_server(context, cloudshell, deadline)
+        found = self._find_release_and_environment(octo, deadline, project_name, release_version, environment_name)
+        release, environment = found['release'], found['environment']
+        with deadline.step('deploy release {0} to {1}'.format(release_version, environment_name)):
+            octo.deploy_release(release['Id'], environment['Id'], poll_schedule)
         return 'Deployed {0} - {1} to {2}'.format(project_name, release['Version'], environment_name)
 
+    def start_deployment(self, context, project_name, release_version, environment_name):
+        """
+        Queues the deployment of a release to an environment and returns without waiting for it
+        :param ResourceCommandContext context: the context the command runs on
+        :return: id of the Octopus task running the deployment, see get_deployment_status and wait_for_deployments
+        """
+        cloudshell = self._get_cloudshell_api(context)
+        octo = self._get_octopus_server(context, cloudshell)
+        found = self._find_release_and_environment(octo, octo.deadline, project_name, release_version, environment_name)
+        deployment = octo.start_deployment(found['release']['Id'], found['environment']['Id'])
+        return str(deployment['TaskId'])
+
+    def _find_release_and_environment(self, octo, deadline, project_name, release_version, environment_name):
+        return LookupExecutor(deadline) \
+            .add('project', lambda: octo.find_project_by_name(project_name)) \
+            .add('release', lambda project: octo.get_release_by_version_name(project['Id'], release_version), 'project') \
+            .add('environment', lambda: octo.find_environment_by_name(environment_name)) \
+            .run()
+
+    def get_deployment_status(self, context, task_id):
+        """
+        :param ResourceCommandContext context: the context the command runs on
+        :param task_id: id returned by start_deployment
+        :return: json with the task state
+        """
+        cloudshell = self._get_cloudshell_api(context)
+        octo = self._get_octopus_server(context, cloudshell)
+        return json.dumps(self._get_task_status(octo.get_task(task_id)))
+
+    def wait_for_deployments(self, context, task_ids):
+        """
+        Waits until every given deployment task completes, bounded by the Deployment Timeout attribute
+        :param ResourceCommandContext context: the context the command runs on
+        :param task_ids: comma separated ids returned by start_deployment
+        :return: json with the final state of each task
+        """
+        poll_schedule = self._get_poll_schedule(context)
+        deadline = Deadline(poll_schedule.timeout, 'wait_for_deployments')
+        cloudshell = self._get_cloudshell_api(context)
+        octo = self._get_octopus_server(context, cloudshell, deadline)
+        watcher = get_deployment_watcher(octo)
+        futures = [watcher.watch(task_id, poll_schedule=poll_schedule)
+                   for task_id in filter(None, task_ids.split(','))]
+        statuses = []
+        for future in futures:
+            with deadline.step('waiting for task {0}'.format(future.task_id)):
+                # only this command's wait is bound by its deadline, the shared watcher polls without one
+                statuses.append(self._get_task_status(future.result(deadline.check())))
+        failed = [status for status in statuses if not status['FinishedSuccessfully']]
+        if failed:
+            raise Exception('Octopus deployments failed: {0}'.format(
+                ', '.join('{0} ({1})'.format(status['TaskId'], status['ErrorMessage']) for status in failed)))
+        return json.dumps(statuses)
+
+    def provision_sandbox(self, context, project_name, channel_name, release_version, phase_name, environment_name):
+        """
+        Everything the sandbox needs from Octopus in one command: creates the environment unless it exists, adds it
+        to the optional targets of the channel lifecycle phase and starts deploying the release to it.
+        Project, channel, release and environment are resolved once, independent lookups run concurrently.
+        :param ResourceCommandContext context: the context the command runs on
+        :return: json with the ids involved, the deployment task id and the seconds each step took
+        """
+        deadline = Deadline(DEFAULT_COMMAND_TIMEOUT, 'provision_sandbox')
+        cloudshell = self._get_cloudshell_api(context)
+        octo = self._get_octopus_server(context, cloudshell, deadline)
+        environment_spec = self._get_environment_spec(context)
+        environment_spec._name = environment_name
+        lookups = LookupExecutor(deadline) \
+            .add('project', lambda: octo.find_project_by_name(project_name)) \
+            .add('channel', lambda project: octo.find_channel_by_name_on_project(project['Id'], channel_name), 'project') \
+            .add('release', lambda project: octo.get_release_by_version_name(project['Id'], release_version), 'project') \
+            .add('environment', lambda: octo.ensure_environment(environment_spec))
+        found = lookups.run()
+        project, channel, release = found['project'], found['channel'], found['release']
+        environment_id, environment_created = found['environment']
+        timings = dict(lookups.timings)
+
+        self._timed(timings, deadline, 'add environment to lifecycle', octo.add_environment_to_lifecycle_on_phase,
+                    environment_id, channel['LifecycleId'], phase_name)
+        deployment = self._timed(timings, deadline, 'start deployment', octo.start_deployment,
+                                 release['Id'], environment_id)
+        return json.dumps({
+            'ProjectId': project['Id'],
+            'ChannelId': channel['Id'],
+            'LifecycleId': channel['LifecycleId'],
+            'ReleaseId': release['Id'],
+            'ReleaseVersion': release['Version'],
+            'EnvironmentId': environment_id,
+            'EnvironmentCreated': environment_created,
+            'TaskId': deployment['TaskId'],
+            'Timings': timings
+        })
+
+    def deprovision_sandbox(self, context, project_name, channel_name, phase_name, environment_name):
+        """
+        Undoes provision_sandbox in one command: removes the environment from the optional targets of the channel
+        lifecycle phase and deletes it along with its machines
+        :param ResourceCommandContext context: the context the command runs on
+        :return: json with the ids involved, the machine deletion result and the seconds each step took
+        """
+        deadline = Deadline(DEFAULT_COMMAND_TIMEOUT, 'deprovision_sandbox')
+        cloudshell = self._get_cloudshell_api(context)
+        octo = self._get_octopus_server(context, cloudshell, deadline)
+        lookups = self._get_lifecycle_lookups(octo, deadline, project_name, channel_name, environment_name)
+        found = lookups.run()
+        project, channel, environment = found['project'], found['channel'], found['environment']
+        timings = dict(lookups.timings)
+
+        self._timed(timings, deadline, 'remove environment from lifecycle',
+                    octo.remove_environment_from_lifecycle_on_phase,
+                    environment['Id'], channel['LifecycleId'], phase_name)
+        machines_result = self._timed(timings, deadline, 'delete environment', octo.delete_environment,
+                                      environment['Id'])
+        return json.dumps({
+            'ProjectId': project['Id'],
+            'ChannelId': channel['Id'],
+            'LifecycleId': channel['LifecycleId'],
+            'EnvironmentId': environment['Id'],
+            'Machines': machines_result.json,
+            'Timings': timings
+        })
+
+    def _get_lifecycle_lookups(self, octo, deadline, project_name, channel_name, environment_name):
+        return LookupExecutor(deadline) \
+            .add('project', lambda: octo.find_project_by_name(project_name)) \
+            .add('channel', lambda project: octo.find_channel_by_name_on_project(project['Id'], channel_name), 'project') \
+            .add('environment', lambda: octo.find_environment_by_name(environment_name))
+
+    def _timed(self, timings, deadline, step_name, func, *args):
+        started = time.time()
+        with deadline.step(step_name):
+            result = func(*args)
+        timings[step_name] = round(time.time() - started, 3)
+        return result
+
+    def _get_task_status(self, task):
+        return {
+            'TaskId': task['Id'],
+            'State': task.get('State'),
+            'IsCompleted': task['IsCompleted'],
+            'FinishedSuccessfully': task.get('FinishedSuccessfully'),
+            'ErrorMessage': task.get('ErrorMessage')
+        }
+
     def get_channel_latest_release_version_name(self, context, project_name, channel_name):
         cloudshell = self._get_cloudshell_api(context)
         octo = self._get_octopus_server(context, cloudshell)
@@ -103,20 +352,16 @@ class OctopusDeployOrchestratorDriver(ResourceDriverInterface):
     def add_environment_to_optional_targets_of_lifecycle(self, context, project_name, channel_name, environment_name, phase_name):
         cloudshell = self._get_cloudshell_api(context)
         octo = self._get_octopus_server(context, cloudshell)
-        project = octo.find_project_by_name(project_name)
-        channel = octo.find_channel_by_name_on_project(project['Id'], channel_name)
-        lifecycle_id = channel['LifecycleId']
-        environment = octo.find_environment_by_name(environment_name)
-        octo.add_environment_to_lifecycle_on_phase(environment['Id'], lifecycle_id, phase_name)
+        found = self._get_lifecycle_lookups(octo, octo.deadline, project_name, channel_name, environment_name).run()
+        octo.add_environment_to_lifecycle_on_phase(found['environment']['Id'], found['channel']['LifecycleId'],
+                                                   phase_name)
 
     def remove_environment_from_optional_targets_of_lifecycle(self, context, project_name, channel_name, environment_name, phase_name):
         cloudshell = self._get_cloudshell_api(context)
         octo = self._get_octopus_server(context, cloudshell)
-        project = octo.find_project_by_name(project_name)
-        channel = octo.find_channel_by_name_on_project(project['Id'], channel_name)
-        lifecycle_id = channel['LifecycleId']
-        environment = octo.find_environment_by_name(environment_name)
-        octo.remove_environment_from_lifecycle_on_phase(environment['Id'], lifecycle_id, phase_name)
+        found = self._get_lifecycle_lookups(octo, octo.deadline, project_name, channel_name, environment_name).run()
+        octo.remove_environment_from_lifecycle_on_phase(found['environment']['Id'], found['channel']['LifecycleId'],
+                                                        phase_name)
 
     def create_and_deploy_release(self, context, project_name):
         return self._create_and_deploy_release(context, project_name)
@@ -226,21 +471,25 @@ class OctopusDeployOrchestratorDriver(ResourceDriverInterface):
         roles = self._parse_roles(machine_roles)
         cloudshell = self._get_cloudshell_api(context)
         octo = self._get_octopus_server(context, cloudshell)
-        machine = octo.find_machine_by_name(machine_name)
-        environment = octo.find_environment_by_name(environment_name)
-        octo.add_existing_machine_to_environment(machine['Id'], environment['Id'], roles)
+        found = self._get_machine_lookups(octo, machine_name, environment_name).run()
+        octo.add_existing_machine_to_environment(found['machine']['Id'], found['environment']['Id'], roles)
 
     def _remove_existing_machine_from_environment(self, context, machine_name, environment_name):
         cloudshell = self._get_cloudshell_api(context)
         octo = self._get_octopus_server(context, cloudshell)
-        environment = octo.find_environment_by_name(environment_name)
-        machine = octo.find_machine_by_name(machine_name)
+        found = self._get_machine_lookups(octo, machine_name, environment_name).run()
+        machine, environment = found['machine'], found['environment']
         if self._check_if_last_environment_machine_is_associated_with(environment, machine):
             return 'Could not remove {0} from {1}, a machine must be associated with at least one environment' \
                'and {1} was the last environment with which {0} was associated'.format(machine_name, environment_name)
         octo.remove_existing_machine_from_environment(machine['Id'], environment['Id'])
         return 'Removed {0} from {1}'
 
+    def _get_machine_lookups(self, octo, machine_name, environment_name):
+        return LookupExecutor(octo.deadline) \
+            .add('machine', lambda: octo.find_machine_by_name(machine_name)) \
+            .add('environment', lambda: octo.find_environment_by_name(environment_name))
+
     def _check_if_last_environment_machine_is_associated_with(self, environment, machine):
         return len(machine['EnvironmentIds']) == 1 and environment['Id'] in machine['EnvironmentIds']
 
@@ -255,22 +504,61 @@ class OctopusDeployOrchestratorDriver(ResourceDriverInterface):
                                sort_order=0,
                                use_guided_failure=False)
 
-    def _get_octopus_server(self, context, cloudshell):
+    def _get_poll_schedule(self, context):
+        return PollSchedule(
+            initial_interval=self._get_numeric_attribute(context, DEPLOYMENT_POLL_INTERVAL, DEFAULT_INITIAL_INTERVAL),
+            max_interval=self._get_numeric_attribute(context, DEPLOYMENT_MAX_POLL_INTERVAL, DEFAULT_MAX_INTERVAL),
+            timeout=self._get_numeric_attribute(context, DEPLOYMENT_TIMEOUT, DEFAULT_TIMEOUT))
+
+    def _get_numeric_attribute(self, context, attribute_name, default):
+        value = context.resource.attributes.get(attribute_name)
+        return float(value) if value else default
+
+    def _get_octopus_server(self, context, cloudshell, deadline=None):
+        provider_key = (context.connectivity.server_address, context.resource.attributes[OCTOPUS_DEPLOY_PROVIDER])
+        address, api_key = _octopus_providers.get(
+            provider_key, lambda: self._get_octopus_provider_details(context, cloudshell))
+
+        def renew_api_key():
+            # the cached key was rotated, read the provider again instead of failing until the entry expires
+            _octopus_providers.invalidate(provider_key)
+            return _octopus_providers.get(
+                provider_key, lambda: self._get_octopus_provider_details(context, cloudshell))[1]
         try:
-            octopus_server = cloudshell.GetResourceDetails(context.resource.attributes[OCTOPUS_DEPLOY_PROVIDER])
+            return OctopusServer(host=address, api_key=api_key, deadline=deadline or Deadline(DEFAULT_COMMAND_TIMEOUT),
+                                 renew_api_key=renew_api_key)
+        except Exception:
+            # the provider may have been moved or its key rotated, read it again next time
+            _octopus_providers.invalidate(provider_key)
+            raise
+
+    def _get_octopus_provider_details(self, context, cloudshell):
+        provider_name = context.resource.attributes[OCTOPUS_DEPLOY_PROVIDER]
+        try:
+            octopus_server = cloudshell.GetResourceDetails(provider_name)
         except Exception as e:
+            # a cached session may have expired on the server, do not hand it to the next command
+            self._invalidate_cloudshell_api(context)
             raise Exception('Could not find the Octopus Deploy Provider resource on Cloudshell.'
                             ' \nError details: \n{0}'.format(e.message))
         octopus_attributes = self._get_resource_attributes_as_dict(octopus_server.ResourceAttributes)
-        return OctopusServer(host=octopus_server.Address, api_key=octopus_attributes[OCTOPUS_API_KEY])
+        return octopus_server.Address, octopus_attributes[OCTOPUS_API_KEY]
 
     def _get_resource_attributes_as_dict(self, attributes_list):
         return {resource_attribute.Name: resource_attribute.Value for resource_attribute in attributes_list}
 
     def _get_cloudshell_api(self, context):
-        return CloudShellAPISession(host=context.connectivity.server_address,
-                                    token_id=context.connectivity.admin_auth_token,
-                                    domain=context.reservation.domain)
+        return _cloudshell_sessions.get(self._get_cloudshell_api_key(context),
+                                        lambda: CloudShellAPISession(host=context.connectivity.server_address,
+                                                                     token_id=context.connectivity.admin_auth_token,
+                                                                     domain=context.reservation.domain))
+
+    def _invalidate_cloudshell_api(self, context):
+        _cloudshell_sessions.invalidate(self._get_cloudshell_api_key(context))
+
+    def _get_cloudshell_api_key(self, context):
+        return (context.connectivity.server_address, context.connectivity.admin_auth_token,
+                context.reservation.domain)
 
     def cleanup(self):
         """
@@ -283,5 +571,5 @@ class OctopusDeployOrchestratorDriver(ResourceDriverInterface):
         cloudshell = self._get_cloudshell_api(context)
         octo = self._get_octopus_server(context, cloudshell)
         environment_id = octo.find_environment_by_name(environment_name)['Id']
-        if octo.delete_environment(environment_id):
-            return 'Environment deleted'
+        octo.delete_environment(environment_id)
+        return 'Environment deleted'
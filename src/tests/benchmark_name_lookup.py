@@ -0,0 +1,44 @@
+"""
+Compares looking environments up by name in a 10k environment catalog by downloading /api/environments/all
+(servers that ignore ?partialName=) with the server-side filtered lookup. The name index is cleared before
+every lookup, as it effectively is for the new environment each reservation creates.
+Run from src: python -m tests.benchmark_name_lookup
+"""
+import time
+
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer, named_collection
+
+CATALOG_SIZE = 10000
+LOOKUPS = 20
+
+
+def _measure(octo):
+    start = time.time()
+    for i in xrange(LOOKUPS):
+        octo.name_index.invalidate()
+        octo.find_environment_by_name('Sandbox {0}'.format(CATALOG_SIZE - i * 7))
+    return (time.time() - start) / LOOKUPS * 1000
+
+
+def main():
+    environments = [{'Id': 'Environments-{0}'.format(i), 'Name': 'Sandbox {0}'.format(i),
+                     'Description': 'Reservation {0}'.format(i), 'SortOrder': i, 'UseGuidedFailure': False}
+                    for i in xrange(1, CATALOG_SIZE + 1)]
+    unfiltered_stub = StubOctopusServer({'/api/environments': {'Items': environments[:30], 'Links': {}},
+                                         '/api/environments/all': environments}).start()
+    filtered_stub = StubOctopusServer({'/api/environments': named_collection('/api/environments', environments),
+                                       '/api/environments/all': environments}).start()
+    try:
+        all_ms = _measure(OctopusServer(unfiltered_stub.host, 'API-STUB'))
+        filtered_ms = _measure(OctopusServer(filtered_stub.host, 'API-STUB'))
+        print 'catalog size:            {0} environments'.format(CATALOG_SIZE)
+        print '/all download:           {0:.1f} ms/lookup'.format(all_ms)
+        print '?partialName= filter:    {0:.1f} ms/lookup'.format(filtered_ms)
+    finally:
+        unfiltered_stub.stop()
+        filtered_stub.stop()
+
+
+if __name__ == '__main__':
+    main()
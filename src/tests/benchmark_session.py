@@ -0,0 +1,48 @@
+"""
+Compares per-call latency of a fresh connection per request (module level requests.get, the
+pre-pooling behaviour) with the pooled keep-alive session OctopusServer uses.
+Run from src: python -m tests.benchmark_session
+"""
+import time
+from urlparse import urljoin
+
+import requests
+
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer
+
+CALLS = 500
+
+
+def _measure(call):
+    start = time.time()
+    for _ in xrange(CALLS):
+        call()
+    return (time.time() - start) / CALLS * 1000
+
+
+def main():
+    stub = StubOctopusServer({'/api/environments/Environments-1': {'Id': 'Environments-1'}}).start()
+    try:
+        api_url = urljoin(stub.host, '/api/environments/Environments-1')
+        rest_params = {'ApiKey': 'API-STUB'}
+
+        connections_before = stub.connections
+        unpooled_ms = _measure(lambda: requests.get(api_url, params=rest_params))
+        unpooled_connections = stub.connections - connections_before
+
+        connections_before = stub.connections
+        octo = OctopusServer(stub.host, rest_params['ApiKey'])
+        pooled_ms = _measure(lambda: octo.get_entity('/api/environments/Environments-1'))
+        pooled_connections = stub.connections - connections_before
+
+        print 'calls per run:           {0}'.format(CALLS)
+        print 'requests.get (no pool):  {0:.3f} ms/call, {1} connections'.format(unpooled_ms, unpooled_connections)
+        print 'OctopusServer (pooled):  {0:.3f} ms/call, {1} connections'.format(pooled_ms, pooled_connections)
+        octo._http_session.close()
+    finally:
+        stub.stop()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,129 @@
+import json
+import socket
+import threading
+from urlparse import parse_qs
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from SocketServer import ThreadingMixIn
+
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # keep-alive connections still open at shutdown are expected, not worth a traceback
+        pass
+
+
+def named_collection(path, entities, default_take=30):
+    """
+    Route answering a paged Octopus listing that honours ?partialName=, like /api/environments
+    :param path: the route path, used in Page.Next links
+    :param entities: the whole collection, read on every request so tests can change it
+    :type entities: list[dict]
+    """
+    def get_page(query, body):
+        partial_name = query.get('partialName', '').lower()
+        matches = [entity for entity in entities if partial_name in entity['Name'].lower()]
+        skip = int(query.get('skip', 0))
+        take = int(query.get('take', default_take))
+        page = {'Items': matches[skip:skip + take], 'TotalResults': len(matches), 'Links': {}}
+        if skip + take < len(matches):
+            page['Links']['Page.Next'] = '{0}?skip={1}&take={2}&partialName={3}'.format(
+                path, skip + take, take, query.get('partialName', ''))
+        return page
+    return get_page
+
+
+class StubOctopusServer(object):
+    """
+    Minimal in-process Octopus Deploy API used by tests and benchmarks: answers requests from a dict of
+    routes over keep-alive HTTP/1.1 connections on a free local port
+    """
+    def __init__(self, routes=None):
+        """
+        :param routes: maps 'METHOD /path' (or just '/path' for GET), without query string, to the object
+        returned as json, or to a callable receiving the query string as a dict and the parsed json body and
+        returning either that object or a (status code, object) tuple
+        :type routes: dict
+        """
+        self.routes = routes if routes is not None else {}
+        self.routes.setdefault('/', {'Application': 'Octopus Deploy'})
+        self.connections = 0
+        self.requests = []
+        self._open_connections = []
+        self._server = _ThreadingHTTPServer(('127.0.0.1', 0), self._get_handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={'poll_interval': 0.05})
+        self._thread.daemon = True
+
+    @property
+    def host(self):
+        return 'http://127.0.0.1:{0}'.format(self._server.server_address[1])
+
+    def start(self):
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._server.shutdown()
+        self._server.server_close()
+        # release handler threads still waiting on keep-alive connections held by pooled clients
+        for connection in self._open_connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+
+    def _get_handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            # buffer headers and body into a single send so delayed ACKs don't stall keep-alive clients
+            wbufsize = -1
+
+            def setup(self):
+                BaseHTTPRequestHandler.setup(self)
+                stub.connections += 1
+                stub._open_connections.append(self.connection)
+
+            def do_GET(self):
+                self._handle()
+
+            def do_POST(self):
+                self._handle()
+
+            def do_PUT(self):
+                self._handle()
+
+            def do_DELETE(self):
+                self._handle()
+
+            def _handle(self):
+                path, _, query = self.path.partition('?')
+                stub.requests.append('{0} {1}'.format(self.command, self.path))
+                content_length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(content_length)) if content_length else None
+                route = '{0} {1}'.format(self.command, path)
+                if route not in stub.routes and self.command == 'GET':
+                    route = path
+                if route not in stub.routes:
+                    self._reply(404, json.dumps({'ErrorMessage': 'Not found'}))
+                    return
+                status_code, payload = 200, stub.routes[route]
+                if callable(payload):
+                    payload = payload({key: values[-1] for key, values in parse_qs(query).items()}, body)
+                if isinstance(payload, tuple):
+                    status_code, payload = payload
+                self._reply(status_code, json.dumps(payload))
+
+            def _reply(self, status_code, body):
+                self.send_response(status_code)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args):
+                pass
+
+        return Handler
@@ -0,0 +1,100 @@
+import unittest
+
+from cloudshell.octopus.retry import RetryPolicy
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer
+
+
+class DeleteEnvironmentTest(unittest.TestCase):
+    def setUp(self):
+        self.machines = {'Machines-1', 'Machines-2', 'Machines-3'}
+        self.routes = {
+            '/api/machines': self._get_machines,
+            '/api/environments/Environments-1/machines': {'Items': [{'Id': 'Machines-1'}, {'Id': 'Machines-2'},
+                                                                    {'Id': 'Machines-3'}], 'Links': {}},
+            'DELETE /api/machines/Machines-1': {},
+            'DELETE /api/machines/Machines-2': lambda query, body: (404, {'ErrorMessage': 'Not found'}),
+            'DELETE /api/machines/Machines-3': {},
+            'DELETE /api/environments/Environments-1': {},
+        }
+        self.stub = StubOctopusServer(self.routes).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB', retry_policy=RetryPolicy(base_delay=0.001))
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _get_machines(self, query, body):
+        return {'Items': [{'Id': machine_id} for machine_id in query['ids'].split(',') if machine_id in self.machines],
+                'Links': {}}
+
+    def test_deletes_machines_without_probing_and_tolerates_missing_ones(self):
+        machines_result = self.octo.delete_environment('Environments-1')
+        self.assertEqual(sorted(machines_result.succeeded), ['Machines-1', 'Machines-2', 'Machines-3'])
+        self.assertFalse([request for request in self.stub.requests if request.startswith('GET /api/machines')])
+        self.assertIn('DELETE /api/environments/Environments-1?ApiKey=API-STUB', self.stub.requests)
+
+    def test_keeps_environment_when_a_machine_fails_to_delete(self):
+        self.routes['DELETE /api/machines/Machines-3'] = lambda query, body: (500, {'ErrorMessage': 'Busy'})
+        self.assertRaises(Exception, self.octo.delete_environment, 'Environments-1')
+        self.assertNotIn('DELETE /api/environments/Environments-1?ApiKey=API-STUB', self.stub.requests)
+
+    def test_failed_deletion_of_a_machine_that_is_gone_counts_as_deleted(self):
+        def delete_then_fail(query, body):
+            self.machines.discard('Machines-3')
+            return 400, {'ErrorMessage': 'Deletion interrupted'}
+        self.routes['DELETE /api/machines/Machines-3'] = delete_then_fail
+        self.routes['DELETE /api/machines/Machines-1'] = lambda query, body: (400, {'ErrorMessage': 'In use'})
+        try:
+            self.octo.delete_environment('Environments-1')
+            self.fail('delete_environment should fail when a machine could not be deleted')
+        except Exception as e:
+            self.assertIn('Machines-1', str(e))
+            self.assertNotIn('Machines-3', str(e))
+        self.assertEqual(len([r for r in self.stub.requests if r.startswith('GET /api/machines?')]), 1)
+
+    def test_failed_recheck_reports_the_failed_machines(self):
+        self.routes['DELETE /api/machines/Machines-1'] = lambda query, body: (400, {'ErrorMessage': 'In use'})
+        self.routes['/api/machines'] = lambda query, body: (400, {'ErrorMessage': 'Bad filter'})
+        try:
+            self.octo.delete_environment('Environments-1')
+            self.fail('delete_environment should fail when a machine could not be deleted')
+        except Exception as e:
+            self.assertIn('Machines-1', str(e))
+            self.assertIn('In use', str(e))
+
+
+class DeleteChannelTest(unittest.TestCase):
+    def setUp(self):
+        self.routes = {
+            '/api/releases': lambda query, body: {'Items': [{'Id': 'Releases-7'}], 'Links': {}},
+            '/api/channels/Channels-1/releases': self._get_releases_page,
+            'DELETE /api/channels/Channels-1': {},
+        }
+        for i in range(45):
+            self.routes['DELETE /api/releases/Releases-{0}'.format(i)] = {}
+        self.stub = StubOctopusServer(self.routes).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB', retry_policy=RetryPolicy(base_delay=0.001))
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _get_releases_page(self, query, body):
+        skip = int(query.get('skip', 0))
+        page = {'Items': [{'Id': 'Releases-{0}'.format(i)} for i in range(skip, min(skip + 30, 45))], 'Links': {}}
+        if skip + 30 < 45:
+            page['Links']['Page.Next'] = '/api/channels/Channels-1/releases?skip={0}&take=30'.format(skip + 30)
+        return page
+
+    def test_deletes_releases_of_every_page(self):
+        releases_result = self.octo.delete_channel('Channels-1')
+        self.assertEqual(len(releases_result.succeeded), 45)
+        self.assertEqual(releases_result.failed, {})
+
+    def test_reports_failed_releases(self):
+        self.routes['DELETE /api/releases/Releases-7'] = lambda query, body: (500, {'ErrorMessage': 'Busy'})
+        try:
+            self.octo.delete_channel('Channels-1')
+            self.fail('delete_channel should fail when a release could not be deleted')
+        except Exception as e:
+            self.assertIn('Releases-7', str(e))
+        self.assertNotIn('DELETE /api/channels/Channels-1?ApiKey=API-STUB', self.stub.requests)
@@ -0,0 +1,74 @@
+import unittest
+
+from cloudshell.octopus.retry import RetryPolicy
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer
+
+
+class StubMachines(object):
+    def __init__(self, machines):
+        self.machines = {machine['Id']: machine for machine in machines}
+        self.puts = []
+
+    def routes(self):
+        routes = {'/api/machines': self.get_many}
+        for machine_id in self.machines:
+            routes['/api/machines/' + machine_id] = self._get(machine_id)
+            routes['PUT /api/machines/' + machine_id] = self._put(machine_id)
+        return routes
+
+    def get_many(self, query, body):
+        return {'Items': [self.machines[machine_id] for machine_id in query['ids'].split(',')
+                          if machine_id in self.machines], 'Links': {}}
+
+    def _get(self, machine_id):
+        return lambda query, body: self.machines[machine_id]
+
+    def _put(self, machine_id):
+        def put(query, body):
+            self.puts.append(machine_id)
+            self.machines[machine_id] = body
+            return body
+        return put
+
+
+class BulkMachinesTest(unittest.TestCase):
+    def setUp(self):
+        self.machines = StubMachines([
+            {'Id': 'Machines-1', 'EnvironmentIds': ['Environments-1'], 'Roles': ['web']},
+            {'Id': 'Machines-2', 'EnvironmentIds': ['Environments-1', 'Environments-2'], 'Roles': ['web', 'api']},
+            {'Id': 'Machines-3', 'EnvironmentIds': ['Environments-2'], 'Roles': ['db']},
+        ])
+        self.stub = StubOctopusServer(self.machines.routes()).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB', retry_policy=RetryPolicy(base_delay=0.001))
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_add_writes_only_changed_machines(self):
+        result = self.octo.add_existing_machines_to_environment({
+            'Machines-1': ['web', 'api', 'api'],
+            'Machines-2': ['api'],
+            'Machines-404': ['web'],
+        }, 'Environments-2')
+        self.assertEqual(result.succeeded, ['Machines-1'])
+        self.assertEqual(result.skipped, ['Machines-2'])
+        self.assertEqual(result.failed.keys(), ['Machines-404'])
+        self.assertEqual(self.machines.puts, ['Machines-1'])
+        self.assertEqual(self.machines.machines['Machines-1']['Roles'], ['web', 'api'])
+        self.assertEqual(self.machines.machines['Machines-1']['EnvironmentIds'], ['Environments-1', 'Environments-2'])
+        self.assertEqual(len([r for r in self.stub.requests if r.startswith('GET /api/machines?')]), 1)
+
+    def test_remove_skips_absent_machines_and_keeps_last_environment(self):
+        result = self.octo.remove_existing_machines_from_environment(['Machines-1', 'Machines-2', 'Machines-3'],
+                                                                     'Environments-2')
+        self.assertEqual(result.succeeded, ['Machines-2'])
+        self.assertEqual(result.skipped, ['Machines-1'])
+        self.assertIn('at least one environment', result.failed['Machines-3'])
+        self.assertEqual(self.machines.puts, ['Machines-2'])
+
+    def test_single_add_does_not_duplicate_roles_or_write_unchanged_machines(self):
+        self.octo.add_existing_machine_to_environment('Machines-2', 'Environments-2', ['web'])
+        self.assertEqual(self.machines.puts, [])
+        self.octo.add_existing_machine_to_environment('Machines-3', 'Environments-1', ['db', 'cache'])
+        self.assertEqual(self.machines.machines['Machines-3']['Roles'], ['db', 'cache'])
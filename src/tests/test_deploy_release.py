@@ -0,0 +1,67 @@
+import unittest
+
+from cloudshell.octopus.deadline import Deadline, DeadlineExceeded
+from cloudshell.octopus.poll_schedule import PollSchedule
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer
+
+
+class DeployReleaseTest(unittest.TestCase):
+    def setUp(self):
+        self.task_polls = 0
+        self.stub = StubOctopusServer({
+            'POST /api/deployments': {'Id': 'Deployments-2', 'TaskId': 'ServerTasks-2',
+                                      'Links': {'Task': '/api/tasks/ServerTasks-2',
+                                                'Release': '/api/releases/Releases-1'}},
+            '/api/tasks/ServerTasks-2': self._get_task,
+            '/api/releases/Releases-1/deployments': {'Items': [{'Links': {'Task': '/api/tasks/ServerTasks-1'}}]},
+        }).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB')
+        del self.stub.requests[:]
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _get_task(self, query, body):
+        self.task_polls += 1
+        return {'Id': 'ServerTasks-2', 'IsCompleted': self.task_polls >= 3}
+
+    def test_waits_only_on_the_created_deployment_task(self):
+        schedule = PollSchedule(initial_interval=0.01, max_interval=0.01, timeout=5)
+        self.octo.deploy_release('Releases-1', 'Environments-1', schedule)
+        self.assertEqual(self.stub.requests, ['POST /api/deployments?ApiKey=API-STUB'] +
+                         ['GET /api/tasks/ServerTasks-2?ApiKey=API-STUB'] * 3)
+
+    def test_times_out_when_task_does_not_complete(self):
+        schedule = PollSchedule(initial_interval=0.01, max_interval=0.01, timeout=0)
+        self.assertRaises(Exception, self.octo.deploy_release, 'Releases-1', 'Environments-1', schedule)
+
+
+class DeadlineTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubOctopusServer({
+            'POST /api/deployments': {'Id': 'Deployments-2', 'TaskId': 'ServerTasks-2',
+                                      'Links': {'Task': '/api/tasks/ServerTasks-2'}},
+            '/api/tasks/ServerTasks-2': {'Id': 'ServerTasks-2', 'IsCompleted': False},
+        }).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB')
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_poll_loop_stops_at_deadline_naming_the_step(self):
+        self.octo.deadline = Deadline(0.2, 'deploy_environment_to_release')
+        schedule = PollSchedule(initial_interval=0.05, max_interval=0.05, timeout=60)
+        with self.octo.deadline.step('deploy release 1.0'):
+            try:
+                self.octo.deploy_release('Releases-1', 'Environments-1', schedule)
+                self.fail('deploy_release should run out of time')
+            except DeadlineExceeded as e:
+                self.assertIn('deploy_environment_to_release', str(e))
+                self.assertIn('deploy release 1.0', str(e))
+
+    def test_spent_deadline_fails_before_calling_octopus(self):
+        self.octo.deadline = Deadline(0)
+        del self.stub.requests[:]
+        self.assertRaises(DeadlineExceeded, self.octo.get_task, 'ServerTasks-2')
+        self.assertEqual(self.stub.requests, [])
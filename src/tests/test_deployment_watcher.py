@@ -0,0 +1,108 @@
+import threading
+import time
+import unittest
+
+from cloudshell.octopus.deadline import Deadline, DeadlineExceeded
+from cloudshell.octopus.deployment_watcher import DeploymentWatcher, get_deployment_watcher
+from cloudshell.octopus.poll_schedule import PollSchedule
+
+FAST_POLLS = PollSchedule(initial_interval=0.01, max_interval=0.01, jitter=0)
+
+
+class FakeOctopusServer(object):
+    def __init__(self, tasks, host_key='http://octopus', deadline=None):
+        self.tasks = tasks
+        self.requests = []
+        self.host_key = host_key
+        self.rest_params = {'ApiKey': 'API-FAKE'}
+        self.deadline = deadline
+        self.error = None
+
+    def without_deadline(self):
+        octopus_server = FakeOctopusServer(self.tasks, self.host_key)
+        octopus_server.requests = self.requests
+        return octopus_server
+
+    def get_tasks(self, task_ids):
+        if self.deadline:
+            self.deadline.check('GET /api/tasks')
+        if self.error:
+            raise self.error
+        self.requests.append(sorted(task_ids))
+        return [dict(self.tasks[task_id], Id=task_id) for task_id in task_ids if task_id in self.tasks]
+
+
+class ManuallyTickedWatcher(DeploymentWatcher):
+    def _start_thread(self):
+        return 'ticked by the test'
+
+
+class DeploymentWatcherTest(unittest.TestCase):
+    def setUp(self):
+        self.octo = FakeOctopusServer({'ServerTasks-1': {'IsCompleted': False},
+                                       'ServerTasks-2': {'IsCompleted': False}})
+        self.watcher = DeploymentWatcher(self.octo, FAST_POLLS)
+
+    def test_refreshes_all_tasks_in_one_request_per_tick(self):
+        watcher = ManuallyTickedWatcher(self.octo)
+        watcher.watch('ServerTasks-1')
+        watcher.watch('ServerTasks-2')
+        watcher.tick()
+        self.assertEqual(self.octo.requests, [['ServerTasks-1', 'ServerTasks-2']])
+
+    def test_completes_futures_and_calls_callbacks(self):
+        completed = []
+        callback_called = threading.Event()
+        first = self.watcher.watch('ServerTasks-1', callback=lambda f: (completed.append(f.task_id),
+                                                                        callback_called.set()))
+        second = self.watcher.watch('ServerTasks-2')
+        self.octo.tasks['ServerTasks-1']['IsCompleted'] = True
+        self.assertTrue(first.result(timeout=5)['IsCompleted'])
+        callback_called.wait(5)
+        self.assertEqual(completed, ['ServerTasks-1'])
+        self.assertFalse(second.done())
+        self.octo.tasks['ServerTasks-2']['IsCompleted'] = True
+        self.assertTrue(second.result(timeout=5)['IsCompleted'])
+
+    def test_unknown_task_fails_its_future(self):
+        future = self.watcher.watch('ServerTasks-404')
+        self.assertRaises(Exception, future.result, 5)
+
+    def test_watching_same_task_twice_shares_future(self):
+        watcher = ManuallyTickedWatcher(self.octo)
+        self.assertIs(watcher.watch('ServerTasks-1'), watcher.watch('ServerTasks-1'))
+
+    def test_shared_watcher_outlives_the_deadline_of_its_first_caller(self):
+        first_caller = FakeOctopusServer(self.octo.tasks, 'http://expiring-octopus', Deadline(0.01))
+        get_deployment_watcher(first_caller)
+        time.sleep(0.02)
+        watcher = get_deployment_watcher(FakeOctopusServer(self.octo.tasks, 'http://expiring-octopus'))
+        future = watcher.watch('ServerTasks-1', poll_schedule=FAST_POLLS)
+        self.octo.tasks['ServerTasks-1']['IsCompleted'] = True
+        self.assertTrue(future.result(timeout=5)['IsCompleted'])
+        self.assertRaises(DeadlineExceeded, first_caller.get_tasks, ['ServerTasks-1'])
+
+    def test_timed_out_waiter_gets_the_last_refresh_error(self):
+        self.octo.error = Exception('401 Unauthorized')
+        future = self.watcher.watch('ServerTasks-1')
+        self.assertRaisesRegexp(Exception, 'last error refreshing it: 401 Unauthorized', future.result, 0.1)
+
+    def test_each_task_is_polled_on_its_own_schedule(self):
+        watcher = ManuallyTickedWatcher(self.octo)
+        watcher.watch('ServerTasks-1', poll_schedule=PollSchedule(initial_interval=0.001, jitter=0))
+        watcher.watch('ServerTasks-2', poll_schedule=PollSchedule(initial_interval=60, jitter=0))
+        watcher.tick()
+        time.sleep(0.01)
+        watcher.tick()
+        self.assertEqual(self.octo.requests, [['ServerTasks-1', 'ServerTasks-2'], ['ServerTasks-1']])
+
+    def test_polls_of_a_task_back_off(self):
+        watcher = ManuallyTickedWatcher(self.octo)
+        future = watcher.watch('ServerTasks-1', poll_schedule=PollSchedule(initial_interval=10, max_interval=30,
+                                                                           backoff_factor=2, jitter=0))
+        delays = []
+        for _ in range(3):
+            future.next_poll_at = 0
+            watcher.tick()
+            delays.append(int(round(future.next_poll_at - time.time())))
+        self.assertEqual(delays, [10, 20, 30])
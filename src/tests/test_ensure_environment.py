@@ -0,0 +1,32 @@
+import unittest
+
+from cloudshell.octopus.environment_spec import EnvironmentSpec
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer, named_collection
+
+
+class EnsureEnvironmentTest(unittest.TestCase):
+    def setUp(self):
+        self.environments = [{'Id': 'Environments-1', 'Name': 'existing'}]
+        self.stub = StubOctopusServer({
+            '/api/environments': named_collection('/api/environments', self.environments),
+            'POST /api/environments': self._create_environment,
+        }).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB')
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _create_environment(self, query, body):
+        environment = {'Id': 'Environments-2', 'Name': body['Name']}
+        self.environments.append(environment)
+        return environment
+
+    def test_existing_environment_is_not_created(self):
+        self.assertEqual(self.octo.ensure_environment(EnvironmentSpec('existing', '', 0)), ('Environments-1', False))
+        self.assertNotIn('POST /api/environments?ApiKey=API-STUB', self.stub.requests)
+
+    def test_missing_environment_is_created_once(self):
+        self.assertEqual(self.octo.ensure_environment(EnvironmentSpec('sandbox', '', 0)), ('Environments-2', True))
+        self.assertEqual(self.octo.ensure_environment(EnvironmentSpec('sandbox', '', 0)), ('Environments-2', False))
+        self.assertEqual(self.stub.requests.count('POST /api/environments?ApiKey=API-STUB'), 1)
@@ -0,0 +1,39 @@
+import unittest
+
+from cloudshell.octopus.session import OctopusServer, IDS_PER_REQUEST
+from tests.stub_octopus_server import StubOctopusServer
+
+MACHINES = {'Machines-{0}'.format(i): {'Id': 'Machines-{0}'.format(i),
+                                       'EnvironmentIds': ['Environments-1' if i % 2 else 'Environments-2']}
+            for i in range(1, 301)}
+
+
+def get_machines(query, body):
+    ids = query.get('ids', '').split(',')
+    return {'Items': [MACHINES[machine_id] for machine_id in ids if machine_id in MACHINES], 'Links': {}}
+
+
+class GetManyTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubOctopusServer({'/api/machines': get_machines}).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB')
+        del self.stub.requests[:]
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_fetches_ids_in_chunks(self):
+        machine_ids = ['Machines-{0}'.format(i) for i in range(1, 251)]
+        machines = self.octo.get_many('machines', machine_ids)
+        self.assertEqual([machine['Id'] for machine in machines], machine_ids)
+        self.assertEqual(len(self.stub.requests), (len(machine_ids) - 1) // IDS_PER_REQUEST + 1)
+
+    def test_existing_ids_leaves_out_missing(self):
+        existing = self.octo.existing_ids('machines', ['Machines-1', 'Machines-404', 'Machines-300'])
+        self.assertEqual(existing, {'Machines-1', 'Machines-300'})
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_single_existence_checks(self):
+        self.assertTrue(self.octo.machine_exists('Machines-1'))
+        self.assertFalse(self.octo.machine_exists('Machines-404'))
+        self.assertEqual([request.split('?')[0] for request in self.stub.requests], ['GET /api/machines'] * 2)
@@ -0,0 +1,36 @@
+import unittest
+
+from cloudshell.octopus.retry import RetryPolicy
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer
+
+VALIDATION_REQUEST = 'GET /'
+
+
+class HostValidationTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubOctopusServer({'/api/environments/Environments-1': {'Id': 'Environments-1'}}).start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_host_is_validated_once_per_process(self):
+        OctopusServer(self.stub.host, 'API-STUB')
+        OctopusServer(self.stub.host, 'API-STUB')
+        self.assertEqual(self.stub.requests.count(VALIDATION_REQUEST), 1)
+
+    def test_lazy_validation_happens_on_first_call(self):
+        octo = OctopusServer(self.stub.host, 'API-STUB', lazy_validation=True)
+        self.assertEqual(self.stub.requests, [])
+        octo.get_entity('/api/environments/Environments-1')
+        octo.get_entity('/api/environments/Environments-1')
+        self.assertEqual(self.stub.requests.count(VALIDATION_REQUEST), 1)
+        self.assertTrue(self.stub.requests[0].startswith(VALIDATION_REQUEST))
+
+    def test_unreachable_host_fails_clearly(self):
+        self.stub.stop()
+        try:
+            OctopusServer(self.stub.host, 'API-STUB', retry_policy=RetryPolicy(base_delay=0.001))
+            self.fail('an unreachable host should not validate')
+        except Exception as e:
+            self.assertIn('Could not reach', str(e))
@@ -0,0 +1,21 @@
+import unittest
+
+from cloudshell.octopus.session import get_http_session
+
+
+class HttpSessionPoolTest(unittest.TestCase):
+    def test_same_host_shares_session(self):
+        first = get_http_session('http://octopus.pool.test/api/environments')
+        second = get_http_session('HTTP://octopus.pool.test')
+        self.assertIs(first, second)
+
+    def test_different_hosts_get_different_sessions(self):
+        first = get_http_session('http://octopus-a.pool.test')
+        second = get_http_session('http://octopus-b.pool.test')
+        self.assertIsNot(first, second)
+
+    def test_pool_grows_to_largest_requested_size(self):
+        session = get_http_session('https://octopus-grow.pool.test', pool_size=2)
+        get_http_session('https://octopus-grow.pool.test', pool_size=20)
+        get_http_session('https://octopus-grow.pool.test', pool_size=5)
+        self.assertEqual(session.get_adapter('https://octopus-grow.pool.test')._pool_maxsize, 20)
@@ -0,0 +1,47 @@
+import unittest
+
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer
+
+RELEASES_PATH = '/api/channels/Channels-1/releases'
+
+
+def paged_releases(total, default_take=30):
+    def get_page(query, body):
+        skip = int(query.get('skip', 0))
+        take = int(query.get('take', default_take))
+        page = {'Items': [{'Id': 'Releases-{0}'.format(i)} for i in range(skip, min(skip + take, total))],
+                'Links': {}}
+        if skip + take < total:
+            page['Links']['Page.Next'] = '{0}?skip={1}&take={2}'.format(RELEASES_PATH, skip + take, take)
+        return page
+    return get_page
+
+
+class IterCollectionTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubOctopusServer({RELEASES_PATH: paged_releases(total=75)}).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB')
+        del self.stub.requests[:]
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_follows_next_page_links(self):
+        release_ids = [release['Id'] for release in self.octo.iter_collection(RELEASES_PATH)]
+        self.assertEqual(release_ids, ['Releases-{0}'.format(i) for i in range(75)])
+        self.assertEqual(len(self.stub.requests), 3)
+
+    def test_custom_page_size(self):
+        releases = list(self.octo.iter_collection(RELEASES_PATH, take=50, skip=10))
+        self.assertEqual(len(releases), 65)
+        self.assertEqual(len(self.stub.requests), 2)
+
+    def test_stops_fetching_when_consumer_stops(self):
+        release = next(self.octo.iter_collection(RELEASES_PATH))
+        self.assertEqual(release['Id'], 'Releases-0')
+        self.assertEqual(len(self.stub.requests), 1)
+
+    def test_latest_channel_release_requests_a_single_item(self):
+        self.assertEqual(self.octo.get_latest_channel_release('Channels-1')['Id'], 'Releases-0')
+        self.assertIn('take=1', self.stub.requests[0])
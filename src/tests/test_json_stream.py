@@ -0,0 +1,41 @@
+import json
+import unittest
+
+from cloudshell.octopus.json_stream import iter_json_array
+
+ENTITIES = [{'Id': 'Machines-{0}'.format(i), 'Name': u'web [{0}], "quoted" \\ \xe9 \u4e2d'.format(i), 'Port': 10933 + i,
+             'Roles': ['web', 'api'], 'Endpoint': {'Thumbprint': None, 'IsDisabled': False}} for i in range(20)]
+
+
+def in_chunks(document, size):
+    return (document[i:i + size] for i in xrange(0, len(document), size))
+
+
+class IterJsonArrayTest(unittest.TestCase):
+    def test_elements_survive_any_chunking(self):
+        document = json.dumps(ENTITIES, indent=2, ensure_ascii=False).encode('utf-8')
+        for size in (1, 2, 7, 64, len(document)):
+            self.assertEqual(list(iter_json_array(in_chunks(document, size))), ENTITIES)
+
+    def test_numbers_split_across_chunks(self):
+        self.assertEqual(list(iter_json_array(['[12', '34, 5', '6]'])), [1234, 56])
+
+    def test_empty_array(self):
+        self.assertEqual(list(iter_json_array([' [ ', ' ] '])), [])
+
+    def test_stops_reading_when_consumer_stops(self):
+        chunks_read = []
+
+        def chunks():
+            for chunk in in_chunks(json.dumps(ENTITIES), 100):
+                chunks_read.append(chunk)
+                yield chunk
+
+        first = next(iter_json_array(chunks()))
+        self.assertEqual(first, ENTITIES[0])
+        self.assertLess(len(chunks_read), 5)
+
+    def test_malformed_documents_raise(self):
+        self.assertRaises(ValueError, list, iter_json_array(['{"Items": []}']))
+        self.assertRaises(ValueError, list, iter_json_array(['[{"Id": 1}']))
+        self.assertRaises(ValueError, list, iter_json_array(['[{"Id": 1} {"Id": 2}]']))
@@ -0,0 +1,177 @@
+import copy
+import threading
+import time
+import unittest
+
+from cloudshell.octopus.deadline import Deadline, DeadlineExceeded
+from cloudshell.octopus.lifecycle_update import LifecycleOperation, LifecycleUpdateQueue, ADD, REMOVE
+from cloudshell.octopus.retry import RetryPolicy
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer
+
+LIFECYCLE_PATH = '/api/lifecycles/Lifecycles-1'
+
+
+class StubLifecycle(object):
+    def __init__(self):
+        self.document = {'Id': 'Lifecycles-1', 'Phases': [{'Name': 'Dev', 'OptionalDeploymentTargets': ['Environments-1']},
+                                                          {'Name': 'Test', 'OptionalDeploymentTargets': []}]}
+        self.puts = []
+        # responses for the next PUTs: 'conflict' answers 409, 'overwritten' accepts and then loses the write
+        self.next_puts = []
+
+    def get(self, query, body):
+        return self.document
+
+    def put(self, query, body):
+        self.puts.append(body)
+        outcome = self.next_puts.pop(0) if self.next_puts else 'ok'
+        if outcome == 'conflict':
+            return 409, {'ErrorMessage': 'Conflict'}
+        if outcome == 'ok':
+            self.document = body
+        return body
+
+    def targets(self, phase_name):
+        return [phase for phase in self.document['Phases'] if phase['Name'] == phase_name][0]['OptionalDeploymentTargets']
+
+
+class UpdateLifecycleTest(unittest.TestCase):
+    def setUp(self):
+        self.lifecycle = StubLifecycle()
+        self.stub = StubOctopusServer({LIFECYCLE_PATH: self.lifecycle.get,
+                                       'PUT ' + LIFECYCLE_PATH: self.lifecycle.put}).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB', retry_policy=RetryPolicy(base_delay=0.001))
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_batch_is_written_in_one_put(self):
+        self.octo.update_lifecycle('Lifecycles-1', [LifecycleOperation(ADD, 'Environments-2', 'Dev'),
+                                                    LifecycleOperation(ADD, 'Environments-3', 'Test'),
+                                                    LifecycleOperation(REMOVE, 'Environments-1', 'Dev')])
+        self.assertEqual(len(self.lifecycle.puts), 1)
+        self.assertEqual(self.lifecycle.targets('Dev'), ['Environments-2'])
+        self.assertEqual(self.lifecycle.targets('Test'), ['Environments-3'])
+
+    def test_unchanged_lifecycle_is_not_written(self):
+        self.octo.update_lifecycle('Lifecycles-1', [LifecycleOperation(ADD, 'Environments-1', 'Dev')])
+        self.assertEqual(self.lifecycle.puts, [])
+
+    def test_removing_an_environment_that_is_not_on_the_phase_fails(self):
+        self.assertRaisesRegexp(Exception, 'not a target of phase Test',
+                                self.octo.remove_environment_from_lifecycle_on_phase,
+                                'Environments-9', 'Lifecycles-1', 'Test')
+        self.assertEqual(self.lifecycle.puts, [])
+
+    def test_does_not_wait_after_the_last_attempt(self):
+        waits = []
+        self.octo._fit_in_deadline = lambda delay: waits.append(delay) or 0
+        self.lifecycle.next_puts = ['overwritten'] * 10
+        self.assertRaisesRegexp(Exception, 'kept being changed', self.octo.update_lifecycle, 'Lifecycles-1',
+                                [LifecycleOperation(ADD, 'Environments-2', 'Dev')])
+        self.assertEqual(len(self.lifecycle.puts), len(waits) + 1)
+
+    def test_conflicts_and_lost_writes_are_retried(self):
+        self.lifecycle.next_puts = ['conflict', 'overwritten']
+        self.octo.add_environment_to_lifecycle_on_phase('Environments-2', 'Lifecycles-1', 'Dev')
+        self.assertEqual(len(self.lifecycle.puts), 3)
+        self.assertEqual(self.lifecycle.targets('Dev'), ['Environments-1', 'Environments-2'])
+
+    def test_unknown_phase_fails(self):
+        self.assertRaisesRegexp(Exception, 'did not find phase Prod', self.octo.remove_environment_from_lifecycle_on_phase,
+                                'Environments-1', 'Lifecycles-1', 'Prod')
+
+
+class LifecycleUpdateQueueTest(unittest.TestCase):
+    def setUp(self):
+        self.queue = LifecycleUpdateQueue()
+        self.writes = []
+        self.first_write_started = threading.Event()
+        self.release_first_write = threading.Event()
+
+    def _write(self, lifecycle_id, operations):
+        self.writes.append([repr(operation) for operation in operations])
+        if len(self.writes) == 1:
+            self.first_write_started.set()
+            self.release_first_write.wait(5)
+        if any(operation.phase_name == 'Prod' for operation in operations):
+            raise Exception('did not find phase Prod')
+        return copy.copy(self.writes[-1])
+
+    def _submit_in_thread(self, environment_id, phase_name='Dev'):
+        outcome = {}
+
+        def submit():
+            try:
+                outcome['result'] = self.queue.submit(
+                    'Lifecycles-1', [LifecycleOperation(ADD, environment_id, phase_name)], self._write)
+            except Exception as e:
+                outcome['error'] = e
+        thread = threading.Thread(target=submit)
+        thread.start()
+        return thread, outcome
+
+    def _wait_for_next_batch(self, submitters):
+        deadline = time.time() + 5
+        while time.time() < deadline and len(getattr(self.queue._open_batches.get('Lifecycles-1'), 'submissions',
+                                                     [])) < submitters:
+            time.sleep(0.001)
+
+    def test_submissions_during_a_write_are_merged(self):
+        first, _ = self._submit_in_thread('Environments-1')
+        self.first_write_started.wait(5)
+        others = [self._submit_in_thread('Environments-{0}'.format(i)) for i in range(2, 6)]
+        self._wait_for_next_batch(4)
+        self.release_first_write.set()
+        for thread, outcome in [(first, None)] + others:
+            thread.join(5)
+        self.assertEqual(len(self.writes), 2)
+        self.assertEqual(len(self.writes[1]), 4)
+        self.assertEqual(others[0][1]['result'], self.writes[1])
+
+    def test_bad_operation_only_fails_its_submitter(self):
+        first, _ = self._submit_in_thread('Environments-1')
+        self.first_write_started.wait(5)
+        good_thread, good = self._submit_in_thread('Environments-2')
+        bad_thread, bad = self._submit_in_thread('Environments-3', 'Prod')
+        self._wait_for_next_batch(2)
+        self.release_first_write.set()
+        for thread in (first, good_thread, bad_thread):
+            thread.join(5)
+        self.assertIn('result', good)
+        self.assertIn('Prod', str(bad['error']))
+
+    def test_each_submitter_waits_under_its_own_deadline(self):
+        first, first_outcome = self._submit_in_thread('Environments-1')
+        self.first_write_started.wait(5)
+        self.assertRaises(DeadlineExceeded, self.queue.submit, 'Lifecycles-1',
+                          [LifecycleOperation(ADD, 'Environments-2', 'Dev')], self._write, Deadline(0.05))
+        self.release_first_write.set()
+        first.join(5)
+        self.assertIn('result', first_outcome)
+        # the submission that gave up is still written
+        deadline = time.time() + 5
+        while time.time() < deadline and self.queue.batches_written < 2:
+            time.sleep(0.001)
+        self.assertEqual(self.writes[1], ['add Environments-2 on phase Dev'])
+
+    def test_submissions_within_the_window_are_merged(self):
+        self.release_first_write.set()
+        submitters = [self._submit_in_thread('Environments-{0}'.format(i)) for i in range(1, 4)]
+        for thread, _ in submitters:
+            thread.join(5)
+        self.assertEqual(len(self.writes), 1)
+        self.assertEqual(len(self.writes[0]), 3)
+
+    def test_write_lock_is_dropped_once_the_lifecycle_is_written(self):
+        first, _ = self._submit_in_thread('Environments-1')
+        self.first_write_started.wait(5)
+        second, _ = self._submit_in_thread('Environments-2')
+        self._wait_for_next_batch(1)
+        self.assertIn('Lifecycles-1', self.queue._write_locks)
+        self.release_first_write.set()
+        first.join(5)
+        second.join(5)
+        self.assertEqual(len(self.writes), 2)
+        self.assertEqual(self.queue._write_locks, {})
@@ -0,0 +1,62 @@
+import threading
+import unittest
+
+from cloudshell.octopus.deadline import Deadline
+from cloudshell.octopus.lookup_executor import LookupExecutor
+
+
+class LookupExecutorTest(unittest.TestCase):
+    def test_dependent_lookup_gets_results_of_its_dependencies(self):
+        found = LookupExecutor() \
+            .add('project', lambda: {'Id': 'Projects-1'}) \
+            .add('channel', lambda project: 'channel of {0}'.format(project['Id']), 'project') \
+            .run()
+        self.assertEqual(found, {'project': {'Id': 'Projects-1'}, 'channel': 'channel of Projects-1'})
+
+    def test_independent_lookups_run_concurrently(self):
+        project_started = threading.Event()
+        environment_started = threading.Event()
+
+        def find_project():
+            project_started.set()
+            return environment_started.wait(5)
+
+        def find_environment():
+            environment_started.set()
+            return project_started.wait(5)
+
+        found = LookupExecutor().add('project', find_project).add('environment', find_environment).run()
+        self.assertEqual(found, {'project': True, 'environment': True})
+
+    def test_failure_stops_dependent_lookups_and_is_raised(self):
+        started = []
+
+        def find_project():
+            raise Exception('Project named missing was not found on Octopus Deploy')
+
+        executor = LookupExecutor() \
+            .add('project', find_project) \
+            .add('channel', lambda project: started.append('channel'), 'project')
+        self.assertRaisesRegexp(Exception, 'Project named missing', executor.run)
+        self.assertEqual(started, [])
+
+    def test_failure_skips_lookups_queued_for_a_thread(self):
+        started = []
+
+        def find_project():
+            raise Exception('Project named missing was not found on Octopus Deploy')
+
+        executor = LookupExecutor() \
+            .add('project', find_project) \
+            .add('environment', lambda: started.append('environment'))
+        self.assertRaisesRegexp(Exception, 'Project named missing', executor.run, 1)
+        self.assertEqual(started, [])
+
+    def test_lookups_run_as_deadline_steps(self):
+        deadline = Deadline(60)
+        executor = LookupExecutor(deadline).add('project', lambda: deadline.current_step)
+        self.assertEqual(executor.run(), {'project': 'find project'})
+        self.assertIn('project', executor.timings)
+
+    def test_dependencies_must_be_added_first(self):
+        self.assertRaises(ValueError, LookupExecutor().add, 'channel', lambda project: None, 'project')
@@ -0,0 +1,57 @@
+import unittest
+
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer, named_collection
+
+ENVIRONMENTS = [{'Id': 'Environments-{0}'.format(i), 'Name': 'sandbox-{0}'.format(i)} for i in range(1, 120)]
+
+
+class NameFilterTest(unittest.TestCase):
+    def setUp(self):
+        self.stub = StubOctopusServer({
+            '/api/environments': named_collection('/api/environments', ENVIRONMENTS),
+            '/api/environments/all': ENVIRONMENTS,
+        }).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB')
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _requested(self, path):
+        return [request for request in self.stub.requests if request.split('?')[0] == 'GET ' + path]
+
+    def test_lookup_matches_exactly_among_partial_matches(self):
+        # sandbox-1 also partially matches sandbox-10 .. sandbox-119
+        self.assertEqual(self.octo.find_environment_by_name('sandbox-1')['Id'], 'Environments-1')
+        self.assertEqual(self.octo.find_environment_by_name('sandbox-19')['Id'], 'Environments-19')
+        self.assertFalse(self._requested('/api/environments/all'))
+
+    def test_found_entity_is_indexed(self):
+        self.octo.find_environment_by_name('sandbox-7')
+        self.octo.find_environment_by_name('sandbox-7')
+        self.assertEqual(len(self._requested('/api/environments')), 1)
+
+    def test_missing_entity_is_not_found(self):
+        self.assertRaisesRegexp(Exception, 'Environment named other was not found',
+                                self.octo.find_environment_by_name, 'other')
+        self.assertFalse(self._requested('/api/environments/all'))
+
+
+class IgnoredNameFilterTest(unittest.TestCase):
+    def setUp(self):
+        # an older server lists the whole collection whatever the filter
+        self.stub = StubOctopusServer({
+            '/api/environments': {'Items': ENVIRONMENTS[:30], 'Links': {}},
+            '/api/environments/all': ENVIRONMENTS,
+        }).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB')
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def test_falls_back_to_all_and_remembers_it(self):
+        self.assertEqual(self.octo.find_environment_by_name('sandbox-50')['Id'], 'Environments-50')
+        self.octo.name_index.invalidate()
+        self.assertEqual(self.octo.find_environment_by_name('sandbox-60')['Id'], 'Environments-60')
+        filtered = [request for request in self.stub.requests if request.startswith('GET /api/environments?')]
+        self.assertEqual(len(filtered), 1)
@@ -0,0 +1,59 @@
+import unittest
+
+from cloudshell.octopus.name_index import NameIndex
+
+
+class EntityLoader(object):
+    def __init__(self, entities):
+        self.entities = entities
+        self.loads = []
+
+    def __call__(self, name):
+        def load_entity():
+            self.loads.append(name)
+            return self.entities.get(name)
+        return load_entity
+
+
+class NameIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.index = NameIndex(ttl=60)
+        self.loader = EntityLoader({'first': {'Id': 'Environments-1', 'Name': 'first'},
+                                    'second': {'Id': 'Environments-2', 'Name': 'second'}})
+
+    def find(self, name, index=None):
+        return (index or self.index).find_entity('environments', name, self.loader(name))
+
+    def test_repeated_lookups_load_each_entity_once(self):
+        self.assertEqual(self.find('first')['Id'], 'Environments-1')
+        self.assertEqual(self.find('first')['Id'], 'Environments-1')
+        self.assertEqual(self.find('second')['Id'], 'Environments-2')
+        self.assertEqual(self.loader.loads, ['first', 'second'])
+        self.assertEqual((self.index.hits, self.index.misses), (1, 2))
+
+    def test_unknown_name_is_loaded_again(self):
+        self.assertIsNone(self.find('third'))
+        self.assertIsNone(self.find('third'))
+        self.assertEqual(self.loader.loads, ['third', 'third'])
+
+    def test_invalidate_forces_reload(self):
+        self.find('first')
+        self.index.invalidate('environments')
+        self.find('first')
+        self.assertEqual(self.loader.loads, ['first', 'first'])
+
+    def test_invalidate_keeps_other_collections(self):
+        self.index.find_entity('projects', 'first', self.loader('first'))
+        self.index.invalidate('environments')
+        self.index.find_entity('projects', 'first', self.loader('first'))
+        self.assertEqual(self.loader.loads, ['first'])
+
+    def test_expired_entity_is_reloaded(self):
+        index = NameIndex(ttl=-1)
+        self.find('first', index)
+        self.find('first', index)
+        self.assertEqual(self.loader.loads, ['first', 'first'])
+
+    def test_returned_entities_do_not_alias_the_index(self):
+        self.find('first')['Name'] = 'changed'
+        self.assertEqual(self.find('first')['Name'], 'first')
@@ -0,0 +1,21 @@
+import unittest
+
+from cloudshell.octopus.poll_schedule import PollSchedule
+
+
+class PollScheduleTest(unittest.TestCase):
+    def setUp(self):
+        self.schedule = PollSchedule(initial_interval=2, max_interval=60, backoff_factor=2, jitter=0, timeout=1800)
+
+    def test_backs_off_exponentially_up_to_cap(self):
+        delays = [self.schedule.next_delay(poll_number, remaining=1800) for poll_number in range(7)]
+        self.assertEqual(delays, [2, 4, 8, 16, 32, 60, 60])
+
+    def test_never_sleeps_past_deadline(self):
+        self.assertEqual(self.schedule.next_delay(10, remaining=5), 5)
+
+    def test_jitter_stays_within_fraction(self):
+        schedule = PollSchedule(initial_interval=10, max_interval=10, jitter=0.2)
+        for _ in range(100):
+            self.assertTrue(8 <= schedule.next_delay(0, remaining=1800) <= 12)
+
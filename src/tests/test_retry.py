@@ -0,0 +1,129 @@
+import unittest
+
+from cloudshell.octopus.retry import RetryPolicy, CircuitBreaker, CircuitOpenError
+from cloudshell.octopus.session import OctopusServer
+from tests.stub_octopus_server import StubOctopusServer
+
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        self.policy = RetryPolicy(max_attempts=3, base_delay=1, max_delay=3, jitter=0)
+
+    def test_retries_only_idempotent_methods_on_transient_failures(self):
+        self.assertTrue(self.policy.should_retry('GET', 1, 503))
+        self.assertTrue(self.policy.should_retry('DELETE', 1, 429))
+        self.assertTrue(self.policy.should_retry('PUT', 1))
+        self.assertFalse(self.policy.should_retry('POST', 1, 503))
+        self.assertFalse(self.policy.should_retry('GET', 1, 404))
+        self.assertFalse(self.policy.should_retry('GET', 3, 503))
+
+    def test_exponential_delay_is_capped(self):
+        self.assertEqual([self.policy.delay(attempt) for attempt in (1, 2, 3, 4)], [1, 2, 3, 3])
+
+    def test_honors_retry_after(self):
+        self.assertEqual(self.policy.delay(1, retry_after='7'), 7)
+        self.assertEqual(self.policy.delay(1, retry_after='3600'), 60)
+
+
+class CircuitBreakerTest(unittest.TestCase):
+    def test_opens_after_consecutive_failures_and_allows_one_trial_after_timeout(self):
+        breaker = CircuitBreaker('octopus', failure_threshold=2, reset_timeout=0)
+        breaker.record_failure()
+        breaker.before_request()
+        breaker.record_failure()
+        self.assertTrue(breaker.is_open)
+        breaker.before_request()
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+        breaker.record_success()
+        self.assertFalse(breaker.is_open)
+
+    def test_released_trial_lets_the_next_call_be_the_trial(self):
+        breaker = CircuitBreaker('octopus', failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        breaker.before_request()
+        breaker.release_trial()
+        breaker.before_request()
+        self.assertTrue(breaker.is_open)
+
+    def test_fails_fast_while_open(self):
+        breaker = CircuitBreaker('octopus', failure_threshold=1, reset_timeout=60)
+        breaker.record_failure()
+        self.assertRaises(CircuitOpenError, breaker.before_request)
+
+
+class RequestRetryTest(unittest.TestCase):
+    def setUp(self):
+        self.failures_left = 2
+        self.stub = StubOctopusServer({
+            '/api/environments/Environments-1': self._flaky,
+            'POST /api/environments': self._flaky,
+        }).start()
+        self.octo = OctopusServer(self.stub.host, 'API-STUB', retry_policy=RetryPolicy(base_delay=0.001))
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _flaky(self, query, body):
+        if self.failures_left:
+            self.failures_left -= 1
+            return 503, {'ErrorMessage': 'Service Unavailable'}
+        return {'Id': 'Environments-1'}
+
+    def test_get_is_retried_until_it_succeeds(self):
+        self.assertEqual(self.octo.get_entity('/api/environments/Environments-1')['Id'], 'Environments-1')
+        self.assertEqual(self.failures_left, 0)
+
+    def test_post_is_not_retried(self):
+        result = self.octo._request('POST', self.stub.host + '/api/environments', json={})
+        self.assertEqual(result.status_code, 503)
+        self.assertEqual(self.failures_left, 1)
+
+    def test_unexpected_error_does_not_keep_the_circuit_open(self):
+        breaker = self.octo._circuit_breaker
+        breaker.failure_threshold, breaker.reset_timeout = 1, 0
+        breaker.record_failure()
+        def broken_request(*args, **kwargs):
+            raise ValueError('Broken response')
+
+        self.octo._http_session.request = broken_request
+        try:
+            self.assertRaises(ValueError, self.octo.get_entity, '/api/environments/Environments-1')
+        finally:
+            del self.octo._http_session.request
+        self.failures_left = 0
+        self.assertEqual(self.octo.get_entity('/api/environments/Environments-1')['Id'], 'Environments-1')
+        self.assertFalse(breaker.is_open)
+        breaker.failure_threshold, breaker.reset_timeout = 5, 30
+
+
+class RenewApiKeyTest(unittest.TestCase):
+    def setUp(self):
+        self.valid_api_key = 'API-NEW'
+        self.renewals = 0
+        self.stub = StubOctopusServer({'/api/environments/Environments-1': self._authenticated}).start()
+
+    def tearDown(self):
+        self.stub.stop()
+
+    def _authenticated(self, query, body):
+        if query.get('ApiKey') != self.valid_api_key:
+            return 401, {'ErrorMessage': 'Invalid API key'}
+        return {'Id': 'Environments-1'}
+
+    def _renew_api_key(self):
+        self.renewals += 1
+        return 'API-NEW'
+
+    def test_rejected_call_is_repeated_with_the_renewed_key(self):
+        octo = OctopusServer(self.stub.host, 'API-ROTATED', renew_api_key=self._renew_api_key)
+        self.assertEqual(octo.get_entity('/api/environments/Environments-1')['Id'], 'Environments-1')
+        self.assertEqual(octo.get_entity('/api/environments/Environments-1')['Id'], 'Environments-1')
+        self.assertEqual(self.renewals, 1)
+        self.assertEqual(octo.rest_params['ApiKey'], 'API-NEW')
+
+    def test_key_is_renewed_only_once(self):
+        self.valid_api_key = 'API-OTHER'
+        octo = OctopusServer(self.stub.host, 'API-ROTATED', renew_api_key=self._renew_api_key)
+        self.assertRaises(Exception, octo.get_entity, '/api/environments/Environments-1')
+        self.assertRaises(Exception, octo.get_entity, '/api/environments/Environments-1')
+        self.assertEqual(self.renewals, 1)
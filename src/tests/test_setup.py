@@ -0,0 +1,360 @@
+import imp
+import os
+import threading
+import time
+import unittest
+
+HELPERS_DIR = os.path.join(os.path.dirname(__file__), '..', 'cloudshell-orchestration-script', 'Default Sandbox Setup',
+                           'sandbox_scripts', 'helpers')
+stage_scheduler = imp.load_source('stage_scheduler', os.path.join(HELPERS_DIR, 'stage_scheduler.py'))
+app_pipeline = imp.load_source('app_pipeline', os.path.join(HELPERS_DIR, 'app_pipeline.py'))
+resource_helpers = imp.load_source('resource_helpers', os.path.join(HELPERS_DIR, 'resource_helpers.py'))
+operation_limiter = imp.load_source('operation_limiter', os.path.join(HELPERS_DIR, 'operation_limiter.py'))
+service_deployment = imp.load_source('service_deployment', os.path.join(HELPERS_DIR, 'service_deployment.py'))
+
+
+class StageSchedulerTest(unittest.TestCase):
+    def test_stages_get_results_of_their_dependencies(self):
+        results = stage_scheduler.StageScheduler() \
+            .add('reservation details', lambda: 'details') \
+            .add('deploy apps', lambda details: 'apps of ' + details, ['reservation details']) \
+            .run()
+        self.assertEqual(results['deploy apps'], 'apps of details')
+
+    def test_independent_stages_run_concurrently(self):
+        connectivity_started = threading.Event()
+        octopus_started = threading.Event()
+
+        def prepare_connectivity():
+            connectivity_started.set()
+            return octopus_started.wait(5)
+
+        def create_octopus_environment():
+            octopus_started.set()
+            return connectivity_started.wait(5)
+
+        results = stage_scheduler.StageScheduler() \
+            .add('prepare connectivity', prepare_connectivity) \
+            .add('create octopus environment', create_octopus_environment) \
+            .run()
+        self.assertEqual(results, {'prepare connectivity': True, 'create octopus environment': True})
+
+    def test_failed_stage_stops_its_dependents(self):
+        started = []
+
+        def deploy_apps():
+            raise Exception('Deployment failed')
+
+        scheduler = stage_scheduler.StageScheduler() \
+            .add('deploy apps', deploy_apps) \
+            .add('autoload', lambda _: started.append('autoload'), ['deploy apps'])
+        self.assertRaisesRegexp(Exception, 'Deployment failed', scheduler.run)
+        self.assertEqual(started, [])
+
+    def test_failed_stage_skips_stages_queued_for_a_thread(self):
+        started = []
+
+        def deploy_apps():
+            raise Exception('Deployment failed')
+
+        scheduler = stage_scheduler.StageScheduler() \
+            .add('deploy apps', deploy_apps) \
+            .add('prepare connectivity', lambda: started.append('prepare connectivity'))
+        self.assertRaisesRegexp(Exception, 'Deployment failed', scheduler.run, 1)
+        self.assertEqual(started, [])
+        self.assertTrue(scheduler.failed.is_set())
+
+    def test_critical_path_follows_the_dependency_that_finished_last(self):
+        scheduler = stage_scheduler.StageScheduler() \
+            .add('a', lambda: None) \
+            .add('b', lambda: None) \
+            .add('c', lambda *_: None, ['a', 'b'])
+        scheduler.run()
+        scheduler.started_at.update({'a': 0, 'b': 0, 'c': 5})
+        scheduler.finished_at.update({'a': 2, 'b': 5, 'c': 6})
+        self.assertEqual(scheduler.critical_path(), [('b', 5), ('c', 1)])
+        self.assertEqual(scheduler.format_critical_path(), 'b 5.0s -> c 1.0s (6.0s total)')
+
+
+class DeployedApp(object):
+    def __init__(self, app_name, success=True):
+        self.AppName = app_name
+        self.Success = success
+        self.AppDeploymentyInfo = type('AppDeploymentyInfo', (object,), {'LogicalResourceName': app_name + '_1'})
+
+
+def deploy_result(app_names, success=True):
+    return app_pipeline.PipelineDeployResult([DeployedApp(app_name, success) for app_name in app_names])
+
+
+class AppPipelineTest(unittest.TestCase):
+    def test_deployed_app_goes_on_while_other_chunks_deploy(self):
+        slow_chunk_deployed = threading.Event()
+        installed = []
+
+        def deploy(app_names):
+            if app_names == ['slow']:
+                slow_chunk_deployed.wait(5)
+            return deploy_result(app_names)
+
+        def install(deployed_app, _):
+            installed.append(deployed_app.AppName)
+            if deployed_app.AppName == 'fast':
+                slow_chunk_deployed.set()
+
+        pipeline = app_pipeline.AppPipeline(deploy, [('install', install)]).start(['slow', 'fast'])
+        self.assertEqual(pipeline.join(), {})
+        self.assertEqual(installed, ['fast', 'slow'])
+        self.assertItemsEqual([item.AppName for item in pipeline.wait_deployed().ResultItems], ['slow', 'fast'])
+
+    def test_apps_are_deployed_in_chunks(self):
+        chunks = []
+
+        def deploy(app_names):
+            chunks.append(app_names)
+            return deploy_result(app_names)
+
+        app_pipeline.AppPipeline(deploy, [], chunk_size=2).start(['a', 'b', 'c']).join()
+        self.assertItemsEqual(chunks, [['a', 'b'], ['c']])
+
+    def test_app_stops_at_failed_step(self):
+        steps_run = []
+
+        def power_on(deployed_app, _):
+            steps_run.append(('power on', deployed_app.AppName))
+            if deployed_app.AppName == 'b':
+                raise Exception('Error powering on deployed app b_1')
+
+        def install(deployed_app, _):
+            steps_run.append(('install', deployed_app.AppName))
+
+        pipeline = app_pipeline.AppPipeline(lambda app_names: deploy_result(app_names),
+                                            [('power on', power_on), ('install', install)]).start(['a', 'b'])
+        pipeline.wait_step('install')
+        errors = pipeline.join()
+        self.assertEqual(errors.keys(), ['b_1'])
+        self.assertEqual(errors['b_1'].message, 'Error powering on deployed app b_1')
+        self.assertNotIn(('install', 'b'), steps_run)
+        self.assertIn(('install', 'a'), steps_run)
+
+    def test_apps_that_failed_to_deploy_skip_the_steps(self):
+        steps_run = []
+        pipeline = app_pipeline.AppPipeline(lambda app_names: deploy_result(app_names, success=False),
+                                            [('install', lambda deployed_app, _: steps_run.append(deployed_app))])
+        self.assertEqual(pipeline.start(['a']).join(), {})
+        self.assertEqual(steps_run, [])
+
+    def test_deployment_error_is_raised_once_all_chunks_are_done(self):
+        def deploy(app_names):
+            if app_names == ['a']:
+                raise Exception('Deployment failed')
+            return deploy_result(app_names)
+
+        pipeline = app_pipeline.AppPipeline(deploy, []).start(['a', 'b'])
+        self.assertRaisesRegexp(Exception, 'Deployment failed', pipeline.wait_deployed)
+
+    def test_deployment_error_stops_the_steps_and_waits_for_the_running_ones(self):
+        c_powering_on = threading.Event()
+        steps_run = []
+
+        def deploy(app_names):
+            if app_names == ['a']:
+                c_powering_on.wait(5)
+                raise Exception('Deployment failed')
+            if app_names == ['b']:
+                pipeline.failed.wait(5)
+            return deploy_result(app_names)
+
+        def power_on(deployed_app, _):
+            c_powering_on.set()
+            pipeline.failed.wait(5)
+            steps_run.append(('power on', deployed_app.AppName))
+
+        def install(deployed_app, _):
+            steps_run.append(('install', deployed_app.AppName))
+
+        pipeline = app_pipeline.AppPipeline(deploy, [('power on', power_on), ('install', install)])
+        pipeline.start(['a', 'b', 'c'])
+        self.assertRaisesRegexp(Exception, 'Deployment failed', pipeline.wait_deployed)
+        self.assertEqual(steps_run, [('power on', 'c')])
+
+
+class ResourceDetailsCacheTest(unittest.TestCase):
+    def test_cached_details_are_not_fetched_again(self):
+        cache = {}
+        api = type('Api', (object,), {'GetResourceDetails': lambda self, name: 'fetched ' + name})()
+        resource_helpers.add_resource_details_to_cache('app_1', 'cached app_1', cache)
+        self.assertEqual(resource_helpers.get_resource_details_from_cache_or_server(api, 'app_1', cache),
+                         'cached app_1')
+        self.assertEqual(resource_helpers.get_resource_details_from_cache_or_server(api, 'app_2', cache),
+                         'fetched app_2')
+
+    def test_cache_is_filled_from_several_threads(self):
+        cache = {}
+        threads = [threading.Thread(target=resource_helpers.add_resource_details_to_cache,
+                                    args=('app_{0}'.format(i), i, cache)) for i in range(20)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(cache), 20)
+
+
+class OperationLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.backoff = operation_limiter.THROTTLING_BACKOFF
+        operation_limiter.THROTTLING_BACKOFF = 0
+
+    def tearDown(self):
+        operation_limiter.THROTTLING_BACKOFF = self.backoff
+
+    def test_operations_of_a_group_are_limited(self):
+        lock = threading.Lock()
+        running = {'azure': 0, 'vcenter': 0}
+        most_running = {'azure': 0, 'vcenter': 0, 'total': 0}
+
+        def operation(group):
+            def run():
+                with lock:
+                    running[group] += 1
+                    most_running[group] = max(most_running[group], running[group])
+                    most_running['total'] = max(most_running['total'], sum(running.values()))
+                time.sleep(0.02)
+                with lock:
+                    running[group] -= 1
+            return run
+
+        limiter = operation_limiter.OperationLimiter(max_concurrent=3, max_concurrent_per_group=2)
+        threads = [threading.Thread(target=limiter.run, args=(group, 'power on', operation(group)))
+                   for group in ['azure', 'vcenter'] * 4]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertLessEqual(most_running['azure'], 2)
+        self.assertLessEqual(most_running['vcenter'], 2)
+        self.assertLessEqual(most_running['total'], 3)
+        self.assertEqual(limiter.metrics['power on']['calls'], 8)
+
+    def test_throttled_operation_is_tried_again_with_a_lower_limit(self):
+        calls = []
+
+        def power_on():
+            calls.append('power on')
+            if len(calls) == 1:
+                raise Exception('CloudShell API error 100: Too Many Requests')
+            return 'powered on'
+
+        limiter = operation_limiter.OperationLimiter(max_concurrent=10, max_concurrent_per_group=4)
+        self.assertEqual(limiter.run('azure', 'power on', power_on), 'powered on')
+        self.assertEqual(len(calls), 2)
+        self.assertEqual(limiter._get_group_slots('azure').limit, 2)
+        self.assertEqual(limiter._get_group_slots('vcenter').limit, 4)
+
+    def test_other_errors_are_not_tried_again(self):
+        calls = []
+
+        def install():
+            calls.append('install')
+            raise Exception('Installation script failed')
+
+        limiter = operation_limiter.OperationLimiter(max_concurrent=10, max_concurrent_per_group=4)
+        self.assertRaisesRegexp(Exception, 'Installation script failed', limiter.run, 'azure', 'install', install)
+        self.assertEqual(calls, ['install'])
+        self.assertEqual(limiter.metrics['install']['calls'], 1)
+
+    def test_throttling_is_recognized_by_status_and_provider_codes(self):
+        for message in ['HTTP Error 429: Too Many Requests', 'Request failed with status code: 429',
+                        'ThrottlingException: Rate exceeded', 'RequestLimitExceeded',
+                        'The server is busy, try again later', 'SubscriptionRequestsThrottled']:
+            self.assertTrue(operation_limiter.is_throttling_error(Exception(message)), message)
+        for message in ['Error powering on deployed app vm-429', 'Failed to allocate 4290 MB of memory',
+                        'CloudShell API error 429: Resource is reserved']:
+            self.assertFalse(operation_limiter.is_throttling_error(Exception(message)), message)
+
+    def test_operation_that_must_not_run_twice_is_only_tried_again_when_rejected(self):
+        calls = []
+
+        def install(error):
+            calls.append(error)
+            if len(calls) == 1:
+                raise Exception(error)
+            return 'installed'
+
+        limiter = operation_limiter.OperationLimiter(max_concurrent=10, max_concurrent_per_group=4)
+        self.assertRaisesRegexp(Exception, 'Throttling', limiter.run, 'aws', 'install', install,
+                                'Throttling: installation script was throttled',
+                                is_throttled=operation_limiter.is_rejected_error)
+        del calls[:]
+        self.assertEqual(limiter.run('aws', 'install', install, 'HTTP Error 429: Too Many Requests',
+                                     is_throttled=operation_limiter.is_rejected_error), 'installed')
+        self.assertEqual(len(calls), 2)
+
+    def test_limit_grows_back_while_operations_succeed(self):
+        limiter = operation_limiter.OperationLimiter(max_concurrent=10, max_concurrent_per_group=4)
+        slots = limiter._get_group_slots('azure')
+        slots.decrease()
+        for _ in range(2):
+            limiter.run('azure', 'refresh ip', lambda: None)
+        self.assertEqual(slots.limit, 3)
+
+
+class ServiceDeploymentTest(unittest.TestCase):
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.calls = []
+        self.failing = set()
+        self.blocked = {}
+
+    def _call(self, name):
+        if name in self.blocked:
+            self.blocked[name].wait(5)
+        with self.lock:
+            self.calls.append(name)
+        if name in self.failing:
+            raise Exception('{0} failed'.format(name))
+
+    def _run(self, profiles, services, max_workers=service_deployment.SERVICES_MAX_WORKERS):
+        deployment = service_deployment.ServiceDeployment(lambda profile: self._call('create ' + profile),
+                                                          lambda service: self._call('deploy ' + service),
+                                                          max_workers)
+        return deployment, deployment.run(profiles, services)
+
+    def test_each_profile_is_created_once(self):
+        _, errors = self._run(['cdn1', 'cdn2'], [('web', 'cdn1'), ('api', 'cdn1'), ('img', 'cdn2'), ('db', None)])
+        self.assertEqual(errors, [])
+        self.assertEqual(sorted(call for call in self.calls if call.startswith('create')),
+                         ['create cdn1', 'create cdn2'])
+        self.assertEqual(len(self.calls), 6)
+
+    def test_service_waits_only_for_its_own_profile(self):
+        # cdn1 is created only once img, a service of cdn2, was deployed
+        img_deployed = self.blocked['create cdn1'] = threading.Event()
+        original_call = self._call
+
+        def call(name):
+            original_call(name)
+            if name == 'deploy img':
+                img_deployed.set()
+        self._call = call
+        _, errors = self._run(['cdn1', 'cdn2'], [('web', 'cdn1'), ('img', 'cdn2')], max_workers=3)
+        self.assertEqual(errors, [])
+        self.assertLess(self.calls.index('create cdn2'), self.calls.index('deploy img'))
+        self.assertLess(self.calls.index('deploy img'), self.calls.index('create cdn1'))
+        self.assertLess(self.calls.index('create cdn1'), self.calls.index('deploy web'))
+
+    def test_failed_profile_only_stops_its_services(self):
+        self.failing.add('create cdn1')
+        deployment, _ = self._run(['cdn1', 'cdn2'], [('web', 'cdn1'), ('img', 'cdn2'), ('db', None)])
+        self.assertNotIn('deploy web', self.calls)
+        self.assertIn('deploy img', self.calls)
+        self.assertIn('deploy db', self.calls)
+        self.assertEqual(deployment.profile_errors.keys(), ['cdn1'])
+        self.assertEqual(deployment.deploy_errors.keys(), ['web'])
+
+    def test_profile_and_deploy_errors_are_reported(self):
+        self.failing.update(['create cdn1', 'deploy db'])
+        _, errors = self._run(['cdn1'], [('web', 'cdn1'), ('db', None)], max_workers=1)
+        self.assertEqual(errors, ['Error creating CDN profile cdn1: create cdn1 failed',
+                                  'Error deploying service web: CDN profile cdn1 was not created',
+                                  'Error deploying service db: deploy db failed'])
@@ -0,0 +1,38 @@
+import unittest
+
+from cloudshell.octopus.ttl_cache import TtlCache
+
+
+class ValueFactory(object):
+    def __init__(self):
+        self.calls = 0
+
+    def __call__(self):
+        self.calls += 1
+        return 'value-{0}'.format(self.calls)
+
+
+class TtlCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.cache = TtlCache(ttl=60)
+        self.create = ValueFactory()
+
+    def test_value_is_created_once(self):
+        self.assertEqual(self.cache.get('key', self.create), 'value-1')
+        self.assertEqual(self.cache.get('key', self.create), 'value-1')
+        self.assertEqual(self.create.calls, 1)
+        self.assertEqual((self.cache.hits, self.cache.misses), (1, 1))
+
+    def test_keys_are_cached_separately(self):
+        self.cache.get('first', self.create)
+        self.assertEqual(self.cache.get('second', self.create), 'value-2')
+
+    def test_invalidate_forces_create(self):
+        self.cache.get('key', self.create)
+        self.cache.invalidate('key')
+        self.assertEqual(self.cache.get('key', self.create), 'value-2')
+
+    def test_expired_value_is_created_again(self):
+        cache = TtlCache(ttl=-1)
+        cache.get('key', self.create)
+        self.assertEqual(cache.get('key', self.create), 'value-2')